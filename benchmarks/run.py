@@ -0,0 +1,329 @@
+"""
+Benchmark suite for libwyag.
+
+Each scenario runs in a fresh child process against a synthetic repository
+(see synthetic.py), so that its peak RSS and syscall counts are its own.
+The child measures only the operation, not its setup, and reports:
+
+    seconds, cpu      wall and CPU time of the operation
+    ops_per_sec       operations (files, commits, objects...) per second
+    mb_per_sec        payload throughput, where the scenario has one
+    peak_rss_kb       peak resident set size during the operation, of the
+                      child or of a process it ran (Linux only: the peak
+                      is reset through /proc/self/clear_refs after setup)
+    rw_syscalls       read and write syscalls made during the operation,
+                      from /proc/self/io (Linux only); other syscalls,
+                      stat or open, aren't counted
+
+Results go to a JSON file.  `compare` checks a run against a baseline and
+exits non-zero if a scenario's ops/sec dropped by more than the threshold,
+or if a scenario of the baseline failed or is missing in the new run, so
+it can gate merges:
+
+    python benchmarks/run.py run -o base.json           # on the base revision
+    python benchmarks/run.py run -o new.json            # on the candidate
+    python benchmarks/run.py compare base.json new.json --threshold 0.1
+"""
+
+import argparse
+import contextlib
+import json
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(HERE)
+sys.path.insert(0, ROOT)
+sys.path.insert(0, HERE)
+
+import libwyag  # noqa: E402
+from synthetic import SyntheticRepo  # noqa: E402
+
+# Scenarios, by name: function(args, synthetic) doing the setup and
+# returning the operation to time.  The operation returns (ops, bytes).
+SCENARIOS = {}
+
+def wyag(*argv):
+    """Run a libwyag command in-process, discarding its output."""
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        libwyag.main(list(argv))
+
+def plan_history(args, synthetic):
+    """
+    args.commits rounds of churn, generated up front so that generating
+    them isn't timed: a list of [(path, contents)] per round.
+    """
+    plan = {}
+    rounds = []
+    for i in range(args.commits):
+        changed = synthetic.churn(args.churn, plan)
+        rounds.append([(rel, plan[rel]) for rel in changed])
+    return rounds
+
+def make_history(synthetic, rounds):
+    """Write, add and commit each round of plan_history(); returns bytes added."""
+    added = 0
+    for i, changes in enumerate(rounds):
+        for rel, data in changes:
+            with open(os.path.join(synthetic.root, rel), "wb") as f:
+                f.write(data)
+        wyag("add", *(rel for rel, data in changes))
+        wyag("commit", f"Commit {i}")
+        added += sum(len(data) for rel, data in changes)
+    return added
+
+def scenario_init(args, synthetic):
+    def op():
+        for i in range(args.reps):
+            libwyag.repo_create(f"init-{i}")
+        return args.reps, 0
+    return op
+
+def scenario_add_cold(args, synthetic):
+    def op():
+        wyag("add", *synthetic.paths)
+        return len(synthetic.paths), synthetic.total_size()
+    return op
+
+def scenario_add_warm(args, synthetic):
+    wyag("add", *synthetic.paths)
+    time.sleep(0.01)  # Let the index get older than the files (racy git)
+    def op():
+        wyag("add", *synthetic.paths)
+        return len(synthetic.paths), synthetic.total_size()
+    return op
+
+def scenario_commit(args, synthetic):
+    wyag("add", *synthetic.paths)
+    rounds = plan_history(args, synthetic)
+    def op():
+        return args.commits, make_history(synthetic, rounds)
+    return op
+
+def scenario_log(args, synthetic):
+    wyag("add", *synthetic.paths)
+    make_history(synthetic, plan_history(args, synthetic))
+    def op():
+        wyag("log")
+        return args.commits, 0
+    return op
+
+def blobs(args, synthetic):
+    """args.reps in-memory blobs, each the size of one synthetic file."""
+    return [synthetic.content(synthetic.size()) for i in range(args.reps)]
+
+def scenario_object_write(args, synthetic):
+    repo = libwyag.GitRepository(os.getcwd())
+    data = blobs(args, synthetic)
+    def op():
+        for blob in data:
+            libwyag.object_write(b"blob", blob, repo)
+        return len(data), sum(map(len, data))
+    return op
+
+def scenario_object_read(args, synthetic):
+    repo = libwyag.GitRepository(os.getcwd())
+    shas = [libwyag.object_write(b"blob", blob, repo) for blob in blobs(args, synthetic)]
+    # Read through a fresh repository object, with a cold cache
+    repo = libwyag.GitRepository(os.getcwd())
+    def op():
+        size = 0
+        for sha in shas:
+            size += len(libwyag.object_read(repo, sha)[1])
+        return len(shas), size
+    return op
+
+def scenario_startup(args, synthetic):
+    cmd = [sys.executable, os.path.join(ROOT, "wyag"), "--version"]
+    def op():
+        for i in range(args.reps):
+            subprocess.run(cmd, check=True, stdout=subprocess.DEVNULL)
+        return args.reps, 0
+    return op
+
+SCENARIOS["init"] = scenario_init
+SCENARIOS["add-cold"] = scenario_add_cold
+SCENARIOS["add-warm"] = scenario_add_warm
+SCENARIOS["commit"] = scenario_commit
+SCENARIOS["log"] = scenario_log
+SCENARIOS["object-write"] = scenario_object_write
+SCENARIOS["object-read"] = scenario_object_read
+SCENARIOS["startup"] = scenario_startup
+
+def proc_io():
+    """Read/write syscall counters of this process, or None off Linux."""
+    try:
+        with open("/proc/self/io") as f:
+            fields = dict(line.split(": ") for line in f.read().splitlines())
+    except OSError:
+        return None
+    return {"read": int(fields["syscr"]), "write": int(fields["syscw"])}
+
+def peak_rss_reset():
+    """Restart this process's peak RSS count from now; False if it can't be."""
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+    except OSError:
+        return False
+    return True
+
+def run_child(args):
+    """Set up and time one scenario in this process; print its results."""
+    os.chdir(args.dir)
+    synthetic = SyntheticRepo(os.path.join(args.dir, "worktree"), args.files,
+                              args.depth, args.min_size, args.max_size, args.seed)
+    synthetic.generate()
+    os.chdir(synthetic.root)
+    libwyag.repo_create(".")
+
+    op = SCENARIOS[args.child](args, synthetic)
+
+    io_before = proc_io()
+    rss_reset = peak_rss_reset()
+    wall, cpu = time.perf_counter(), time.process_time()
+    ops, nbytes = op()
+    wall, cpu = time.perf_counter() - wall, time.process_time() - cpu
+    io_after = proc_io()
+
+    rusage = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    result = {
+        "seconds": wall,
+        "cpu": cpu,
+        "ops": ops,
+        "ops_per_sec": ops / wall if wall else None,
+        "bytes": nbytes,
+        "mb_per_sec": nbytes / wall / 1e6 if nbytes and wall else None,
+        # Setup runs no processes, so those waited for ran in the operation
+        "peak_rss_kb": max(rusage.ru_maxrss, children.ru_maxrss) if rss_reset else None,
+        "rw_syscalls": None,
+    }
+    if io_before and io_after:
+        result["rw_syscalls"] = {k: io_after[k] - io_before[k] for k in io_before}
+    json.dump(result, sys.stdout)
+
+def git_revision():
+    try:
+        return subprocess.check_output(["git", "-C", ROOT, "rev-parse", "HEAD"],
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def cmd_run(args):
+    params = {k: getattr(args, k) for k in
+              ("files", "depth", "min_size", "max_size", "commits", "churn", "reps", "seed")}
+    report = {"revision": git_revision(), "python": platform.python_version(),
+              "params": params, "scenarios": {}}
+
+    for name in args.scenarios or SCENARIOS:
+        workdir = tempfile.mkdtemp(prefix=f"wyag-bench-{name}-")
+        cmd = [sys.executable, os.path.abspath(__file__), "child", name, workdir]
+        for key, value in params.items():
+            cmd += [f"--{key.replace('_', '-')}", str(value)]
+        try:
+            proc = subprocess.run(cmd, capture_output=True, text=True)
+        finally:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+        if proc.returncode:
+            error = (proc.stderr.strip().splitlines() or ["failed"])[-1]
+            result = {"error": error}
+            print(f"{name:14} ERROR {error}")
+        else:
+            result = json.loads(proc.stdout)
+            mb = f"{result['mb_per_sec']:9.2f} MB/s" if result["mb_per_sec"] else " " * 14
+            rss = f"{result['peak_rss_kb']:8d} KB rss" if result["peak_rss_kb"] else ""
+            print(f"{name:14} {result['ops_per_sec']:12.1f} ops/s {mb} {rss}")
+        report["scenarios"][name] = result
+
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
+
+def cmd_compare(args):
+    with open(args.base) as f:
+        base = json.load(f)["scenarios"]
+    with open(args.new) as f:
+        new = json.load(f)["scenarios"]
+
+    regressions = []
+    for name in sorted(base):
+        old_rate = base[name].get("ops_per_sec")
+        if not old_rate:
+            print(f"{name:14} skipped (no baseline result)")
+            continue
+        # A scenario the candidate lost or broke fails the gate
+        if name not in new:
+            print(f"{name:14} MISSING from the new run")
+            regressions.append(name)
+            continue
+        new_rate = new[name].get("ops_per_sec")
+        if not new_rate:
+            print(f"{name:14} FAILED {new[name].get('error', 'no result')}")
+            regressions.append(name)
+            continue
+        change = new_rate / old_rate - 1
+        flag = ""
+        if change < -args.threshold:
+            flag = "  REGRESSION"
+            regressions.append(name)
+        print(f"{name:14} {old_rate:12.1f} -> {new_rate:12.1f} ops/s {change:+7.1%}{flag}")
+
+    if regressions:
+        print(f"{len(regressions)} scenario(s) failed or slower than the "
+              f"{args.threshold:.0%} threshold")
+        sys.exit(1)
+
+def add_params(argsp):
+    argsp.add_argument("--files", type=int, default=1000, help="Files in the synthetic worktree.")
+    argsp.add_argument("--depth", type=int, default=3, help="Directory depth.")
+    argsp.add_argument("--min-size", type=int, default=100, help="Smallest file size.")
+    argsp.add_argument("--max-size", type=int, default=100 * 1024, help="Largest file size.")
+    argsp.add_argument("--commits", type=int, default=20, help="Commits in the history.")
+    argsp.add_argument("--churn", type=float, default=0.01,
+                       help="Fraction of the files each commit changes.")
+    argsp.add_argument("--reps", type=int, default=100,
+                       help="Repetitions for the init, object and startup scenarios.")
+    argsp.add_argument("--seed", type=int, default=0)
+
+def main():
+    argparser = argparse.ArgumentParser(description="Benchmark libwyag.")
+    argsubparsers = argparser.add_subparsers(dest="command")
+    argsubparsers.required = True
+
+    argsp = argsubparsers.add_parser("run", help="Run the scenarios.")
+    argsp.add_argument("scenarios", nargs="*",
+                       help=f"Scenarios to run (default: all): {', '.join(SCENARIOS)}.")
+    argsp.add_argument("-o", "--output", default="bench.json", help="Where to write the results.")
+    add_params(argsp)
+
+    argsp = argsubparsers.add_parser("compare", help="Compare two runs.")
+    argsp.add_argument("base", help="Results of the baseline revision.")
+    argsp.add_argument("new", help="Results of the candidate revision.")
+    argsp.add_argument("--threshold", type=float, default=0.10,
+                       help="Largest tolerated drop in ops/sec (default 0.10).")
+
+    argsp = argsubparsers.add_parser("child")
+    argsp.add_argument("child", choices=list(SCENARIOS))
+    argsp.add_argument("dir")
+    add_params(argsp)
+
+    args = argparser.parse_args()
+    if args.command == "run":
+        unknown = set(args.scenarios) - set(SCENARIOS)
+        if unknown:
+            argparser.error(f"unknown scenarios: {', '.join(sorted(unknown))}")
+        cmd_run(args)
+    elif args.command == "compare":
+        cmd_compare(args)
+    else:
+        run_child(args)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,117 @@
+"""
+Synthetic repository generator for the benchmarks.
+
+Builds a worktree of N files spread over a directory tree of a given
+depth, with sizes drawn log-uniformly between a minimum and a maximum so
+that most files are small and a few are large, like in a real source
+tree.  Contents are lines sampled from a fixed pool of random words: they
+compress and deltify roughly like source code does.  Everything derives
+from a seed, so two runs with the same parameters produce the same tree.
+"""
+
+import argparse
+import math
+import os
+import random
+
+WORDS = ["alpha", "beta", "gamma", "delta", "index", "object", "commit",
+         "tree", "blob", "return", "self", "import", "def", "class", "for",
+         "while", "if", "else", "None", "True", "False", "data", "path"]
+
+class SyntheticRepo(object):
+    """Parameters of a synthetic worktree, and the files generated for it."""
+
+    def __init__(self, root, files=1000, depth=3, min_size=100,
+                 max_size=100 * 1024, seed=0):
+        self.root = root
+        self.files = files
+        self.depth = depth
+        self.min_size = min_size
+        self.max_size = max_size
+        self.rng = random.Random(seed)
+        self.lines = [" ".join(self.rng.choice(WORDS)
+                               for i in range(self.rng.randint(2, 12))) + "\n"
+                      for j in range(1000)]
+        self.paths = []  # Generated files, relative to root
+
+    def size(self):
+        """A file size, log-uniform between min_size and max_size."""
+        return int(math.exp(self.rng.uniform(math.log(self.min_size),
+                                             math.log(self.max_size))))
+
+    def content(self, size):
+        """size bytes of source-like text."""
+        out = []
+        n = 0
+        while n < size:
+            line = self.rng.choice(self.lines)
+            out.append(line)
+            n += len(line)
+        return "".join(out)[:size].encode()
+
+    def generate(self):
+        """Write the worktree and return the generated paths."""
+        # Spread files over directories dir0/dir3/..., up to depth levels
+        fanout = max(2, int(round(self.files ** (1 / (self.depth + 1)))))
+        for i in range(self.files):
+            parts = []
+            n = i
+            for level in range(self.depth):
+                n //= fanout
+                parts.append(f"dir{n % fanout}")
+            rel = os.path.join(*parts, f"file{i}.txt")
+            path = os.path.join(self.root, rel)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, "wb") as f:
+                f.write(self.content(self.size()))
+            self.paths.append(rel)
+        return self.paths
+
+    def churn(self, fraction, plan=None):
+        """
+        Rewrite a random part of a fraction of the files; return them.
+
+        With plan, a dict, nothing is written: the new contents go to
+        plan[path] instead, and are read back from there by the next
+        rounds, so that a history can be generated ahead of time.
+        """
+        count = max(1, int(len(self.paths) * fraction))
+        changed = self.rng.sample(self.paths, count)
+        for rel in changed:
+            path = os.path.join(self.root, rel)
+            if plan is not None and rel in plan:
+                data = plan[rel]
+            else:
+                with open(path, "rb") as f:
+                    data = f.read()
+            start = self.rng.randrange(len(data) or 1)
+            patch = self.content(self.rng.randint(1, 200))
+            data = data[:start] + patch + data[start + len(patch):]
+            if plan is not None:
+                plan[rel] = data
+            else:
+                with open(path, "wb") as f:
+                    f.write(data)
+        return changed
+
+    def total_size(self):
+        return sum(os.path.getsize(os.path.join(self.root, rel))
+                   for rel in self.paths)
+
+def main():
+    argparser = argparse.ArgumentParser(description="Generate a synthetic worktree.")
+    argparser.add_argument("root", help="Directory to generate the files in.")
+    argparser.add_argument("--files", type=int, default=1000)
+    argparser.add_argument("--depth", type=int, default=3)
+    argparser.add_argument("--min-size", type=int, default=100)
+    argparser.add_argument("--max-size", type=int, default=100 * 1024)
+    argparser.add_argument("--seed", type=int, default=0)
+    args = argparser.parse_args()
+
+    repo = SyntheticRepo(args.root, args.files, args.depth, args.min_size,
+                         args.max_size, args.seed)
+    repo.generate()
+    print(f"Generated {len(repo.paths)} files, {repo.total_size()} bytes in {args.root}")
+
+if __name__ == "__main__":
+    main()
@@ -1,35 +1,173 @@
-import argparse
-import configparser
-from datetime import datetime
-import grp, pwd
-from fnmatch import fnmatch
-import hashlib
-from math import ceil
+import bisect
+import collections
+import itertools
 import os
-import re
 import stat
+import struct
 import sys
-import zlib
-import logging
+import threading
+import time
 
-# Configure logging to display INFO level messages
-logging.basicConfig(
-    level=logging.INFO,  # Set the logging level to INFO
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'  # Format for log messages
-)
+# Modules only some commands need (argparse, configparser,
+# concurrent.futures, ctypes, getpass, hashlib, heapq, json, logging, math,
+# mmap, re, select, socket, socketserver, subprocess, tempfile, zlib) are
+# imported where they are used, so that starting the CLI doesn't pay for
+# them.
 
-logger = logging.getLogger('git')
-logger.info('Initializing git CLI application')
-logger.info('Setting up logging')
+__version__ = "0.1.0"
 
-# GitRepository class definition
+class LazyLogger(object):
+    """Stands in for logging.getLogger('git') until something is logged."""
+
+    def __getattr__(self, name):
+        import logging
+        global logger
+        logger = logging.getLogger('git')
+        return getattr(logger, name)
+
+logger = LazyLogger()
+
+# Commands, by name: (function, help, function adding its arguments).
+# The argument parser is only built in main(), and only the command being
+# run gets its arguments set up.
+COMMANDS = {}
+
+# Tracing
+#
+# With WYAG_TRACE=/path/file.jsonl set, a command appends JSON events to
+# that file: one when it starts, one when it ends, and in between one
+# "region" event per phase ("hash", "compress", "write", "walk"...) with
+# the wall and CPU time spent in it and the objects and bytes it handled.
+# A region adds up every entry into it over the whole command, across
+# threads, so hot loops can be traced without an event per object.  With
+# WYAG_TRACE unset, trace_region() hands back a shared no-op span.
+
+class TraceRegion(object):
+    """Totals for one phase of the running command."""
+
+    def __init__(self, name):
+        self.name = name
+        self.count = 0    # Times the region was entered
+        self.wall = 0.0   # Seconds, summed over threads
+        self.cpu = 0.0    # Thread CPU seconds, summed over threads
+        self.objects = 0
+        self.bytes = 0
+        self.lock = threading.Lock()
+
+class TraceSpan(object):
+    """One timed entry into a region, used as a context manager."""
+
+    __slots__ = ("region", "objects", "bytes", "wall", "cpu")
+
+    def __init__(self, region):
+        self.region = region
+        self.objects = 0
+        self.bytes = 0
+
+    def add(self, objects=0, bytes=0):
+        """Count objects and bytes handled in this span."""
+        self.objects += objects
+        self.bytes += bytes
+
+    def __enter__(self):
+        self.wall = time.perf_counter()
+        self.cpu = time.thread_time()
+        return self
+
+    def __exit__(self, *exc):
+        wall = time.perf_counter() - self.wall
+        cpu = time.thread_time() - self.cpu
+        region = self.region
+        with region.lock:
+            region.count += 1
+            region.wall += wall
+            region.cpu += cpu
+            region.objects += self.objects
+            region.bytes += self.bytes
+        return False
+
+class NullSpan(object):
+    """What trace_region() returns when tracing is off: does nothing."""
+
+    def add(self, objects=0, bytes=0):
+        pass
+
+    def __enter__(self):
+        return self
 
-# Initialize the argument parser
-argparser = argparse.ArgumentParser(description="The stupidest content tracker")
+    def __exit__(self, *exc):
+        return False
 
-# Add subparsers for commands
-argsubparsers = argparser.add_subparsers(title="Commands", dest="command")
-argsubparsers.required = True
+NULL_SPAN = NullSpan()
+
+class Trace(object):
+    """The open WYAG_TRACE file and the regions of the running command."""
+
+    def __init__(self, path, command):
+        self.fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o666)
+        self.command = command
+        self.regions = {}
+        self.lock = threading.Lock()
+        self.wall = time.perf_counter()
+        self.cpu = time.process_time()
+
+    def event(self, event, **fields):
+        """Append one event; each is a single O_APPEND write of one line."""
+        import json
+        record = {"event": event, "time": time.time(), "pid": os.getpid(),
+                  "command": self.command}
+        record.update(fields)
+        os.write(self.fd, (json.dumps(record) + "\n").encode())
+
+    def span(self, name):
+        region = self.regions.get(name)
+        if region is None:
+            with self.lock:
+                region = self.regions.setdefault(name, TraceRegion(name))
+        return TraceSpan(region)
+
+TRACE = None  # The Trace of the running command, if WYAG_TRACE is set
+
+def trace_start(command, argv):
+    """Open WYAG_TRACE, if set, and record that command started."""
+    global TRACE
+    path = os.environ.get("WYAG_TRACE")
+    if not path:
+        return
+    try:
+        TRACE = Trace(path, command)
+    except OSError as e:
+        logger.warning("Not tracing to %s: %s", path, e)
+        return
+    TRACE.event("start", argv=argv)
+
+def trace_region(name):
+    """Time a phase: `with trace_region("hash") as span: span.add(bytes=n)`."""
+    if TRACE is None:
+        return NULL_SPAN
+    return TRACE.span(name)
+
+def trace_event(event, **fields):
+    """Record a one-off event, such as cache statistics."""
+    if TRACE is not None:
+        TRACE.event(event, **fields)
+
+def trace_end(status):
+    """Record every region of the command, then its end, and close the trace."""
+    global TRACE
+    if TRACE is None:
+        return
+    trace, TRACE = TRACE, None
+    for region in trace.regions.values():
+        trace.event("region", name=region.name, count=region.count,
+                    wall=region.wall, cpu=region.cpu,
+                    objects=region.objects, bytes=region.bytes)
+    trace.event("end", status=status,
+                wall=time.perf_counter() - trace.wall,
+                cpu=time.process_time() - trace.cpu)
+    os.close(trace.fd)
+
+# GitRepository class definition
 class GitRepository(object):
     """A git repository"""
 
@@ -37,6 +175,12 @@ class GitRepository(object):
     worktree = None  # Path to the working directory
     gitdir = None    # Path to the .git directory
     conf = None      # Configuration object for .git/config
+    packs = None     # Open GitPack objects, see repo_packs()
+    cache = None     # ObjectCache of recently read objects
+    fanout_dirs = None  # objects/xx directories known to exist
+    refs = None      # Memo of resolved refs, see ref_resolve()
+    packed_refs = None  # .git/packed-refs, read on first use
+    commit_graph = None  # GitCommitGraph, see repo_commit_graph()
 
     def __init__(self, path, force=False):
         """
@@ -53,14 +197,10 @@ class GitRepository(object):
         if not (force or os.path.isdir(self.gitdir)):
             raise Exception(f"Not a Git repository {path}")
 
-        # Initialize the configuration parser
-        self.conf = configparser.ConfigParser()
-        cf = repo_file(self, "config")  # Path to .git/config
-
         # Read the configuration file if it exists
-        if cf and os.path.exists(cf):
-            self.conf.read([cf])
-        elif not force:
+        cf = repo_file(self, "config")  # Path to .git/config
+        self.conf = config_new()
+        if not (cf and config_read(self.conf, cf)) and not force:
             raise Exception("Configuration file missing")
 
         # Validate the repository format version
@@ -69,6 +209,67 @@ class GitRepository(object):
             if vers != 0:
                 raise Exception(f"Unsupported repositoryformatversion: {vers}")
 
+        self.refs = {}
+
+        # Cache of decompressed objects and delta bases
+        self.cache = ObjectCache(config_size(self, "core", "deltabasecachelimit",
+                                             DEFAULT_OBJECT_CACHE_LIMIT))
+
+
+# Object cache
+#
+# Reading an object means a file open or a pack lookup plus a zlib
+# inflate, and history walks read the same trees and delta bases over and
+# over.  Each repository keeps the most recently used decompressed objects
+# in memory, up to a byte budget.
+
+# Default for core.deltaBaseCacheLimit, the cache's byte budget
+DEFAULT_OBJECT_CACHE_LIMIT = 96 * 1024 * 1024
+# Rough per-entry cost of the cache's own bookkeeping
+OBJECT_CACHE_OVERHEAD = 128
+
+class ObjectCache(object):
+    """A least-recently-used cache of (fmt, data) pairs, bounded in bytes."""
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        """The cached value for key, or None."""
+        with self.lock:
+            value = self.entries.get(key)
+            if value is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.entries.move_to_end(key)
+            return value
+
+    def put(self, key, value):
+        """Cache value, a (fmt, data) pair, evicting the oldest entries."""
+        cost = len(value[1]) + OBJECT_CACHE_OVERHEAD
+        if cost > self.limit:
+            return
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.size -= len(old[1]) + OBJECT_CACHE_OVERHEAD
+            self.entries[key] = value
+            self.size += cost
+            while self.size > self.limit:
+                _, evicted = self.entries.popitem(last=False)
+                self.size -= len(evicted[1]) + OBJECT_CACHE_OVERHEAD
+
+    def stats(self):
+        """Hit/miss counters and current usage, for logging and tracing."""
+        return {"hits": self.hits, "misses": self.misses,
+                "entries": len(self.entries), "bytes": self.size,
+                "limit": self.limit}
 
 # Helper function to construct paths within the .git directory
 def repo_path(repo, *path):
@@ -97,18 +298,19 @@ def repo_dir(repo, *path, mkdir=False):
 
     path = repo_path(repo, *path)
 
-    if os.path.exists(path):
-        if (os.path.isdir(path)):
+    # A single stat tells both whether path exists and whether it's a dir
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        if mkdir:
+            os.makedirs(path, exist_ok=True)
             return path
-        else:
-            raise Exception(f"Not a directory {path}")
+        return None
 
-    if mkdir:
-        os.makedirs(path)
+    if stat.S_ISDIR(st.st_mode):
         return path
-    else:
-        return None
-    
+    raise Exception(f"Not a directory {path}")
+
 def repo_create(path):
     """Create a new repository at path."""
 
@@ -144,8 +346,32 @@ def repo_create(path):
 
     return repo
 
+def config_new():
+    """
+    An empty ConfigParser that takes git's config syntax: sections may
+    repeat, and values are taken as they are, "%" included.
+    """
+    import configparser
+    return configparser.ConfigParser(strict=False, interpolation=None)
+
+def config_read(conf, path):
+    """
+    Read the git config file at path into conf; False if there is none.
+
+    `git config` indents keys with a tab, which configparser would take
+    for the continuation of the previous key's value, so the lines are
+    stripped of their indentation first.
+    """
+    try:
+        with open(path, encoding="utf8") as f:
+            lines = [line.lstrip() for line in f]
+    except FileNotFoundError:
+        return False
+    conf.read_string("".join(lines), path)
+    return True
+
 def repo_default_config():
-    ret = configparser.ConfigParser()
+    ret = config_new()
 
     ret.add_section("core")
     ret.set("core", "repositoryformatversion", "0")
@@ -154,100 +380,4635 @@ def repo_default_config():
 
     return ret
 
+def config_size(repo, section, key, fallback):
+    """Read a size such as "512m" from .git/config, in bytes."""
+    value = repo.conf.get(section, key, fallback=None)
+    if value is None:
+        return fallback
+    units = {"k": 1024, "m": 1024**2, "g": 1024**3}
+    value = value.strip().lower()
+    if value[-1:] in units:
+        return int(value[:-1]) * units[value[-1]]
+    return int(value)
+
 def cmd_init(args):
-    logger.info(f'Initializing a new repository at {args.path}')
+    logger.info('Initializing a new repository at %s', args.path)
     repo_create(args.path)
     
-argsp = argsubparsers.add_parser("init", help="Initialize a new, empty repository.")
-argsp.add_argument("path",
-                   metavar="directory",
-                   nargs="?",
-                   default=".",
-                   help="Where to create the repository.")
+def argsp_init(argsp):
+    argsp.add_argument("path",
+                       metavar="directory",
+                       nargs="?",
+                       default=".",
+                       help="Where to create the repository.")
 
-# Add functionality for `add` command to stage files
-def cmd_add(args):
-    """Handle the 'add' command."""
-    logger.info(f"Staging file(s): {args.files}")
-    repo = GitRepository(os.getcwd())  # Initialize repository object
-    # Logic to add files to the staging area
-    for file in args.files:
-        logger.info(f"Processing file: {file}")
-        # Example: Compute hash and store in objects directory
-        with open(file, "rb") as f:
-            data = f.read()
-            sha1 = hashlib.sha1(data).hexdigest()
-            obj_path = os.path.join(repo.gitdir, "objects", sha1[:2], sha1[2:])
-            os.makedirs(os.path.dirname(obj_path), exist_ok=True)
-            with open(obj_path, "wb") as obj_file:
-                obj_file.write(data)
-    logger.info("Files staged successfully.")
+COMMANDS["init"] = (cmd_init, "Initialize a new, empty repository.", argsp_init)
 
-argsp_add = argsubparsers.add_parser("add", help="Stage files for the next commit.")
-argsp_add.add_argument("files", nargs="+", help="Files to stage.")
+# Size of the blocks large files are read and hashed in.  Keeping this
+# fixed bounds the memory `add` needs, whatever the size of the file.
+BLOCK_SIZE = 1024 * 1024
 
-# Add functionality for `commit` command to create a snapshot
-def cmd_commit(args):
-    """Handle the 'commit' command."""
-    logger.info(f"Creating commit with message: {args.message}")
-    repo = GitRepository(os.getcwd())  # Initialize repository object
-    # Logic to create a commit object
-    tree_hash = "dummy_tree_hash"  # Replace with actual tree hash computation
-    parent_hash = "dummy_parent_hash"  # Replace with actual parent hash lookup
-    commit_data = f"tree {tree_hash}\nparent {parent_hash}\n\n{args.message}"
-    sha1 = hashlib.sha1(commit_data.encode()).hexdigest()
-    obj_path = os.path.join(repo.gitdir, "objects", sha1[:2], sha1[2:])
-    os.makedirs(os.path.dirname(obj_path), exist_ok=True)
-    with open(obj_path, "wb") as obj_file:
-        obj_file.write(commit_data.encode())
-    logger.info(f"Commit created successfully: {sha1}")
-
-argsp_commit = argsubparsers.add_parser("commit", help="Create a new commit.")
-argsp_commit.add_argument("message", help="Commit message.")
+# Object ids
+#
+# Ids are kept as their 20 raw bytes everywhere: that's how packs, the
+# index, trees and the commit-graph store them, so nothing gets converted
+# on the way in or out, and they hash and compare faster than 40
+# character hex strings.  ObjectId only turns into hex when printed
+# (str(), f-strings, logging).
 
-# Add functionality for `log` command to display commit history
-def cmd_log(args):
-    """Handle the 'log' command."""
-    logger.info("Displaying commit history")
-    repo = GitRepository(os.getcwd())  # Initialize repository object
-    # Logic to traverse and display commit history
-    current_commit = "dummy_commit_hash"  # Replace with actual HEAD lookup
-    while current_commit:
-        commit_path = os.path.join(repo.gitdir, "objects", current_commit[:2], current_commit[2:])
-        with open(commit_path, "rb") as commit_file:
-            commit_data = commit_file.read().decode()
-            logger.info(f"Commit: {current_commit}\n{commit_data}")
-            # Extract parent hash for next iteration
-            current_commit = "dummy_parent_hash"  # Replace with actual parent hash extraction
-
-argsp_log = argsubparsers.add_parser("log", help="Display commit history.")
+class ObjectId(bytes):
+    """A binary object id."""
 
-# Define the main function
-def main(argv=sys.argv[1:]):
+    __slots__ = ()
+
+    @classmethod
+    def from_hex(cls, text):
+        """The ObjectId of a 40 character hex string."""
+        if len(text) != 40:
+            raise ValueError(f"Bad object id {text!r}")
+        return cls(bytes.fromhex(text))
+
+    def __str__(self):
+        return self.hex()
+
+    def __repr__(self):
+        return f"ObjectId('{self.hex()}')"
+
+# Loose object store
+def new_sha1(data=b""):
+    """A new hashlib SHA-1 object; hashlib is imported on first use."""
+    import hashlib
+    return hashlib.sha1(data)
+
+def object_path(repo, sha):
+    """Path of the loose object named sha (objects/xx/yyyy...)."""
+    name = sha.hex()
+    return repo_path(repo, "objects", name[:2], name[2:])
+
+def object_exists(repo, sha):
+    """True if the object sha is already in the store, packed or loose."""
+    return pack_object_find(repo, sha) is not None or \
+        os.path.exists(object_path(repo, sha))
+
+def object_store(repo, sha, blocks):
     """
-    Main entry point for the CLI.
+    Write the loose object sha from an iterable of byte blocks.
+
+    Objects are content-addressed, so if sha already exists nothing is
+    written at all.  Otherwise the blocks go to a temporary file, which is
+    then renamed into place: readers (and concurrent writers) only ever
+    see complete objects.
 
     Args:
-        argv (list): Command-line arguments (excluding the script name).
+        repo (GitRepository): The repository object.
+        sha (ObjectId): Object id the blocks hash to.
+        blocks (iterable): Byte strings making up the stored object.
+
+    Returns:
+        bool: True if the object was written, False if it already existed.
     """
-    logging.info('Starting the git CLI application')
-    args = argparser.parse_args(argv)
-    logging.info(f'Parsed arguments: {args}')
-
-    # Replace the match statement with if-elif conditions for compatibility with Python 3.9
-    if args.command == "add":
-        cmd_add(args)
-    elif args.command == "commit":
-        cmd_commit(args)
-    elif args.command == "init":
-        logger.info(f'Command: {args.command}') 
-        cmd_init(args)
-    elif args.command == "log":
-        cmd_log(args)
-    else:
-        print("Bad command.")
+    if object_exists(repo, sha):
+        return False
+    tmp_path = object_tmp_write(repo, blocks)
+    object_rename(repo, tmp_path, sha)
+    return True
+
+def object_tmp_write(repo, blocks):
+    """Write blocks to a new temporary file in objects/; return its path."""
+    import tempfile
+    fd, tmp_path = tempfile.mkstemp(dir=repo_path(repo, "objects"), prefix="tmp_obj_")
+    try:
+        with os.fdopen(fd, "wb") as tmp_file:
+            for block in blocks:
+                with trace_region("write") as span:
+                    tmp_file.write(block)
+                    span.add(bytes=len(block))
+    except BaseException:
+        object_tmp_remove(tmp_path)
+        raise
+    return tmp_path
+
+def object_tmp_remove(tmp_path):
+    try:
+        os.unlink(tmp_path)
+    except FileNotFoundError:
+        pass
+
+def object_rename(repo, tmp_path, sha):
+    """Move the complete temporary file tmp_path to where object sha goes."""
+    fanout = sha.hex()[:2]
+    path = object_path(repo, sha)
+    try:
+        with trace_region("write") as span:
+            try:
+                object_fanout_dir(repo, fanout)
+                os.replace(tmp_path, path)
+            except FileNotFoundError:
+                # A concurrent gc removed the fanout directory since we saw it
+                repo.fanout_dirs.discard(fanout)
+                object_fanout_dir(repo, fanout)
+                os.replace(tmp_path, path)
+            span.add(objects=1)
+    except BaseException:
+        object_tmp_remove(tmp_path)
+        raise
+
+def object_fanout_dir(repo, fanout):
+    """
+    Path of objects/<fanout>, creating it if needed.
+
+    The fanout directories present are listed with one scandir the first
+    time an object is written, and remembered for the rest of the process,
+    so writing many objects doesn't stat or mkdir the same 256 directories
+    over and over.
+    """
+    if repo.fanout_dirs is None:
+        repo.fanout_dirs = set()
+        with os.scandir(repo_path(repo, "objects")) as entries:
+            repo.fanout_dirs.update(e.name for e in entries
+                                    if len(e.name) == 2 and e.is_dir())
+
+    path = repo_path(repo, "objects", fanout)
+    if fanout not in repo.fanout_dirs:
+        try:
+            os.mkdir(path)
+        except FileExistsError:
+            pass
+        repo.fanout_dirs.add(fanout)
+    return path
+
+def file_blocks(path):
+    """Yield the contents of path in BLOCK_SIZE chunks."""
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(BLOCK_SIZE), b""):
+            yield block
+
+# Git's default for loose objects is Z_BEST_SPEED: they are written once
+# and usually repacked later, so speed matters more than size.
+DEFAULT_LOOSE_COMPRESSION = 1
+
+def object_compression_level(repo):
+    """
+    zlib level for loose objects, as configured in .git/config.
+
+    core.looseCompression wins over core.compression, which in turn
+    wins over the default.  Like git, -1 means zlib's own default.
+    """
+    level = DEFAULT_LOOSE_COMPRESSION
+    for key in ("compression", "loosecompression"):
+        if repo.conf.has_option("core", key):
+            level = repo.conf.getint("core", key)
+    if not -1 <= level <= 9:
+        raise Exception(f"Bad zlib compression level {level}")
+    return level
+
+def object_header(fmt, size):
+    """The `<fmt> <size>\\0` header git hashes and stores before the data."""
+    return fmt + b" " + str(size).encode() + b"\x00"
+
+def object_compress(repo, blocks):
+    """zlib-compress an iterable of blocks, yielding compressed blocks."""
+    import zlib
+    compressor = zlib.compressobj(object_compression_level(repo))
+    for block in blocks:
+        with trace_region("compress") as span:
+            out = compressor.compress(block)
+            span.add(bytes=len(block))
+        if out:
+            yield out
+    with trace_region("compress") as span:
+        out = compressor.flush()
+        span.add(objects=1)
+    yield out
+
+def object_write(fmt, data, repo=None):
+    """
+    Hash an object and, if repo is given, store it.
+
+    Args:
+        fmt (bytes): Object type (b"blob", b"commit", ...).
+        data (bytes): Serialized object contents.
+        repo (GitRepository): Where to store the object, or None to only hash.
+
+    Returns:
+        ObjectId: The object id.
+    """
+    with trace_region("hash") as span:
+        header = object_header(fmt, len(data))
+        sha = new_sha1(header)
+        sha.update(data)
+        sha1 = ObjectId(sha.digest())
+        span.add(objects=1, bytes=len(data))
+
+    if repo:
+        object_store(repo, sha1, object_compress(repo, [header, data]))
+    return sha1
+
+def object_write_file(path, fmt=b"blob", repo=None):
+    """
+    Streaming counterpart of object_write for files on disk.
+
+    The file is first read once just to hash it, so that content already
+    in the store costs no compression and no write.  Only a missing object
+    is read a second time, through the compressor into a temporary file
+    and through the hasher again: the temporary file only gets its name if
+    both passes agree, so what is stored is always exactly what the id was
+    computed from, even if the file changes meanwhile.
+    """
+    size = os.stat(path).st_size
+    header = object_header(fmt, size)
+
+    def blocks(sha):
+        read = 0
+        yield header
+        for block in file_blocks(path):
+            with trace_region("hash") as span:
+                sha.update(block)
+                span.add(bytes=len(block))
+            read += len(block)
+            yield block
+        with trace_region("hash") as span:
+            span.add(objects=1)
+        if read != size:
+            raise Exception(f"{path} changed while it was being hashed")
+
+    sha = new_sha1(header)
+    for block in blocks(sha):
+        pass
+    sha1 = ObjectId(sha.digest())
+    if not repo or object_exists(repo, sha1):
+        return sha1
+
+    sha = new_sha1(header)
+    tmp_path = object_tmp_write(repo, object_compress(repo, blocks(sha)))
+    if sha.digest() != sha1:
+        object_tmp_remove(tmp_path)
+        raise Exception(f"{path} changed while it was being hashed")
+    object_rename(repo, tmp_path, sha1)
+    return sha1
+
+def object_read(repo, sha):
+    """
+    Read the object sha from the repository.
+
+    Packs are searched first, then the loose objects.  If the object is
+    in neither, the pack directory is scanned again in case a concurrent
+    repack moved it.  Recently read objects come from the repository's
+    cache: packed ones are cached under (pack path, offset), the key
+    GitPack.read_at() looks delta bases up by, so that an object read
+    directly is found again as a delta base, and the other way around.
+
+    Returns:
+        tuple: (fmt, data), the object type and its contents as bytes.
+    """
+    found = pack_object_find(repo, sha)
+    key = (found[0].pack_path, found[1]) if found else sha
+    cached = repo.cache.get(key)
+    if cached:
+        return cached
+
+    with trace_region("read") as span:
+        if not found and not os.path.exists(object_path(repo, sha)):
+            found = pack_object_find(repo, sha, rescan=True)
+            if not found:
+                raise Exception(f"Object {sha} not found")
+            key = (found[0].pack_path, found[1])
+        if found:
+            pack, offset = found
+            obj = pack.read_at(offset, lambda base: object_read(repo, base), repo.cache)
+            repo.cache.put(key, obj)
+            span.add(objects=1, bytes=len(obj[1]))
+            return obj
+
+        import zlib
+        with open(object_path(repo, sha), "rb") as f:
+            raw = zlib.decompress(f.read())
+        span.add(objects=1, bytes=len(raw))
+
+    # Read the object type and size from the header
+    x = raw.find(b" ")
+    y = raw.find(b"\x00", x)
+    if x < 0 or y < 0:
+        raise Exception(f"Malformed object {sha}: bad header")
+    fmt = raw[0:x]
+    size = int(raw[x + 1:y])
+    if size != len(raw) - y - 1:
+        raise Exception(f"Malformed object {sha}: bad length")
+
+    obj = (fmt, raw[y + 1:])
+    repo.cache.put(sha, obj)
+    return obj
+
+def object_info(repo, sha):
+    """(fmt, size) of the object sha, packed or loose, without reading it all."""
+    found = pack_object_find(repo, sha)
+    if found:
+        pack, offset = found
+        return pack.info(offset, lambda base: object_info(repo, base))
+    fmt, size, blocks = object_read_blocks(repo, sha)
+    blocks.close()
+    return fmt, size
+
+def object_read_blocks(repo, sha):
+    """
+    Stream the loose object sha without inflating it all at once.
+
+    Returns:
+        tuple: (fmt, size, blocks), blocks being a generator of the
+        object's contents in chunks of at most BLOCK_SIZE bytes.
+    """
+    def inflate(f):
+        import zlib
+        with f:
+            d = zlib.decompressobj()
+            while not d.eof:
+                data = d.unconsumed_tail or f.read(BLOCK_SIZE)
+                if not data:
+                    out = d.flush()
+                    if out:
+                        yield out
+                    break
+                out = d.decompress(data, BLOCK_SIZE)
+                if out:
+                    yield out
+
+    blocks = inflate(open(object_path(repo, sha), "rb"))
+    head = b""
+    for block in blocks:
+        head += block
+        if b"\x00" in head:
+            break
+    x = head.find(b" ")
+    y = head.find(b"\x00", x)
+    if x < 0 or y < 0:
+        blocks.close()
+        raise Exception(f"Malformed object {sha}: bad header")
+    fmt = head[0:x]
+    size = int(head[x + 1:y])
+
+    def contents():
+        try:
+            yield head[y + 1:]
+            yield from blocks
+        finally:
+            blocks.close()
+
+    return fmt, size, contents()
+
+# Object model
+#
+# Parsed objects are small __slots__ classes rather than dicts, and refer
+# to other objects by ObjectId, so that walks holding many of them stay
+# cheap in memory.
+
+class Blob(object):
+    """A file's contents."""
+
+    __slots__ = ("oid", "data")
+
+    def __init__(self, oid, data):
+        self.oid = oid
+        self.data = data
+
+class TreeEntry(object):
+    """One item of a tree: a file, a symlink, a submodule or a subtree."""
+
+    __slots__ = ("mode", "name", "oid")
+
+    def __init__(self, mode, name, oid):
+        self.mode = mode  # Octal string, TREE_MODE for subtrees
+        self.name = name
+        self.oid = oid
+
+class Tree(object):
+    """A directory: its entries, in git's order."""
+
+    __slots__ = ("oid", "entries")
+
+    def __init__(self, oid, entries):
+        self.oid = oid
+        self.entries = entries
+
+# Commits and tags are "key value" header lines, a blank line, then a
+# message.  They are parsed lazily, in place: a Commit keeps its raw bytes
+# and only looks a header up when it's asked for, so a history walk that
+# needs the parents and the committer date never touches the message or
+# a signature, and nothing is copied but the values actually read.
+
+def kvlm_headers(data):
+    """
+    Yield (key, start, end) for the headers of the raw commit or tag
+    data, in order, up to the blank line before the message.  The value
+    is data[start:end], continuation lines (as in gpgsig) included.
+    """
+    pos = 0
+    size = len(data)
+    while pos < size:
+        eol = data.find(b"\n", pos)
+        if eol < 0:
+            eol = size
+        if eol == pos:
+            return
+        space = data.find(b" ", pos, eol)
+        key_end = space if space >= 0 else eol
+        # Lines starting with a space continue the value
+        while eol + 1 < size and data[eol + 1] == 0x20:
+            eol = data.find(b"\n", eol + 1)
+            if eol < 0:
+                eol = size
+        yield data[pos:key_end], min(key_end + 1, eol), eol
+        pos = eol + 1
+
+def kvlm_value(data, start, end):
+    """A header value as bytes, its continuation lines joined."""
+    return data[start:end].replace(b"\n ", b"\n")
+
+def kvlm_header(data, key):
+    """The value of the first header key of the raw commit or tag data, or None."""
+    for name, start, end in kvlm_headers(data):
+        if name == key:
+            return kvlm_value(data, start, end)
+    return None
+
+def kvlm_message(data):
+    """The message of the raw commit or tag data, as a memoryview into it."""
+    # Continuation lines start with a space, so the first empty line
+    # ends the headers
+    end = data.find(b"\n\n")
+    return memoryview(data)[end + 2:] if end >= 0 else memoryview(b"")
+
+class Commit(object):
+    """
+    A commit: its tree, its parents, who made it and why.
+
+    Parsed lazily from raw, the object's bytes; the tree and parents are
+    kept once read, since walks ask for them over and over.
+    """
+
+    __slots__ = ("oid", "raw", "_tree", "_parents")
+
+    def __init__(self, oid, raw):
+        self.oid = oid
+        self.raw = raw
+        self._tree = None
+        self._parents = None
+
+    def header(self, key):
+        """The value of header key (b"encoding", b"gpgsig"...), or None."""
+        return kvlm_header(self.raw, key)
+
+    @property
+    def tree(self):
+        if self._tree is None:
+            self._tree = ObjectId.from_hex(self.header(b"tree").decode())
+        return self._tree
+
+    @property
+    def parents(self):
+        if self._parents is None:
+            parents = []
+            for key, start, end in kvlm_headers(self.raw):
+                if key == b"parent":
+                    parents.append(ObjectId.from_hex(self.raw[start:end].decode()))
+                elif key != b"tree":
+                    break  # Parents come right after the tree
+            self._parents = parents
+        return self._parents
+
+    @property
+    def author(self):
+        """b"Name <email> timestamp tz"."""
+        return self.header(b"author")
+
+    @property
+    def committer(self):
+        return self.header(b"committer")
+
+    @property
+    def date(self):
+        """The committer date, as a timestamp."""
+        return commit_date(self.committer)
+
+    @property
+    def message(self):
+        """The message, as a memoryview into raw."""
+        return kvlm_message(self.raw)
+
+class Tag(object):
+    """An annotated tag, parsed lazily from raw like a Commit."""
+
+    __slots__ = ("oid", "raw", "_object")
+
+    def __init__(self, oid, raw):
+        self.oid = oid
+        self.raw = raw
+        self._object = None
+
+    def header(self, key):
+        return kvlm_header(self.raw, key)
+
+    @property
+    def object(self):
+        """ObjectId of the tagged object."""
+        if self._object is None:
+            self._object = ObjectId.from_hex(self.header(b"object").decode())
+        return self._object
+
+    @property
+    def type(self):
+        """Type of the tagged object, b"commit" usually."""
+        return self.header(b"type")
+
+    @property
+    def tag(self):
+        return self.header(b"tag").decode("utf8")
+
+    @property
+    def tagger(self):
+        return self.header(b"tagger")
+
+    @property
+    def message(self):
+        return kvlm_message(self.raw)
+
+def commit_date(identity):
+    """The timestamp of an author or committer line's "Name <email> ts tz"."""
+    return int(identity.rsplit(b" ", 2)[-2])
+
+def blob_parse(oid, data):
+    return Blob(oid, data)
+
+def tree_parse(oid, data):
+    """Parse a tree object."""
+    entries = []
+    pos = 0
+    end = len(data)
+    while pos < end:
+        space = data.index(b" ", pos)
+        nul = data.index(b"\x00", space)
+        entries.append(TreeEntry(data[pos:space].decode(), data[space + 1:nul].decode("utf8"),
+                                 ObjectId(data[nul + 1:nul + 21])))
+        pos = nul + 21
+    return Tree(oid, entries)
+
+def commit_parse(oid, data):
+    return Commit(oid, data)
+
+def tag_parse(oid, data):
+    return Tag(oid, data)
+
+# Parser of each object type: function(oid, data)
+OBJECT_PARSERS = {b"blob": blob_parse, b"tree": tree_parse,
+                  b"commit": commit_parse, b"tag": tag_parse}
+
+def object_load(repo, sha, fmt=None):
+    """
+    Read and parse the object sha.
+
+    Args:
+        fmt (bytes): The type the object must have, if given.
+
+    Returns:
+        Blob, Tree, Commit or Tag.
+    """
+    obj_fmt, data = object_read(repo, sha)
+    if fmt is not None and obj_fmt != fmt:
+        raise Exception(f"Object {sha} is a {obj_fmt.decode()}, not a {fmt.decode()}")
+    return OBJECT_PARSERS[obj_fmt](sha, data)
+
+# Staging index (.git/index)
+#
+# The index uses git's own binary format, version 2, so real git can
+# read what we write.  Next to the object id it records each file's stat
+# data: as long as that hasn't changed, the file doesn't need re-hashing.
+
+INDEX_SIGNATURE = b"DIRC"
+INDEX_VERSION = 2
+# ctime s/ns, mtime s/ns, dev, ino, mode, uid, gid, size, sha, flags
+INDEX_ENTRY_HEADER = struct.Struct(">10I20sH")
+INDEX_NAME_MASK = 0xFFF
+
+class GitIndexEntry(object):
+    """One staged path: its object id plus the stat data it was hashed from."""
+
+    def __init__(self, name, sha, mode, ctime=(0, 0), mtime=(0, 0),
+                 dev=0, ino=0, uid=0, gid=0, size=0, flags=0):
+        self.name = name    # Path relative to the worktree, "/"-separated
+        self.sha = sha      # ObjectId of the staged blob
+        self.mode = mode    # Normalized git mode (0o100644, 0o120000...)
+        self.ctime = ctime  # (seconds, nanoseconds)
+        self.mtime = mtime  # (seconds, nanoseconds)
+        self.dev = dev
+        self.ino = ino
+        self.uid = uid
+        self.gid = gid
+        self.size = size
+        self.flags = flags  # Flags other than the name length
+        # False for entries read back from disk, whose stat data may be
+        # racily clean; True for ones just built from a stat and a hash.
+        self.verified = False
+
+class GitIndex(object):
+    """The staging area, keyed by path."""
+
+    def __init__(self, entries=None, mtime_ns=None, cache_tree=None):
+        self.version = INDEX_VERSION
+        self.entries = entries if entries is not None else {}
+        # When the index file was last written, for the racy-git check
+        self.mtime_ns = mtime_ns
+        # Root GitCacheTree (the TREE extension), or None
+        self.cache_tree = cache_tree
+        # The FSMN extension: the fsmonitor token the entries were last
+        # checked at, and the names of the ones that didn't match the
+        # worktree then (see Filesystem monitor)
+        self.fsmonitor_token = None
+        self.fsmonitor_dirty = set()
+        # Root UntrackedDir (see Untracked cache), or None; not an
+        # extension, but saved and loaded along with the index
+        self.untracked = None
+
+def index_mode(st_mode):
+    """Normalize an st_mode to one of the modes git stores for files."""
+    if stat.S_ISLNK(st_mode):
+        return 0o120000
+    if st_mode & stat.S_IXUSR:
+        return 0o100755
+    return 0o100644
+
+def index_mode_keep_exec(old, new):
+    """
+    The mode to record for a file of mode new, formerly old (None if it
+    wasn't staged), when core.fileMode says the worktree's executable bits
+    can't be trusted: that of old for a file that was and still is a
+    regular one, else that of a plain file, as in git.
+    """
+    if new == 0o120000:
+        return new
+    if old in (0o100644, 0o100755):
+        return old
+    return 0o100644
+
+def index_entry_from_stat(name, sha, st):
+    """Build an index entry for name from its os.lstat result."""
+    # The on-disk fields are 32 bits wide; truncate now so entries we
+    # build compare equal to the ones we read back.
+    u32 = 0xFFFFFFFF
+    entry = GitIndexEntry(
+        name=name,
+        sha=sha,
+        mode=index_mode(st.st_mode),
+        ctime=(st.st_ctime_ns // 10**9 & u32, st.st_ctime_ns % 10**9),
+        mtime=(st.st_mtime_ns // 10**9 & u32, st.st_mtime_ns % 10**9),
+        dev=st.st_dev & u32,
+        ino=st.st_ino & u32,
+        uid=st.st_uid & u32,
+        gid=st.st_gid & u32,
+        size=st.st_size & u32)
+    entry.verified = True
+    return entry
+
+def index_entry_uptodate(index, entry, st, filemode=True):
+    """
+    True if st still describes the file entry was hashed from.
+
+    A file changed in the same timestamp tick the index was written in
+    can look unchanged to stat ("racy git"); such entries are never
+    trusted and get re-hashed instead.  With filemode false (core.fileMode)
+    the executable bit doesn't count.
+    """
+    fresh = index_entry_from_stat(entry.name, entry.sha, st)
+    if not filemode:
+        fresh.mode = index_mode_keep_exec(entry.mode, fresh.mode)
+    if (entry.mtime, entry.ctime, entry.size, entry.ino, entry.mode) != \
+       (fresh.mtime, fresh.ctime, fresh.size, fresh.ino, fresh.mode):
+        return False
+
+    mtime_ns = entry.mtime[0] * 10**9 + entry.mtime[1]
+    return index.mtime_ns is not None and mtime_ns < index.mtime_ns
+
+def index_path(repo, path):
+    """The index name of path: relative to the worktree, "/"-separated."""
+    rel = os.path.relpath(os.path.abspath(path), os.path.abspath(repo.worktree))
+    if rel == os.pardir or rel.startswith(os.pardir + os.sep):
+        raise Exception(f"{path} is outside repository at {repo.worktree}")
+    return rel.replace(os.sep, "/")
+
+def index_read(repo):
+    """Read .git/index, or return an empty index if there is none yet."""
+    path = repo_path(repo, "index")
+    try:
+        with open(path, "rb") as f:
+            raw = f.read()
+            mtime_ns = os.fstat(f.fileno()).st_mtime_ns
+    except FileNotFoundError:
+        return GitIndex()
+
+    if len(raw) < 32 or new_sha1(raw[:-20]).digest() != raw[-20:]:
+        raise Exception("Index file is corrupt: bad checksum")
+    signature, version, count = struct.unpack_from(">4sII", raw, 0)
+    if signature != INDEX_SIGNATURE:
+        raise Exception("Index file is corrupt: bad signature")
+    if version != INDEX_VERSION:
+        raise Exception(f"Unsupported index version {version}")
+
+    entries = {}
+    idx = 12
+    for i in range(count):
+        (ctime_s, ctime_ns, mtime_s, mtime_ns_, dev, ino, mode, uid, gid,
+         size, sha, flags) = INDEX_ENTRY_HEADER.unpack_from(raw, idx)
+        name_start = idx + INDEX_ENTRY_HEADER.size
+        name_len = flags & INDEX_NAME_MASK
+        if name_len == INDEX_NAME_MASK:
+            name_end = raw.index(b"\x00", name_start)
+        else:
+            name_end = name_start + name_len
+        name = raw[name_start:name_end].decode("utf8")
+        entries[name] = GitIndexEntry(
+            name=name, sha=ObjectId(sha), mode=mode,
+            ctime=(ctime_s, ctime_ns), mtime=(mtime_s, mtime_ns_),
+            dev=dev, ino=ino, uid=uid, gid=gid, size=size,
+            flags=flags & ~INDEX_NAME_MASK)
+        # Entries are NUL-padded to a multiple of 8 bytes, with at least one NUL
+        idx += (name_end - idx + 8) & ~7
+
+    # Extensions starting with an uppercase letter are optional caches
+    # that can be dropped; anything else we can't honour.
+    index = GitIndex(entries, mtime_ns)
+    while idx < len(raw) - 20:
+        signature, size = struct.unpack_from(">4sI", raw, idx)
+        data = raw[idx + 8:idx + 8 + size]
+        if signature == b"TREE":
+            index.cache_tree = cache_tree_parse(data)
+        elif signature == b"FSMN":
+            fsmonitor_ext_parse(index, data)
+        elif not b"A" <= signature[:1] <= b"Z":
+            raise Exception(f"Unsupported index extension {signature!r}")
+        idx += 8 + size
+
+    index.untracked = untracked_cache_read(repo, raw[-20:])
+    return index
+
+def index_write(repo, index):
+    """
+    Write index to .git/index.
+
+    Like git, the new index is written to index.lock, created exclusively
+    so two writers can't interleave, and renamed over the old one.
+    """
+    parts = [struct.pack(">4sII", INDEX_SIGNATURE, index.version,
+                         len(index.entries))]
+    for name in sorted(index.entries):
+        e = index.entries[name]
+        # An entry that was racily clean in the index we read would look
+        # trustworthy once the index gets a newer mtime.  Like git, write
+        # it with a zero size so that it gets hashed again next time.
+        if not e.verified and index.mtime_ns is not None and \
+           e.mtime[0] * 10**9 + e.mtime[1] >= index.mtime_ns:
+            e.size = 0
+        bname = name.encode("utf8")
+        flags = e.flags | min(len(bname), INDEX_NAME_MASK)
+        parts.append(INDEX_ENTRY_HEADER.pack(
+            e.ctime[0], e.ctime[1], e.mtime[0], e.mtime[1], e.dev, e.ino,
+            e.mode, e.uid, e.gid, e.size, e.sha, flags))
+        entry_len = INDEX_ENTRY_HEADER.size + len(bname)
+        parts.append(bname + b"\x00" * (8 - entry_len % 8))
+    if index.cache_tree is not None:
+        data = cache_tree_serialize(index.cache_tree)
+        parts.append(struct.pack(">4sI", b"TREE", len(data)))
+        parts.append(data)
+    if index.fsmonitor_token is not None:
+        data = fsmonitor_ext_serialize(index)
+        parts.append(struct.pack(">4sI", b"FSMN", len(data)))
+        parts.append(data)
+    raw = b"".join(parts)
+
+    path = repo_path(repo, "index")
+    lock_path = path + ".lock"
+    try:
+        fd = os.open(lock_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o666)
+    except FileExistsError:
+        raise Exception(f"Unable to create {lock_path}: "
+                        "is another process writing the index?")
+    try:
+        checksum = new_sha1(raw).digest()
+        with os.fdopen(fd, "wb") as f:
+            f.write(raw)
+            f.write(checksum)
+        untracked_cache_write(repo, index, checksum)
+        os.replace(lock_path, path)
+    except BaseException:
+        os.unlink(lock_path)
+        raise
+
+# Bitmaps over the index entries are stored the way git stores them, as
+# EWAH compressed bitmaps: 64-bit words, where a "run length word" says
+# how many all-zero (or all-one) words are elided before the literal words
+# following it.
+
+EWAH_RUN_MAX = 0xFFFFFFFF
+EWAH_LITERAL_MAX = 0x7FFFFFFF
+
+def ewah_parse(data, pos=0):
+    """Parse an EWAH bitmap at data[pos:]; return (set bit positions, end)."""
+    bit_size, word_count = struct.unpack_from(">II", data, pos)
+    words = struct.unpack_from(f">{word_count}Q", data, pos + 8)
+    end = pos + 8 + 8 * word_count + 4  # The last word is the last RLW's position
+    bits = []
+    offset = 0
+    i = 0
+    while i < word_count:
+        rlw = words[i]
+        run = (rlw >> 1) & EWAH_RUN_MAX
+        literals = rlw >> 33
+        if rlw & 1:
+            bits.extend(range(offset, offset + 64 * run))
+        offset += 64 * run
+        for word in words[i + 1:i + 1 + literals]:
+            while word:
+                low = word & -word
+                bits.append(offset + low.bit_length() - 1)
+                word ^= low
+            offset += 64
+        i += 1 + literals
+    return [b for b in bits if b < bit_size], end
+
+def ewah_serialize(bits, bit_size):
+    """Serialize the set bit positions bits as an EWAH bitmap of bit_size bits."""
+    words = [0] * ((bit_size + 63) // 64)
+    for bit in bits:
+        words[bit >> 6] |= 1 << (bit & 63)
+    # Trailing zero words needn't be stored: bit_size says where it ends
+    while words and not words[-1]:
+        words.pop()
+
+    out = []
+    rlw_pos = 0
+    i = 0
+    while True:
+        run = 0
+        while i < len(words) and not words[i] and run < EWAH_RUN_MAX:
+            run += 1
+            i += 1
+        start = i
+        while i < len(words) and words[i] and i - start < EWAH_LITERAL_MAX:
+            i += 1
+        rlw_pos = len(out)
+        out.append(run << 1 | (i - start) << 33)
+        out.extend(words[start:i])
+        if i >= len(words):
+            break
+    return struct.pack(f">II{len(out)}QI", bit_size, len(out), *out, rlw_pos)
+
+# Tree objects
+#
+# Commits snapshot the index as a hierarchy of tree objects, one per
+# directory.  The index keeps a cache of the trees it last produced (git's
+# cache-tree, stored as the TREE extension): staging a path invalidates
+# only the trees on that path, so the next commit rewrites O(depth) trees
+# and reuses the ids of all the others.
+
+TREE_MODE = "40000"
+
+class GitCacheTree(object):
+    """Cached tree of one directory of the index, and of its subdirectories."""
+
+    def __init__(self, name="", entry_count=-1, sha=None):
+        self.name = name                # Directory name; "" for the root
+        self.entry_count = entry_count  # Index entries covered; -1 if invalid
+        self.sha = sha                  # ObjectId of the tree, when valid
+        self.subtrees = {}              # Name -> GitCacheTree
+
+def cache_tree_parse(data):
+    """Parse a TREE index extension into its root GitCacheTree."""
+    pos = 0
+
+    def node():
+        nonlocal pos
+        nul = data.index(b"\x00", pos)
+        name = data[pos:nul].decode("utf8")
+        newline = data.index(b"\n", nul)
+        entry_count, subtree_count = map(int, data[nul + 1:newline].split(b" "))
+        pos = newline + 1
+        tree = GitCacheTree(name, entry_count)
+        if entry_count >= 0:
+            tree.sha = ObjectId(data[pos:pos + 20])
+            pos += 20
+        for i in range(subtree_count):
+            child = node()
+            tree.subtrees[child.name] = child
+        return tree
+
+    return node()
+
+def cache_tree_serialize(tree):
+    """Serialize a GitCacheTree as a TREE index extension."""
+    out = [tree.name.encode("utf8"), b"\x00",
+           f"{tree.entry_count} {len(tree.subtrees)}\n".encode()]
+    if tree.entry_count >= 0:
+        out.append(tree.sha)
+    for name in sorted(tree.subtrees):
+        out.append(cache_tree_serialize(tree.subtrees[name]))
+    return b"".join(out)
+
+def cache_tree_invalidate(index, name):
+    """Invalidate the cached trees of the directories containing name."""
+    tree = index.cache_tree
+    if tree is None:
+        return
+    tree.entry_count = -1
+    for part in name.split("/")[:-1]:
+        tree = tree.subtrees.get(part)
+        if tree is None:
+            return
+        tree.entry_count = -1
+
+def tree_serialize(items):
+    """Serialize (mode, name, ObjectId) items as a tree object."""
+    items = sorted(items, key=lambda item: tree_sort_key(item[0], item[1]))
+    return b"".join(mode.encode() + b" " + name.encode("utf8") + b"\x00" + sha
+                    for mode, name, sha in items)
+
+def tree_write_index(repo, index):
+    """
+    Write the trees for the index and return the id of the root tree.
+
+    Trees still valid in the index's cache-tree are not looked at again;
+    the others are rebuilt and the cache-tree updated.
+    """
+    if index.cache_tree is None:
+        index.cache_tree = GitCacheTree()
+    names = sorted(index.entries)
+    with trace_region("tree") as span:
+        sha = tree_write_range(repo, index, names, 0, len(names), "",
+                               index.cache_tree, span)
+    return sha
+
+def tree_write_range(repo, index, names, lo, hi, prefix, tree, span):
+    """Write the tree of names[lo:hi], the entries under prefix."""
+    items = []
+    subtrees = {}
+    i = lo
+    while i < hi:
+        rest = names[i][len(prefix):]
+        slash = rest.find("/")
+        if slash < 0:
+            e = index.entries[names[i]]
+            items.append((f"{e.mode:o}", rest, e.sha))
+            i += 1
+            continue
+
+        # All the entries under dirname/ sort before dirname0
+        dirname = rest[:slash]
+        end = bisect.bisect_left(names, prefix + dirname + "0", i, hi)
+        child = tree.subtrees.get(dirname) or GitCacheTree(dirname)
+        if child.entry_count < 0:
+            tree_write_range(repo, index, names, i, end, prefix + dirname + "/", child, span)
+        subtrees[dirname] = child
+        items.append((TREE_MODE, dirname, child.sha))
+        i = end
+
+    tree.subtrees = subtrees
+    tree.sha = object_write(b"tree", tree_serialize(items), repo)
+    tree.entry_count = hi - lo
+    span.add(objects=1)
+    return tree.sha
+
+def tree_sort_key(mode, name):
+    """Where name sorts in a tree: subtrees as if their name ended with a slash."""
+    return name + "/" if mode == TREE_MODE else name
+
+def tree_path_match(path, is_tree, paths):
+    """
+    How path stands against the limits in paths: 2 if it is one of them
+    or under one, 1 if it is a tree one of them is under, else 0.
+    """
+    match = 0
+    for limit in paths:
+        if path == limit or path.startswith(limit + "/"):
+            return 2
+        if is_tree and limit.startswith(path + "/"):
+            match = 1
+    return match
+
+def tree_diff(repo, old, new, prefix="", paths=None, recursive=True):
+    """
+    Yield the files that differ between trees old and new (ObjectIds,
+    None for an empty tree) as (path, old (mode, sha), new (mode, sha)),
+    with None for the side a file is missing from.
+
+    Both trees are sorted the same way, so they are merged in one pass,
+    and subtrees with the same id on both sides are skipped unread.
+
+    Args:
+        paths (list): Only diff these paths and what is under them
+            ("dir" or "dir/file"); subtrees leading to none of them
+            aren't read either.
+        recursive (bool): If false, subtrees that differ are yielded as
+            one entry, with their tree mode, rather than descended into.
+    """
+    if old == new:
+        return
+    a = object_load(repo, old, b"tree").entries if old else []
+    b = object_load(repo, new, b"tree").entries if new else []
+    i = j = 0
+    while i < len(a) or j < len(b):
+        key_a = tree_sort_key(a[i].mode, a[i].name) if i < len(a) else None
+        key_b = tree_sort_key(b[j].mode, b[j].name) if j < len(b) else None
+        if key_b is None or (key_a is not None and key_a < key_b):
+            ea, eb = a[i], None
+            i += 1
+        elif key_a is None or key_b < key_a:
+            ea, eb = None, b[j]
+            j += 1
+        else:
+            ea, eb = a[i], b[j]
+            i += 1
+            j += 1
+            if ea.oid == eb.oid and ea.mode == eb.mode:
+                continue
+        # Equal keys are both subtrees or both not
+        e = ea or eb
+        path = prefix + e.name
+        is_tree = e.mode == TREE_MODE
+        below = paths
+        if paths is not None:
+            match = tree_path_match(path, is_tree, paths)
+            if not match:
+                continue
+            if match == 2:
+                below = None  # All of the subtree is wanted
+        if is_tree and recursive:
+            yield from tree_diff(repo, ea and ea.oid, eb and eb.oid, path + "/", below)
+        else:
+            yield path, ea and (ea.mode, ea.oid), eb and (eb.mode, eb.oid)
+
+# Ignore rules
+#
+# .gitignore files (each applying to its own directory and below),
+# .git/info/exclude and core.excludesFile are read with git's syntax and
+# precedence: a deeper .gitignore beats a shallower one, which beats
+# info/exclude, which beats core.excludesFile; within a file the last
+# matching pattern wins, and "!" re-includes.
+#
+# Each file is compiled once.  Plain names ("node_modules") and "*.ext"
+# patterns, most of any real .gitignore, are dictionary lookups; all the
+# other patterns of a file are merged into one regex, last pattern first,
+# so a path is matched against a file in a couple of operations whatever
+# the number of patterns.
+
+# Characters that make a pattern more than a plain name
+IGNORE_GLOB_CHARS = "*?[\\"
+
+def ignore_regex(pattern):
+    """Translate a gitignore glob into a regex (without capturing groups)."""
+    import re
+    out = []
+    i, n = 0, len(pattern)
+    while i < n:
+        c = pattern[i]
+        if c == "*":
+            if pattern.startswith("**", i) and (i == 0 or pattern[i - 1] == "/"):
+                if i + 2 == n:
+                    out.append(".*")  # Trailing /**: everything inside
+                    i += 2
+                    continue
+                if pattern[i + 2] == "/":
+                    out.append("(?:.*/)?")  # **/: any number of directories
+                    i += 3
+                    continue
+            while i < n and pattern[i] == "*":
+                i += 1
+            out.append("[^/]*")
+            continue
+        if c == "?":
+            out.append("[^/]")
+        elif c == "[":
+            j = i + 1
+            if j < n and pattern[j] in "!^":
+                j += 1
+            if j < n and pattern[j] == "]":
+                j += 1
+            j = pattern.find("]", j)
+            if j < 0:
+                out.append(re.escape(c))
+            else:
+                body = pattern[i + 1:j].replace("\\", "\\\\")
+                if body[:1] in "!^":
+                    body = "^" + body[1:]
+                out.append(f"[{body}]")
+                i = j
+        elif c == "\\" and i + 1 < n:
+            i += 1
+            out.append(re.escape(pattern[i]))
+        else:
+            out.append(re.escape(c))
+        i += 1
+    return "".join(out)
+
+class IgnoreRules(object):
+    """The patterns of one ignore file, compiled."""
+
+    def __init__(self, lines, base=""):
+        import re
+        self.base = base  # Directory the patterns are relative to, "" or "dir/"
+        self.digest = None
+        # Tables 0 apply to files and directories, tables 1 to directories
+        # only (patterns ending with a slash).  Values are (index, negated).
+        self.names = ({}, {})
+        self.suffixes = ({}, {})
+        self.suffix_lengths = set()
+        # Per table and per subject (0: the name, 1: the path below base)
+        # a merged regex and the (index, negated) of each of its groups
+        self.regexes = [[None, None], [None, None]]
+        self.groups = [[None, None], [None, None]]
+        globs = [[[], []], [[], []]]
+
+        for index, line in enumerate(lines):
+            line = line.rstrip("\n")
+            if line.startswith("#"):
+                continue
+            # Trailing spaces don't count unless escaped
+            stripped = line.rstrip(" ")
+            if stripped.endswith("\\") and len(stripped) < len(line):
+                stripped += " "
+            line = stripped
+            negated = line.startswith("!")
+            if negated:
+                line = line[1:]
+            dir_only = int(line.endswith("/"))
+            line = line.rstrip("/")
+            if not line:
+                continue
+            anchored = int("/" in line)
+            line = line.lstrip("/")
+
+            if not anchored and not any(c in line for c in IGNORE_GLOB_CHARS):
+                self.names[dir_only][line] = (index, negated)
+            elif not anchored and line.startswith("*") and len(line) > 1 and \
+                    not any(c in line[1:] for c in IGNORE_GLOB_CHARS):
+                self.suffixes[dir_only][line[1:]] = (index, negated)
+                self.suffix_lengths.add(len(line) - 1)
+            else:
+                globs[dir_only][anchored].append((index, negated, ignore_regex(line)))
+
+        for dir_only in (0, 1):
+            for anchored in (0, 1):
+                patterns = sorted(globs[dir_only][anchored], reverse=True)
+                if patterns:
+                    self.regexes[dir_only][anchored] = re.compile(
+                        "|".join(f"({regex})" for index, negated, regex in patterns),
+                        re.DOTALL)
+                    self.groups[dir_only][anchored] = [None] + [
+                        (index, negated) for index, negated, regex in patterns]
+
+    def match(self, path, name, is_dir):
+        """
+        True if path (whose last component is name) is ignored, False if
+        it's re-included by a negated pattern, None if no pattern matches.
+        """
+        best = None
+        rel = path[len(self.base):]
+        for dir_only in ((0, 1) if is_dir else (0,)):
+            hit = self.names[dir_only].get(name)
+            if hit and (best is None or hit > best):
+                best = hit
+            for length in self.suffix_lengths:
+                hit = self.suffixes[dir_only].get(name[-length:])
+                if hit and (best is None or hit > best):
+                    best = hit
+            for anchored, subject in ((0, name), (1, rel)):
+                regex = self.regexes[dir_only][anchored]
+                if regex is not None:
+                    m = regex.fullmatch(subject)
+                    if m:
+                        hit = self.groups[dir_only][anchored][m.lastindex]
+                        if best is None or hit > best:
+                            best = hit
+        return None if best is None else not best[1]
+
+def ignore_rules_read(path, base=""):
+    """
+    IgnoreRules from the file at path, or None if it doesn't exist.  Their
+    digest attribute is the digest of the file, for the untracked cache.
+    """
+    try:
+        with open(path, "rb") as f:
+            raw = f.read()
+    except (FileNotFoundError, NotADirectoryError, IsADirectoryError):
+        return None
+    text = raw.decode("utf8", "surrogateescape").replace("\r\n", "\n").replace("\r", "\n")
+    rules = IgnoreRules(text.split("\n"), base)
+    rules.digest = new_sha1(raw).digest()
+    return rules
+
+class IgnoreMatcher(object):
+    """All the ignore rules of a worktree, .gitignore files read as needed."""
+
+    def __init__(self, repo):
+        self.repo = repo
+        excludes = repo.conf.get("core", "excludesfile", fallback=None)
+        if excludes is None:
+            config_home = os.environ.get("XDG_CONFIG_HOME") or \
+                os.path.join(os.path.expanduser("~"), ".config")
+            excludes = os.path.join(config_home, "git", "ignore")
+        # Lowest precedence first
+        found = [ignore_rules_read(os.path.expanduser(excludes)),
+                 ignore_rules_read(repo_path(repo, "info", "exclude"))]
+        self.global_rules = [rules for rules in found if rules]
+        # What the rules of every directory start from
+        self.global_digest = new_sha1(b"".join(
+            rules.digest if rules else UNTRACKED_NO_DIGEST for rules in found)).digest()
+        self.dirs = {}  # "" or "dir/" -> IgnoreRules of its .gitignore, or None
+
+    def load(self, base, present=True):
+        """
+        Read the .gitignore of directory base, unless present is False
+        (the caller listed the directory and saw it has none).
+        """
+        if base not in self.dirs:
+            rules = None
+            if present:
+                rules = ignore_rules_read(os.path.join(self.repo.worktree, base, ".gitignore"), base)
+            self.dirs[base] = rules
+        return self.dirs[base]
+
+    def ignored(self, path, is_dir):
+        """
+        Whether path (relative to the worktree, "/"-separated) is ignored.
+
+        Only path's own rules are looked at: callers walking the worktree
+        don't descend into ignored directories in the first place.
+        """
+        name = path.rpartition("/")[2]
+        slash = len(path)
+        while slash > 0:
+            slash = path.rfind("/", 0, slash)
+            base = path[:slash + 1]
+            rules = self.load(base)
+            if rules is not None:
+                result = rules.match(path, name, is_dir)
+                if result is not None:
+                    return result
+        for rules in reversed(self.global_rules):
+            result = rules.match(path, name, is_dir)
+            if result is not None:
+                return result
+        return False
+
+    def excluded(self, path, is_dir):
+        """
+        The directory leading to path that is ignored, or path itself if
+        it is: what a walk of the worktree would never get to.  None if
+        neither path nor any directory above it is ignored.
+        """
+        slash = path.find("/")
+        while slash >= 0:
+            if self.ignored(path[:slash], True):
+                return path[:slash]
+            slash = path.find("/", slash + 1)
+        return path if self.ignored(path, is_dir) else None
+
+# Untracked cache
+#
+# Finding the untracked files means listing every directory of the
+# worktree, whether anything changed or not.  The index keeps, for each
+# directory that isn't ignored, the stat data it had when it was last
+# listed, the digest of the ignore rules that applied to it and what was
+# found in it: its untracked files and its subdirectories.  A file
+# created, removed or renamed in a directory changes its mtime, so as long
+# as the mtime is the same (and older than the index, so that a change in
+# the same timestamp tick isn't missed) and the rules are, the directory
+# costs one lstat instead of a readdir and an ignore check per entry.
+# Ignored directories aren't in the cache at all and cost nothing.
+#
+# Staging or unstaging a path changes what's untracked in its directory
+# without touching the directory, so add invalidates that directory's
+# entry, like it does the cache-tree.
+#
+# The cache isn't an index extension: git prints a warning for every
+# extension it doesn't know, and its own UNTR extension has semantics git
+# would trust blindly.  It lives in .git/untracked-cache instead, written
+# and read along with the index and tagged with the checksum of the index
+# it goes with, so an index written by anything else voids it.
+
+UNTRACKED_FILE = "untracked-cache"
+UNTRACKED_SIGNATURE = b"WUNT"
+# Directory mtime, ctime, inode; its .gitignore's mtime, size, inode
+UNTRACKED_STAT = struct.Struct(">6Q")
+UNTRACKED_COUNTS = struct.Struct(">II")
+UNTRACKED_NO_DIGEST = b"\x00" * 20
+
+class UntrackedDir(object):
+    """What the untracked cache knows about one directory."""
+
+    __slots__ = ("stat", "ignore", "rules", "files", "dirs")
+
+    def __init__(self):
+        self.stat = None     # (mtime ns, ctime ns, inode) when listed; None if invalid
+        self.ignore = None   # ((mtime ns, size, inode), digest) of its .gitignore, if any
+        self.rules = None    # Digest of all the ignore rules that applied to it
+        self.files = []      # Its untracked files that aren't ignored
+        self.dirs = {}       # Name -> UntrackedDir of its subdirectories that aren't ignored
+
+def untracked_cache_parse(data):
+    """Parse a serialized untracked cache into its root UntrackedDir."""
+    pos = 0
+
+    def node():
+        nonlocal pos
+        nul = data.index(b"\x00", pos)
+        name = data[pos:nul].decode("utf8", "surrogateescape")
+        pos = nul + 1
+        fields = UNTRACKED_STAT.unpack_from(data, pos)
+        pos += UNTRACKED_STAT.size
+        rules, digest = data[pos:pos + 20], data[pos + 20:pos + 40]
+        file_count, dir_count = UNTRACKED_COUNTS.unpack_from(data, pos + 40)
+        pos += 40 + UNTRACKED_COUNTS.size
+        d = UntrackedDir()
+        if fields[0]:
+            d.stat = fields[:3]
+            d.rules = rules
+        if fields[3]:
+            d.ignore = (fields[3:], digest)
+        for i in range(file_count):
+            nul = data.index(b"\x00", pos)
+            d.files.append(data[pos:nul].decode("utf8", "surrogateescape"))
+            pos = nul + 1
+        for i in range(dir_count):
+            child_name, child = node()
+            d.dirs[child_name] = child
+        return name, d
+
+    return node()[1]
+
+def untracked_cache_serialize(root):
+    """Serialize root, an UntrackedDir, and the directories under it."""
+    out = []
+
+    def node(name, d):
+        ignore, digest = d.ignore or ((0, 0, 0), UNTRACKED_NO_DIGEST)
+        out.append(name.encode("utf8", "surrogateescape") + b"\x00")
+        out.append(UNTRACKED_STAT.pack(*(d.stat or (0, 0, 0)), *ignore))
+        out.append((d.rules or UNTRACKED_NO_DIGEST) + digest)
+        out.append(UNTRACKED_COUNTS.pack(len(d.files), len(d.dirs)))
+        out.extend(f.encode("utf8", "surrogateescape") + b"\x00" for f in d.files)
+        for child_name in sorted(d.dirs):
+            node(child_name, d.dirs[child_name])
+
+    node("", root)
+    return b"".join(out)
+
+def untracked_cache_read(repo, checksum):
+    """The cache saved with the index whose checksum is given, or None."""
+    try:
+        with open(repo_path(repo, UNTRACKED_FILE), "rb") as f:
+            data = f.read()
+    except FileNotFoundError:
+        return None
+    if data[:4] != UNTRACKED_SIGNATURE or data[4:24] != checksum:
+        return None
+    return untracked_cache_parse(data[24:])
+
+def untracked_cache_write(repo, index, checksum):
+    """Save the cache of index, about to be written with checksum."""
+    path = repo_path(repo, UNTRACKED_FILE)
+    if index.untracked is None:
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            pass
+        return
+    with open(path + ".lock", "wb") as f:
+        f.write(UNTRACKED_SIGNATURE + checksum + untracked_cache_serialize(index.untracked))
+    os.replace(path + ".lock", path)
+
+def untracked_cache_invalidate(index, name):
+    """Invalidate the untracked cache entry of the directory containing name."""
+    d = index.untracked
+    for part in name.split("/")[:-1]:
+        if d is None:
+            return
+        d = d.dirs.get(part)
+    if d is not None:
+        d.stat = None
+
+class UntrackedCache(object):
+    """
+    Lists the worktree's directories through the index's untracked cache.
+
+    With core.untrackedCache false the cache starts empty every time and
+    isn't saved, so every directory gets listed.
+    """
+
+    def __init__(self, repo, index, matcher):
+        self.repo = repo
+        self.matcher = matcher
+        self.index_mtime = index.mtime_ns or 0
+        self.names = None  # Sorted index names, for tracked()
+        self.index = index
+        self.enabled = repo.conf.getboolean("core", "untrackedcache", fallback=True)
+        # Whether the index needs writing: entries were refreshed, or the
+        # extension has to go
+        self.changed = index.untracked is not None and not self.enabled
+        if self.enabled:
+            if index.untracked is None:
+                index.untracked = UntrackedDir()
+            self.root = index.untracked
+        else:
+            index.untracked = None
+            self.root = UntrackedDir()
+        self.rules = matcher.global_digest
+        self.listed = 0
+        self.reused = 0
+
+    def directory(self, prefix, d, parent_rules, tracked=()):
+        """
+        Bring d, the entry of directory prefix ("" or "dir/"), up to date.
+
+        parent_rules is the rules digest of the directory containing it,
+        tracked the names of the tracked files right in it.  Returns the
+        directory's own rules digest, and its listing ({name: DirEntry})
+        if it had to be listed again or None if the entry was still valid.
+        """
+        path = os.path.join(self.repo.worktree, prefix) if prefix else self.repo.worktree
+        try:
+            st = os.lstat(path)
+        except (FileNotFoundError, NotADirectoryError):
+            d.stat, d.files, d.dirs = None, [], {}
+            return parent_rules, {}
+        key = (st.st_mtime_ns, st.st_ctime_ns, st.st_ino)
+
+        if d.stat == key and st.st_mtime_ns < self.index_mtime:
+            digest = None
+            if d.ignore is not None:
+                digest = self.ignore_digest(path, d.ignore)
+            if digest is not False:
+                rules = new_sha1(parent_rules + (digest or b"")).digest()
+                if rules == d.rules:
+                    self.reused += 1
+                    return rules, None
+
+        with os.scandir(path) as it:
+            listing = {e.name: e for e in it}
+        self.listed += 1
+        self.changed = True
+        ignore_rules = self.matcher.load(prefix, ".gitignore" in listing)
+        d.ignore = None
+        digest = b""
+        if ignore_rules is not None:
+            digest = ignore_rules.digest
+            try:
+                gst = os.lstat(os.path.join(path, ".gitignore"))
+                d.ignore = ((gst.st_mtime_ns, gst.st_size, gst.st_ino), digest)
+            except FileNotFoundError:
+                pass
+        rules = new_sha1(parent_rules + digest).digest()
+
+        files = []
+        dirs = {}
+        entries = listing.items()
+        if prefix and ".git" in listing:
+            # A repository created in a directory listed before it was
+            # one: nothing in it is untracked, and it only shows up as
+            # "name/" once its parent is listed again
+            entries = ()
+        for name, e in entries:
+            if e.is_dir(follow_symlinks=False):
+                if name == ".git" or self.matcher.ignored(prefix + name, True):
+                    continue
+                if worktree_is_repository(e.path):
+                    # Nested repositories are one untracked entry, "name/",
+                    # and never looked into, like git does
+                    files.append(name + "/")
+                else:
+                    dirs[name] = d.dirs.get(name) or UntrackedDir()
+            elif name not in tracked and not self.matcher.ignored(prefix + name, False):
+                files.append(name)
+        d.stat, d.rules, d.files, d.dirs = key, rules, sorted(files), dirs
+        return rules, listing
+
+    def ignore_digest(self, path, ignore):
+        """
+        The digest of the .gitignore in path, given the (stat key, digest)
+        it had; False if it's gone.
+        """
+        try:
+            gst = os.lstat(os.path.join(path, ".gitignore"))
+        except (FileNotFoundError, NotADirectoryError):
+            return False
+        if (gst.st_mtime_ns, gst.st_size, gst.st_ino) == ignore[0] and \
+           gst.st_mtime_ns < self.index_mtime:
+            return ignore[1]
+        rules = ignore_rules_read(os.path.join(path, ".gitignore"))
+        return rules.digest if rules is not None else False
+
+    def nonempty(self, prefix, d, parent_rules):
+        """Whether the untracked directory prefix holds a file that isn't ignored."""
+        rules, listing = self.directory(prefix, d, parent_rules)
+        return bool(d.files) or any(self.nonempty(prefix + name + "/", child, rules)
+                                    for name, child in sorted(d.dirs.items()))
+
+    def tracked(self, prefix):
+        """The names of the tracked files right in directory prefix."""
+        if self.names is None:
+            self.names = sorted(self.index.entries)
+        names = self.names
+        files = []
+        i = bisect.bisect_left(names, prefix)
+        while i < len(names) and names[i].startswith(prefix):
+            rest = names[i][len(prefix):]
+            slash = rest.find("/")
+            if slash < 0:
+                files.append(rest)
+                i += 1
+            else:
+                i = bisect.bisect_left(names, prefix + rest[:slash] + "0", i)
+        return files
+
+    def walk(self, top):
+        """
+        Yield the untracked files under directory top ("" or "dir/") that
+        aren't ignored, depth first, and the nested repositories as
+        "dir/".
+        """
+        d, rules, prefix = self.root, self.rules, ""
+        for part in top.split("/")[:-1]:
+            rules, listing = self.directory(prefix, d, rules, self.tracked(prefix))
+            d = d.dirs.get(part)
+            prefix += part + "/"
+            if d is None:
+                d = UntrackedDir()  # Ignored, yet named: list it, without caching it
+        stack = [(prefix, d, rules)]
+        while stack:
+            prefix, d, parent_rules = stack.pop()
+            rules, listing = self.directory(prefix, d, parent_rules, self.tracked(prefix))
+            tracked = set(self.tracked(prefix)) if listing is None else ()
+            for name in d.files:
+                if name not in tracked:
+                    yield prefix + name
+            stack.extend((prefix + name + "/", d.dirs[name], rules)
+                         for name in sorted(d.dirs, reverse=True))
+
+    def trace(self):
+        trace_event("untracked-cache", listed=self.listed, reused=self.reused)
+
+def worker_count(repo, key, jobs=None, fallback=1):
+    """
+    Number of threads a command runs with.
+
+    jobs (from --jobs) wins over the core.<key> setting; either set to 0
+    means one worker per CPU.
+    """
+    if jobs is None:
+        jobs = repo.conf.getint("core", key, fallback=fallback)
+    if jobs < 0:
+        raise Exception(f"Bad number of workers {jobs}")
+    return jobs or os.cpu_count() or 1
+
+def blob_write_path(repo, path, st):
+    """Store the blob for the file (or symlink) at path, returning its id."""
+    if stat.S_ISLNK(st.st_mode):
+        return object_write(b"blob", os.fsencode(os.readlink(path)), repo)
+    return object_write_file(path, b"blob", repo)
+
+def worktree_is_repository(path):
+    """Whether the directory path is the worktree of a repository of its own."""
+    return os.path.lexists(os.path.join(path, ".git"))
+
+def worktree_repository(repo, name):
+    """
+    The nested repository (as "dir/") the index name is in or is, if any.
+    """
+    path = repo.worktree
+    parts = name.split("/")
+    for i, part in enumerate(parts):
+        path = os.path.join(path, part)
+        if worktree_is_repository(path):
+            return "/".join(parts[:i + 1]) + "/"
+    return None
+
+# Add functionality for `add` command to stage files
+def worktree_files(repo, top):
+    """
+    Yield the files under directory top ("" or "dir/"), ignore rules or
+    not, for add -f.  Nested repositories are yielded as "dir/" and not
+    looked into, like git does.
+    """
+    stack = [top]
+    while stack:
+        base = stack.pop()
+        with os.scandir(os.path.join(repo.worktree, base) if base else repo.worktree) as it:
+            entries = sorted(it, key=lambda e: e.name)
+        dirs = []
+        for e in entries:
+            if e.is_dir(follow_symlinks=False):
+                if e.name == ".git":
+                    continue
+                if worktree_is_repository(e.path):
+                    yield base + e.name + "/"
+                else:
+                    dirs.append(base + e.name + "/")
+            else:
+                yield base + e.name
+        stack.extend(reversed(dirs))
+
+def cmd_add(args):
+    """Handle the 'add' command."""
+    logger.info("Staging %d path(s)", len(args.files))
+    repo = GitRepository(os.getcwd())  # Initialize repository object
+    with trace_region("index-read") as span:
+        index = index_read(repo)
+        span.add(objects=len(index.entries))
+    matcher = IgnoreMatcher(repo)
+
+    # Files named on the command line, then the ones found under the
+    # directories named, as (path, index name, lstat result)
+    candidates = []
+    dirs = []
+    ignored = []
+    token = check = None
+    with trace_region("stat") as span:
+        for file in args.files:
+            name = index_path(repo, file)
+            st = os.lstat(file)
+            is_dir = stat.S_ISDIR(st.st_mode)
+            if not (is_dir or stat.S_ISREG(st.st_mode) or stat.S_ISLNK(st.st_mode)):
+                raise Exception(f"{file} is not a regular file")
+            # A path is ignored if it or a directory above it is; files
+            # already tracked stay tracked whatever the rules say
+            excluded = None
+            if not args.force and name != "." and (is_dir or name not in index.entries):
+                excluded = matcher.excluded(name, is_dir)
+            nested = None if name == "." else worktree_repository(repo, name)
+            if excluded is not None:
+                if excluded not in ignored:
+                    ignored.append(excluded)
+            elif nested is not None:
+                logger.warning("Skipping %s: %s is a repository of its own", file, nested)
+            elif is_dir:
+                dirs.append("" if name == "." else name + "/")
+            else:
+                candidates.append((file, name, st))
+        if ignored:
+            raise Exception("The following paths are ignored by one of your .gitignore files "
+                            f"(use -f to add them anyway): {' '.join(ignored)}")
+
+        cache = None
+        if dirs:
+            # Tracked files the fsmonitor saw no change to can be skipped
+            token, check = fsmonitor_check(repo, index)
+            if not args.force:
+                cache = UntrackedCache(repo, index, matcher)
+        tracked = sorted(index.entries) if dirs else []
+        for top in dirs:
+            # New files, found through the untracked cache, or all of
+            # them with -f
+            if cache is not None:
+                found = cache.walk(top)
+            else:
+                found = (name for name in worktree_files(repo, top) if name not in index.entries)
+            for name in found:
+                if name.endswith("/"):
+                    logger.warning("Skipping %s: it is a repository of its own", name)
+                    continue
+                path = os.path.join(repo.worktree, name)
+                try:
+                    st = os.lstat(path)
+                except (FileNotFoundError, NotADirectoryError):
+                    continue
+                if stat.S_ISREG(st.st_mode) or stat.S_ISLNK(st.st_mode):
+                    candidates.append((path, name, st))
+            # Files already tracked stay tracked even where ignore rules
+            # apply; the ones gone from the worktree get unstaged.
+            start = bisect.bisect_left(tracked, top)
+            for name in itertools.takewhile(lambda n: n.startswith(top), tracked[start:]):
+                if check is not None and name not in check:
+                    continue
+                path = os.path.join(repo.worktree, name)
+                try:
+                    st = os.lstat(path)
+                except (FileNotFoundError, NotADirectoryError):
+                    st = None
+                if st is None or not (stat.S_ISREG(st.st_mode) or stat.S_ISLNK(st.st_mode)):
+                    logger.debug("Removed file: %s", name)
+                    del index.entries[name]
+                    cache_tree_invalidate(index, name)
+                    untracked_cache_invalidate(index, name)
+                    continue
+                candidates.append((path, name, st))
+        span.add(objects=len(candidates))
+    if cache is not None:
+        cache.trace()
+
+    add_files(repo, index, candidates, worker_count(repo, "addworkers", args.jobs))
+    # Everything looked at now matches the worktree
+    verified = {name for file, name, st in candidates}
+    if dirs:
+        dirty = ()
+        if token is not None:
+            dirty = ((set(index.entries) if check is None else check) - verified) & index.entries.keys()
+        fsmonitor_done(index, token, dirty)
+    else:
+        index.fsmonitor_dirty -= verified
+
+    with trace_region("index-write") as span:
+        index_write(repo, index)
+        span.add(objects=len(index.entries))
+    logger.info("Files staged successfully.")
+
+def add_files(repo, index, candidates, workers=1):
+    """
+    Stage candidates, a list of (path, index name, lstat result).
+
+    Only files whose stat data moved since they were staged get hashed.
+    hashlib and zlib release the GIL on large buffers, so with more than
+    one worker the hashing runs on threads, which is enough to keep every
+    core busy.  With core.fileMode false, executable bits are left as
+    they were staged.
+    """
+    filemode = repo.conf.getboolean("core", "filemode", fallback=True)
+    todo = []
+    for file, name, st in candidates:
+        entry = index.entries.get(name)
+        if entry and index_entry_uptodate(index, entry, st, filemode):
+            logger.debug("Unchanged file: %s", file)
+            continue
+        todo.append((file, name, st))
+
+    def add_one(item):
+        file, name, st = item
+        return blob_write_path(repo, file, st)
+
+    if workers == 1 or len(todo) < 2:
+        add_results(index, todo, map(add_one, todo), filemode)
+        return
+    import concurrent.futures
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+        add_results(index, todo, pool.map(add_one, todo), filemode)
+
+def add_results(index, todo, shas, filemode):
+    """Stage todo, a list of (path, index name, lstat result), as shas."""
+    # Results come back in argument order whatever the number of workers
+    for (file, name, st), sha1 in zip(todo, shas):
+        logger.debug("Processed file: %s (%s)", file, sha1)
+        entry = index_entry_from_stat(name, sha1, st)
+        old = index.entries.get(name)
+        if not filemode:
+            entry.mode = index_mode_keep_exec(old and old.mode, entry.mode)
+        if old is None or (old.sha, old.mode) != (entry.sha, entry.mode):
+            cache_tree_invalidate(index, name)
+        if old is None:
+            untracked_cache_invalidate(index, name)
+        index.entries[name] = entry
+
+def add_tracked(repo, index):
+    """
+    Stage the changes to every tracked file, and unstage the files gone
+    from the worktree, as `commit -a` does.  Untracked files are left
+    alone, so with the fsmonitor only the entries it reports get a stat.
+    """
+    token, check = fsmonitor_check(repo, index)
+    candidates = []
+    with trace_region("stat") as span:
+        for name in sorted(index.entries if check is None else check):
+            path = os.path.join(repo.worktree, name)
+            try:
+                st = os.lstat(path)
+            except (FileNotFoundError, NotADirectoryError):
+                st = None
+            if st is None or not (stat.S_ISREG(st.st_mode) or stat.S_ISLNK(st.st_mode)):
+                logger.debug("Removed file: %s", name)
+                del index.entries[name]
+                cache_tree_invalidate(index, name)
+                untracked_cache_invalidate(index, name)
+                continue
+            candidates.append((path, name, st))
+        span.add(objects=len(candidates))
+    add_files(repo, index, candidates, worker_count(repo, "addworkers"))
+    fsmonitor_done(index, token, ())
+
+def argsp_add(argsp):
+    argsp.add_argument("-j", "--jobs",
+                       type=int,
+                       default=None,
+                       help="Number of files to hash and store in parallel "
+                            "(0 for one per CPU; default core.addWorkers or 1).")
+    argsp.add_argument("-f", "--force",
+                       action="store_true",
+                       help="Add ignored files too, named or found in the directories named.")
+    argsp.add_argument("files", nargs="+", help="Files or directories to stage.")
+
+COMMANDS["add"] = (cmd_add, "Stage files for the next commit.", argsp_add)
+
+# Status
+#
+# `status` compares HEAD's tree with the index (the staged changes) and
+# the index with the worktree (the unstaged ones and the untracked
+# files).
+#
+# The first comparison skips every directory whose cache-tree entry in
+# the index still has the same id as in HEAD, so it only reads the trees
+# on the paths that were staged.  The second goes through the worktree
+# one directory per task on a thread pool, each task queueing its
+# subdirectories as it finds them; lstat and scandir release the GIL, so
+# the sweep runs in parallel.  Directories are only listed when the
+# untracked cache can't vouch for them.  A file whose stat data matches its index
+# entry is clean; only the others get hashed.  Results are consumed
+# directory by directory in path order, so output starts as soon as the
+# first directories are done.
+
+def status_staged(repo, index, tree):
+    """
+    The differences between tree (HEAD's, None if there's no commit yet)
+    and the index, as a dict of path -> "A", "M" or "D".
+    """
+    names = sorted(index.entries)
+    changes = {}
+    with trace_region("status-staged") as span:
+        status_staged_range(repo, index, names, 0, len(names), "", tree,
+                            index.cache_tree, changes, span)
+    return changes
+
+def status_staged_range(repo, index, names, lo, hi, prefix, tree, cache, changes, span):
+    """Compare the index entries names[lo:hi], under prefix, with tree."""
+    if cache is not None and cache.entry_count >= 0 and cache.sha == tree:
+        return  # Nothing staged under prefix since tree was written
+
+    entries = {}
+    if tree is not None:
+        entries = {e.name: e for e in object_load(repo, tree, b"tree").entries}
+        span.add(objects=1)
+    i = lo
+    while i < hi:
+        rest = names[i][len(prefix):]
+        slash = rest.find("/")
+        if slash < 0:
+            e = index.entries[names[i]]
+            old = entries.pop(rest, None)
+            if old is None or old.mode == TREE_MODE:
+                changes[names[i]] = "A"
+                if old is not None:
+                    for path, a, b in tree_diff(repo, old.oid, None, prefix + rest + "/"):
+                        changes[path] = "D"
+            elif (old.oid, int(old.mode, 8)) != (e.sha, e.mode):
+                changes[names[i]] = "M"
+            i += 1
+            continue
+
+        # All the entries under dirname/ sort before dirname0
+        dirname = rest[:slash]
+        end = bisect.bisect_left(names, prefix + dirname + "0", i, hi)
+        old = entries.pop(dirname, None)
+        if old is not None and old.mode != TREE_MODE:
+            changes[prefix + dirname] = "D"
+            old = None
+        subtree = cache.subtrees.get(dirname) if cache is not None else None
+        status_staged_range(repo, index, names, i, end, prefix + dirname + "/",
+                            old.oid if old is not None else None, subtree, changes, span)
+        i = end
+
+    # What's left is in the tree but not in the index
+    for name, old in entries.items():
+        if old.mode == TREE_MODE:
+            for path, a, b in tree_diff(repo, old.oid, None, prefix + name + "/"):
+                changes[path] = "D"
+        else:
+            changes[prefix + name] = "D"
+
+class StatusSweep(object):
+    """The worktree side of `status`: one task per directory on a pool."""
+
+    def __init__(self, repo, index, pool, untracked="normal", check=None):
+        self.repo = repo
+        self.index = index
+        self.names = sorted(index.entries)
+        self.pool = pool
+        self.untracked = untracked  # "no", "normal" (collapse directories) or "all"
+        self.cache = None
+        if untracked != "no":
+            self.cache = UntrackedCache(repo, index, IgnoreMatcher(repo))
+        self.filemode = repo.conf.getboolean("core", "filemode", fallback=True)
+        # Tracked files to look at, when the fsmonitor says the others
+        # haven't changed; None for all of them
+        self.check = check
+        self.refreshed = []  # Entries found clean by hashing, with fresh stat data
+        self.dirty = []      # Tracked files that don't match the index
+        self.span = None
+
+    def run(self):
+        """
+        Yield (path, code) in path order: "M" or "D" for tracked files
+        that differ from the index, "??" for untracked ones.
+        """
+        with trace_region("status-sweep") as span:
+            self.span = span
+            if self.check is not None and self.untracked == "no":
+                # No directory needs listing: only stat what the fsmonitor reported
+                for name in sorted(self.check):
+                    code = self.entry(name)
+                    if code:
+                        self.dirty.append(name)
+                        yield name, code
+                return
+            if self.cache is None:
+                root = self.pool.submit(self.directory, "", 0, len(self.names), False)
+            else:
+                root = self.pool.submit(self.directory, "", 0, len(self.names), True,
+                                        self.cache.root, self.cache.rules)
+            yield from self.collect(root)
+        if self.cache is not None:
+            self.cache.trace()
+
+    def collect(self, future):
+        for key, path, code in future.result():
+            if isinstance(code, str):
+                if code != "??":
+                    self.dirty.append(path)
+                yield path, code
+            else:
+                yield from self.collect(code)
+
+    def entry(self, name):
+        """The code of the tracked file name: "M", "D" or None if it's clean."""
+        path = os.path.join(self.repo.worktree, name)
+        try:
+            st = os.lstat(path)
+        except (FileNotFoundError, NotADirectoryError):
+            return "D"
+        self.span.add(objects=1)
+        if stat.S_ISDIR(st.st_mode):
+            return "D"
+        return None if self.clean(self.index.entries[name], path, st) else "M"
+
+    def directory(self, prefix, lo, hi, untracked, d=None, rules=None):
+        """
+        Compare directory prefix with the index entries names[lo:hi] under
+        it; d and rules are its untracked cache entry and the rules digest
+        of its parent, when untracked files are wanted.
+
+        Returns a list of (sort key, path, code or future of a
+        subdirectory's own list), sorted.
+        """
+        # The tracked files right in prefix, and its tracked subdirectories
+        names = self.names
+        files = []
+        subdirs = []
+        i = lo
+        while i < hi:
+            rest = names[i][len(prefix):]
+            slash = rest.find("/")
+            if slash < 0:
+                files.append(rest)
+                i += 1
+            else:
+                end = bisect.bisect_left(names, prefix + rest[:slash] + "0", i, hi)
+                subdirs.append((rest[:slash], i, end))
+                i = end
+
+        if untracked:
+            # None if the cache entry was valid
+            rules, listing = self.cache.directory(prefix, d, rules, files)
+        else:
+            listing = {}
+            try:
+                with os.scandir(os.path.join(self.repo.worktree, prefix) if prefix
+                                else self.repo.worktree) as it:
+                    listing = {e.name: e for e in it}
+            except (FileNotFoundError, NotADirectoryError):
+                pass
+
+        items = []
+        for rest in files:
+            name = prefix + rest
+            if self.check is not None and name not in self.check:
+                if listing is None or rest in listing:
+                    continue  # Unchanged, says the fsmonitor
+            if listing is None:
+                code = self.entry(name)
+            else:
+                e = listing.get(rest)
+                if e is None or e.is_dir(follow_symlinks=False):
+                    code = "D"
+                elif self.clean(self.index.entries[name], e.path, e.stat(follow_symlinks=False)):
+                    code = None
+                else:
+                    code = "M"
+            if code:
+                items.append((name, name, code))
+
+        for dirname, i, end in subdirs:
+            path = prefix + dirname
+            if listing is not None:
+                e = listing.get(dirname)
+                if e is None or not e.is_dir(follow_symlinks=False):
+                    items.extend((n, n, "D") for n in names[i:end])
+                    continue
+            # Ignored directories aren't in the cache: only their tracked files matter
+            child = d.dirs.get(dirname) if untracked else None
+            items.append((path + "/", path, self.pool.submit(
+                self.directory, path + "/", i, end, child is not None, child, rules)))
+        self.span.add(objects=len(files) + len(subdirs))
+
+        if untracked:
+            tracked = set(files) if listing is None else ()
+            tracked_dirs = {dirname for dirname, i, end in subdirs}
+            items.extend((prefix + name, prefix + name, "??") for name in d.files
+                         if name not in tracked
+                         and not (name.endswith("/") and name[:-1] in tracked_dirs))
+            for dirname, child in d.dirs.items():
+                if dirname in tracked_dirs:
+                    continue
+                path = prefix + dirname
+                if self.untracked == "all":
+                    items.append((path + "/", path, self.pool.submit(
+                        self.directory, path + "/", lo, lo, True, child, rules)))
+                elif self.cache.nonempty(path + "/", child, rules):
+                    items.append((path + "/", path + "/", "??"))
+        items.sort(key=lambda item: item[0])
+        return items
+
+    def clean(self, entry, path, st):
+        """Whether the file at path (lstat result st) still has the contents staged in entry."""
+        if not (stat.S_ISREG(st.st_mode) or stat.S_ISLNK(st.st_mode)):
+            return False
+        if index_entry_uptodate(self.index, entry, st, self.filemode):
+            return True
+        mode = index_mode(st.st_mode)
+        if not self.filemode:
+            mode = index_mode_keep_exec(entry.mode, mode)
+        if mode != entry.mode:
+            return False
+        if entry.size and st.st_size != entry.size:
+            return False
+        # Same size, new stat data: only the contents can tell
+        if blob_write_path(None, path, st) != entry.sha:
+            return False
+        fresh = index_entry_from_stat(entry.name, entry.sha, st)
+        fresh.mode = mode
+        self.refreshed.append(fresh)
+        return True
+
+def status_lines(staged, changes):
+    """
+    Merge the staged changes (a dict, see status_staged()) with the sorted
+    (path, code) stream of a StatusSweep into (X, Y, path) triples: X for
+    the index against HEAD, Y for the worktree against the index, git's
+    way.  Tracked paths come out in path order as they are found; the
+    untracked ones, usually few, are held back until the end like git
+    does.
+    """
+    pending = sorted(staged)
+    untracked = []
+    i = 0
+    for path, code in changes:
+        if code == "??":
+            untracked.append(path)
+            continue
+        while i < len(pending) and pending[i] < path:
+            yield staged[pending[i]], " ", pending[i]
+            i += 1
+        if i < len(pending) and pending[i] == path:
+            yield staged[path], code, path
+            i += 1
+        else:
+            yield " ", code, path
+    for path in pending[i:]:
+        yield staged[path], " ", path
+    for path in untracked:
+        yield "?", "?", path
+
+# Add functionality for `status` command to show the working tree status
+def cmd_status(args):
+    """Handle the 'status' command."""
+    repo = GitRepository(os.getcwd())  # Initialize repository object
+    with trace_region("index-read") as span:
+        index = index_read(repo)
+        span.add(objects=len(index.entries))
+    token, check = fsmonitor_check(repo, index)
+    head = ref_resolve(repo, "HEAD")
+    staged = status_staged(repo, index, object_load(repo, head, b"commit").tree if head else None)
+
+    workers = worker_count(repo, "statusworkers", args.jobs, fallback=0)
+    import concurrent.futures
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+        sweep = StatusSweep(repo, index, pool, args.untracked_files, check)
+        lines = status_lines(staged, sweep.run())
+        out = sys.stdout
+        if args.porcelain:
+            for x, y, path in lines:
+                out.write(f"{x}{y} {path}\n")
+        else:
+            status_long(repo, head, lines, out)
+
+    # Save the stat data of the files that turned out clean, so the next
+    # status doesn't hash them again, and the new fsmonitor token; skip it
+    # if someone holds the index.
+    changed = bool(sweep.refreshed) or (sweep.cache is not None and sweep.cache.changed)
+    for entry in sweep.refreshed:
+        index.entries[entry.name] = entry
+    dirty = set(sweep.dirty) if token is not None else set()
+    if (token, dirty) != (index.fsmonitor_token, index.fsmonitor_dirty):
+        changed = True
+        fsmonitor_done(index, token, dirty)
+    if changed:
+        try:
+            index_write(repo, index)
+        except Exception as e:
+            logger.debug("Not refreshing the index: %s", e)
+
+# Headings of the long format, and the word for each code
+STATUS_SECTIONS = (("Changes to be committed:", {"A": "new file", "M": "modified", "D": "deleted"}),
+                   ("Changes not staged for commit:", {"M": "modified", "D": "deleted"}),
+                   ("Untracked files:", None))
+
+def status_long(repo, head, lines, out):
+    """Print the status in git's long, human readable format."""
+    branch = ref_symbolic(repo, "HEAD")
+    if branch:
+        out.write(f"On branch {branch.rpartition('/')[2]}\n")
+    else:
+        out.write(f"HEAD detached at {str(head)[:7]}\n")
+    if head is None:
+        out.write("\nNo commits yet\n")
+
+    sections = ([], [], [])
+    for x, y, path in lines:
+        if x == "?":
+            sections[2].append(path)
+            continue
+        if x != " ":
+            sections[0].append((x, path))
+        if y != " ":
+            sections[1].append((y, path))
+
+    for (title, words), paths in zip(STATUS_SECTIONS, sections):
+        if not paths:
+            continue
+        out.write(f"\n{title}\n")
+        for item in paths:
+            if words is None:
+                out.write(f"\t{item}\n")
+            else:
+                code, path = item
+                out.write(f"\t{words[code] + ':':<12}{path}\n")
+    if not any(sections):
+        out.write("\nnothing to commit, working tree clean\n")
+
+def argsp_status(argsp):
+    argsp.add_argument("--porcelain",
+                       action="store_true",
+                       help="Print one 'XY path' line per change, as git's --porcelain does.")
+    argsp.add_argument("-u", "--untracked-files",
+                       nargs="?",
+                       const="all",
+                       default="normal",
+                       choices=["no", "normal", "all"],
+                       help="Show untracked files: no, normal (directories collapsed) or all.")
+    argsp.add_argument("-j", "--jobs",
+                       type=int,
+                       default=None,
+                       help="Number of threads scanning the worktree "
+                            "(default core.statusWorkers, or one per CPU).")
+
+COMMANDS["status"] = (cmd_status, "Show the working tree status.", argsp_status)
+
+# Filesystem monitor
+#
+# Even when no file changed, `status` and `add .` have to lstat every
+# tracked file to find that out.  `fsmonitor start` runs a daemon (Linux
+# only: inotify, through ctypes) that watches every directory of the
+# worktree and keeps a journal of the paths that changed, each tagged with
+# a sequence number.  Commands ask it, over a unix socket in .git, for the
+# paths changed since a token, and store the token it answers with in the
+# index (git's FSMN extension), next to the entries that didn't match the
+# worktree then.  Only those entries and the ones under a reported path
+# get looked at next time.
+#
+# The protocol is one request line per connection:
+#
+#     query <token>\n    ->  <new token>\0<path>\0<path>\0...
+#     status\n           ->  one line describing the daemon
+#     stop\n             ->  "ok\n", then the daemon exits
+#
+# A path ending in "/" is a directory: everything under it may have
+# changed.  The path "/" means anything may have changed, when the token
+# is unknown (another daemon's, or older than the journal) or inotify
+# dropped events.  Before answering a query the daemon creates a cookie
+# file in .git and waits for its own event for it: inotify queues events
+# in order, so that makes sure every change made before the query has
+# been journaled.
+#
+# The daemon runs on threads and can be started in-process, FsMonitor(repo)
+# .start(), as well as from the command line.  It is used when
+# core.fsmonitor is true.
+
+# inotify(7) event bits
+IN_MODIFY = 0x2
+IN_ATTRIB = 0x4
+IN_CLOSE_WRITE = 0x8
+IN_MOVED_FROM = 0x40
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+IN_DELETE_SELF = 0x400
+IN_Q_OVERFLOW = 0x4000
+IN_IGNORED = 0x8000
+IN_ONLYDIR = 0x1000000
+IN_ISDIR = 0x40000000
+IN_CLOEXEC = 0o2000000
+# wd, mask, cookie, name length
+INOTIFY_EVENT = struct.Struct("iIII")
+
+FSMONITOR_EVENTS = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM |
+                    IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF)
+FSMONITOR_SOCKET = "fsmonitor--daemon.ipc"
+FSMONITOR_COOKIE = "fsmonitor--cookie-"
+# Version of the FSMN extension whose token is a string, as git writes it
+FSMONITOR_EXT_VERSION = 2
+# Journal entries kept; older tokens get a "/" answer
+FSMONITOR_JOURNAL_MAX = 1 << 20
+# Seconds a query waits for its cookie, and `start` for the daemon
+FSMONITOR_TIMEOUT = 5
+
+def fsmonitor_ext_parse(index, data):
+    """Read an FSMN index extension into index."""
+    version, = struct.unpack_from(">I", data, 0)
+    if version != FSMONITOR_EXT_VERSION:
+        return  # A version 1 timestamp is of no use to us; start afresh
+    nul = data.index(b"\x00", 4)
+    index.fsmonitor_token = data[4:nul].decode()
+    bits, end = ewah_parse(data, nul + 5)  # Skip the bitmap's own size
+    names = sorted(index.entries)
+    index.fsmonitor_dirty = {names[bit] for bit in bits if bit < len(names)}
+
+def fsmonitor_ext_serialize(index):
+    """Serialize the FSMN index extension of index."""
+    names = sorted(index.entries)
+    dirty = index.fsmonitor_dirty
+    bitmap = ewah_serialize([i for i, name in enumerate(names) if name in dirty] if dirty else [],
+                            len(names))
+    return b"".join([struct.pack(">I", FSMONITOR_EXT_VERSION),
+                     index.fsmonitor_token.encode(), b"\x00",
+                     struct.pack(">I", len(bitmap)), bitmap])
+
+def fsmonitor_request(repo, request):
+    """
+    Send request to the daemon and return its answer, or None if it isn't
+    running or went away without answering (it may be shutting down).
+    """
+    import socket
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.settimeout(FSMONITOR_TIMEOUT * 2)
+        chunks = []
+        try:
+            sock.connect(repo_path(repo, FSMONITOR_SOCKET))
+            sock.sendall(request.encode() + b"\n")
+            sock.shutdown(socket.SHUT_WR)
+            while True:
+                chunk = sock.recv(1 << 16)
+                if not chunk:
+                    break
+                chunks.append(chunk)
+        except OSError:
+            return None
+        return b"".join(chunks) or None
+
+def fsmonitor_check(repo, index):
+    """
+    Ask the daemon which index entries may no longer match the worktree.
+
+    Returns (token, names): the token to store in the index once they have
+    been looked at, and the set of names to look at, None meaning all of
+    them.  The token is None when core.fsmonitor is off or the daemon
+    isn't running.
+    """
+    if not repo.conf.getboolean("core", "fsmonitor", fallback=False):
+        return None, None
+    with trace_region("fsmonitor") as span:
+        answer = fsmonitor_request(repo, f"query {index.fsmonitor_token or ''}")
+        fields = answer.decode("utf8", "surrogateescape").split("\x00") if answer else []
+        if len(fields) < 2 or fields[-1]:
+            # Not running, or cut short: look at everything
+            logger.warning("core.fsmonitor is set but the fsmonitor daemon isn't answering")
+            return None, None
+        token, *paths = fields[:-1]
+        span.add(objects=len(paths))
+    if "/" in paths:
+        return token, None
+
+    names = set(index.fsmonitor_dirty) & index.entries.keys()
+    dirs = []
+    for path in paths:
+        if path.endswith("/"):
+            dirs.append(path)
+        elif path in index.entries:
+            names.add(path)
+    if dirs:
+        # A directory created, removed or renamed: everything under it
+        dirs = tuple(dirs)
+        names.update(name for name in index.entries if name.startswith(dirs))
+    return token, names
+
+def fsmonitor_done(index, token, dirty):
+    """
+    Record in index that its entries were checked against the worktree as
+    of token, and that the ones in dirty didn't match.
+    """
+    index.fsmonitor_token = token
+    index.fsmonitor_dirty = set(dirty) if token is not None else set()
+
+class Inotify(object):
+    """An inotify instance, with the worktree-relative directory of each watch."""
+
+    def __init__(self):
+        import ctypes
+        import ctypes.util
+        self.libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        self.libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+        self.fd = self.libc.inotify_init1(IN_CLOEXEC)
+        if self.fd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, f"inotify_init1: {os.strerror(errno)}")
+        self.dirs = {}  # Watch descriptor -> directory ("" or "dir/")
+
+    def watch(self, path, rel):
+        """Watch the directory at path, known as rel; False if it's gone."""
+        import ctypes
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), FSMONITOR_EVENTS | IN_ONLYDIR)
+        if wd < 0:
+            errno = ctypes.get_errno()
+            if errno in (2, 20):  # ENOENT, ENOTDIR: removed since we listed it
+                return False
+            hint = " (raise fs.inotify.max_user_watches)" if errno == 28 else ""
+            raise OSError(errno, f"Can't watch {path}: {os.strerror(errno)}{hint}")
+        self.dirs[wd] = rel
+        return True
+
+    def unwatch(self, prefix):
+        """Stop watching the directories under prefix ("dir/")."""
+        for wd, rel in list(self.dirs.items()):
+            if rel.startswith(prefix):
+                self.libc.inotify_rm_watch(self.fd, wd)
+                del self.dirs[wd]
+
+    def read(self):
+        """Read the pending events as (watch descriptor, mask, name)."""
+        data = os.read(self.fd, 1 << 16)
+        pos = 0
+        while pos < len(data):
+            wd, mask, cookie, length = INOTIFY_EVENT.unpack_from(data, pos)
+            pos += INOTIFY_EVENT.size
+            name = data[pos:pos + length].rstrip(b"\x00")
+            pos += length
+            yield wd, mask, name.decode("utf8", "surrogateescape")
+
+    def close(self):
+        os.close(self.fd)
+
+class FsMonitor(object):
+    """The fsmonitor daemon of one worktree."""
+
+    def __init__(self, repo):
+        self.repo = repo
+        # Tokens of another daemon, or of this one before an overflow,
+        # mean nothing: the instance is part of every token.
+        self.instance = f"{os.getpid()}.{time.time_ns()}"
+        self.seq = 0
+        self.oldest = 0       # Tokens older than this are past the journal
+        self.journal = []     # (seq, path), in seq order
+        self.lock = threading.Lock()
+        self.cookies = {}     # Cookie file name -> threading.Event
+        self.cookie_count = itertools.count()
+        self.inotify = None
+        self.gitdir_wd = None
+        self.server = None
+        self.threads = []
+        self.wakeup = None    # Pipe telling the watcher thread to exit
+        self.stopped = threading.Event()
+
+    def start(self):
+        """Watch the worktree and serve queries, on background threads."""
+        import socketserver
+
+        path = repo_path(self.repo, FSMONITOR_SOCKET)
+        if fsmonitor_request(self.repo, "status") is not None:
+            raise Exception(f"An fsmonitor daemon is already running on {self.repo.worktree}")
+        if os.path.exists(path):
+            os.unlink(path)  # Left behind by a daemon that died
+
+        self.inotify = Inotify()
+        self.gitdir_wd = self.inotify.libc.inotify_add_watch(
+            self.inotify.fd, os.fsencode(self.repo.gitdir), IN_CREATE)
+        with trace_region("fsmonitor-watch") as span:
+            span.add(objects=self.watch_tree(""))
+        self.wakeup = os.pipe()
+
+        monitor = self
+
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self):
+                request = self.rfile.readline().decode("utf8", "surrogateescape").rstrip("\n")
+                self.wfile.write(monitor.answer(request))
+
+        self.server = socketserver.ThreadingUnixStreamServer(path, Handler)
+        # stop() waits for the requests being answered
+        self.server.daemon_threads = False
+        self.server.block_on_close = True
+        for target in (self.watch_loop, self.server.serve_forever):
+            thread = threading.Thread(target=target, daemon=True)
+            thread.start()
+            self.threads.append(thread)
+        logger.info("fsmonitor watching %d directories of %s", len(self.inotify.dirs),
+                    self.repo.worktree)
+
+    def run(self):
+        """Run the daemon until it's asked to stop."""
+        self.start()
+        try:
+            self.stopped.wait()
+        finally:
+            self.stop()
+
+    def stop(self):
+        """
+        Stop serving and watching; safe to call more than once.  The
+        socket is removed last, once the requests being answered are and
+        the threads are done: `fsmonitor stop` waits for that.
+        """
+        if self.server is not None:
+            server, self.server = self.server, None
+            server.shutdown()
+            server.server_close()
+        if self.wakeup is not None:
+            os.write(self.wakeup[1], b"x")
+            for thread in self.threads:
+                thread.join()
+            self.inotify.close()
+            for fd in self.wakeup:
+                os.close(fd)
+            self.wakeup = None
+            try:
+                os.unlink(repo_path(self.repo, FSMONITOR_SOCKET))
+            except FileNotFoundError:
+                pass
+        self.stopped.set()
+
+    def watch_tree(self, rel):
+        """Watch the directory rel ("" or "dir/") and the ones below it."""
+        count = 0
+        stack = [rel]
+        while stack:
+            rel = stack.pop()
+            path = os.path.join(self.repo.worktree, rel)
+            if not self.inotify.watch(path, rel):
+                continue
+            count += 1
+            try:
+                with os.scandir(path) as it:
+                    stack.extend(rel + e.name + "/" for e in it
+                                 if e.name != ".git" and e.is_dir(follow_symlinks=False))
+            except (FileNotFoundError, NotADirectoryError):
+                pass
+        return count
+
+    def watch_loop(self):
+        import select
+        while True:
+            ready, _, _ = select.select([self.inotify.fd, self.wakeup[0]], [], [])
+            if self.wakeup[0] in ready:
+                return
+            with self.lock:
+                self.seq += 1
+                for wd, mask, name in self.inotify.read():
+                    self.event(wd, mask, name)
+                if len(self.journal) > FSMONITOR_JOURNAL_MAX:
+                    cut = len(self.journal) // 2
+                    self.oldest = self.journal[cut][0]
+                    # (seq,) sorts before every (seq, path)
+                    start = bisect.bisect_left(self.journal, (self.oldest,))
+                    del self.journal[:start]
+
+    def event(self, wd, mask, name):
+        """Journal one inotify event; called with the lock held."""
+        if mask & IN_Q_OVERFLOW:
+            # Events were lost: nothing we journaled can be trusted
+            logger.warning("fsmonitor: inotify queue overflow, resetting")
+            self.instance = f"{os.getpid()}.{time.time_ns()}"
+            self.journal.clear()
+            self.inotify.unwatch("")
+            self.watch_tree("")
+            return
+        if wd == self.gitdir_wd:
+            cookie = self.cookies.pop(name, None)
+            if cookie is not None:
+                cookie.set()
+            return
+        if mask & IN_IGNORED:
+            self.inotify.dirs.pop(wd, None)
+            return
+        base = self.inotify.dirs.get(wd)
+        if base is None or (not base and name == ".git"):
+            return
+        path = base + name
+        if mask & IN_ISDIR:
+            path += "/"
+            if mask & (IN_CREATE | IN_MOVED_TO):
+                self.watch_tree(path)
+            elif mask & IN_MOVED_FROM:
+                self.inotify.unwatch(path)
+        self.journal.append((self.seq, path))
+
+    def sync(self):
+        """Wait until every change made before now has been journaled."""
+        name = f"{FSMONITOR_COOKIE}{os.getpid()}-{next(self.cookie_count)}"
+        cookie = threading.Event()
+        with self.lock:
+            self.cookies[name] = cookie
+        path = os.path.join(self.repo.gitdir, name)
+        os.close(os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600))
+        try:
+            if not cookie.wait(FSMONITOR_TIMEOUT):
+                logger.warning("fsmonitor: timed out waiting for cookie %s", name)
+        finally:
+            os.unlink(path)
+            with self.lock:
+                self.cookies.pop(name, None)
+
+    def query(self, token):
+        """Return (new token, changed paths since token, or None for all)."""
+        self.sync()
+        with self.lock:
+            prefix = f"wyag:{self.instance}:"
+            new = f"{prefix}{self.seq}"
+            if not token.startswith(prefix) or not token[len(prefix):].isdigit():
+                return new, None
+            seq = int(token[len(prefix):])
+            if seq < self.oldest or seq > self.seq:
+                return new, None
+            start = bisect.bisect_left(self.journal, (seq + 1,))
+            return new, {path for s, path in self.journal[start:]}
+
+    def answer(self, request):
+        """The answer to one request line, as bytes."""
+        command, _, arg = request.partition(" ")
+        if command == "query":
+            token, paths = self.query(arg)
+            paths = ["/"] if paths is None else sorted(paths)
+            return "".join(p + "\x00" for p in [token] + paths).encode("utf8", "surrogateescape")
+        if command == "status":
+            with self.lock:
+                return (f"pid {os.getpid()} watching {len(self.inotify.dirs)} directories, "
+                        f"{len(self.journal)} journaled changes\n").encode()
+        if command == "stop":
+            self.stopped.set()
+            return b"ok\n"
+        return f"error unknown request {command!r}\n".encode()
+
+# Add functionality for `fsmonitor` command to run the filesystem monitor daemon
+def cmd_fsmonitor(args):
+    """Handle the 'fsmonitor' command."""
+    repo = GitRepository(os.getcwd())  # Initialize repository object
+    if args.action == "run":
+        FsMonitor(repo).run()
+    elif args.action == "start":
+        if fsmonitor_request(repo, "status") is not None:
+            raise Exception("The fsmonitor daemon is already running")
+        import subprocess
+        subprocess.Popen([sys.executable, os.path.abspath(__file__), "fsmonitor", "run"],
+                         cwd=repo.worktree, start_new_session=True, stdin=subprocess.DEVNULL,
+                         stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        deadline = time.monotonic() + FSMONITOR_TIMEOUT
+        while fsmonitor_request(repo, "status") is None:
+            if time.monotonic() > deadline:
+                raise Exception("The fsmonitor daemon didn't start")
+            time.sleep(0.05)
+        if not repo.conf.getboolean("core", "fsmonitor", fallback=False):
+            print("fsmonitor started; set core.fsmonitor to true for commands to use it")
+    elif args.action == "stop":
+        if fsmonitor_request(repo, "stop") is None:
+            raise Exception("The fsmonitor daemon isn't running")
+        # Requests in flight get their answer first, for up to a query's timeout
+        deadline = time.monotonic() + FSMONITOR_TIMEOUT * 2
+        while os.path.exists(repo_path(repo, FSMONITOR_SOCKET)):
+            if time.monotonic() > deadline:
+                raise Exception("The fsmonitor daemon didn't stop")
+            time.sleep(0.05)
+    else:
+        answer = fsmonitor_request(repo, "status")
+        print(answer.decode().rstrip("\n") if answer is not None else "not running")
+
+def argsp_fsmonitor(argsp):
+    argsp.add_argument("action",
+                       choices=["start", "stop", "status", "run"],
+                       help="Start the daemon in the background, stop it, show whether it "
+                            "runs, or run it in the foreground.")
+
+COMMANDS["fsmonitor"] = (cmd_fsmonitor, "Run a daemon watching the worktree for changes.",
+                         argsp_fsmonitor)
+
+# References
+#
+# Refs are read from their loose file under .git/ or, failing that, from
+# .git/packed-refs, and symbolic refs ("ref: refs/heads/master") are
+# followed.  What a ref resolves to is remembered on the repository for
+# the rest of the process; ref_update() is the only writer and keeps that
+# memo up to date, so e.g. HEAD is read from disk once per command.
+
+# How many symbolic refs may be chained, as in git
+REF_MAX_DEPTH = 5
+
+def ref_packed(repo):
+    """.git/packed-refs as a dict of refname -> ObjectId, read once."""
+    if repo.packed_refs is None:
+        refs = {}
+        try:
+            with open(repo_path(repo, "packed-refs")) as f:
+                for line in f:
+                    # Skip the header comment and peeled "^sha" tag lines
+                    if line.startswith(("#", "^")):
+                        continue
+                    sha, name = line.split()
+                    refs[name] = ObjectId.from_hex(sha)
+        except FileNotFoundError:
+            pass
+        repo.packed_refs = refs
+    return repo.packed_refs
+
+def ref_read(repo, ref):
+    """The value of ref, "ref: <target>" or an ObjectId, or None."""
+    try:
+        with open(repo_path(repo, ref)) as f:
+            value = f.read().strip()
+    except (FileNotFoundError, IsADirectoryError):
+        return ref_packed(repo).get(ref)
+    return value if value.startswith("ref: ") else ObjectId.from_hex(value)
+
+def ref_symbolic(repo, ref):
+    """The ref that symbolic ref points to (e.g. HEAD), or None if it's detached."""
+    value = ref_read(repo, ref)
+    if isinstance(value, str):
+        return value[5:]
+    return None
+
+def ref_resolve(repo, ref, depth=0):
+    """
+    Resolve ref to the id it points to, following symbolic refs.
+
+    Returns:
+        ObjectId: The object id, or None for a ref that doesn't exist yet
+        (such as HEAD on a branch with no commits).
+    """
+    if ref in repo.refs:
+        return repo.refs[ref]
+    if depth > REF_MAX_DEPTH:
+        raise Exception(f"Too many levels of symbolic refs at {ref}")
+
+    value = ref_read(repo, ref)
+    if isinstance(value, str):
+        sha = ref_resolve(repo, value[5:], depth + 1)
+    else:
+        sha = value
+    repo.refs[ref] = sha
+    return sha
+
+def ref_update(repo, ref, sha, old_sha=None):
+    """
+    Point ref at sha.
+
+    Like git, the new value is written to <ref>.lock, created exclusively
+    so two writers can't interleave, and renamed into place.  The ref must
+    still point at old_sha (None for a new ref) once the lock is held,
+    otherwise someone else moved it and the update is refused.
+    """
+    path = repo_file(repo, *ref.split("/"), mkdir=True)
+    lock_path = path + ".lock"
+    try:
+        fd = os.open(lock_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o666)
+    except FileExistsError:
+        raise Exception(f"Unable to create {lock_path}: is another process updating {ref}?")
+    try:
+        with os.fdopen(fd, "w") as f:
+            # Re-read under the lock, bypassing the memo
+            repo.refs.clear()
+            repo.packed_refs = None
+            current = ref_resolve(repo, ref)
+            if current != old_sha:
+                raise Exception(f"{ref} moved to {current} while expecting {old_sha}")
+            f.write(f"{sha}\n")
+        os.replace(lock_path, path)
+    except BaseException:
+        os.unlink(lock_path)
+        raise
+
+    # Symbolic refs pointing at ref (HEAD...) have to be resolved again
+    repo.refs.clear()
+    repo.refs[ref] = sha
+
+def ref_list(repo, prefix="refs"):
+    """All refs under prefix, loose or packed, as a dict of name -> ObjectId."""
+    refs = {name: sha for name, sha in ref_packed(repo).items()
+            if name.startswith(prefix + "/")}
+    top = repo_path(repo, prefix)
+    for root, dirs, files in os.walk(top):
+        for name in files:
+            if name.endswith(".lock"):
+                continue
+            ref = os.path.relpath(os.path.join(root, name), repo.gitdir).replace(os.sep, "/")
+            sha = ref_resolve(repo, ref)
+            if sha:
+                refs[ref] = sha
+    return refs
+
+def object_find(repo, name):
+    """
+    The ObjectId name refers to: a full hex object id, HEAD, or a ref
+    name looked up as git does (refs/<name>, refs/tags/<name>, refs/heads/<name>).
+    """
+    name = name.strip()
+    if len(name) == 40 and all(c in "0123456789abcdef" for c in name.lower()):
+        return ObjectId.from_hex(name)
+    for ref in (name, f"refs/{name}", f"refs/tags/{name}", f"refs/heads/{name}"):
+        sha = ref_resolve(repo, ref)
+        if sha:
+            return sha
+    raise Exception(f"No such reference {name}")
+
+# Commit metadata
+
+def commit_identity(repo, role):
+    """
+    The "Name <email> timestamp tz" of the author or committer.
+
+    Taken from GIT_<ROLE>_NAME/EMAIL/DATE in the environment, then
+    user.name/user.email in .git/config, then the login name.
+    """
+    name = os.environ.get(f"GIT_{role}_NAME") or \
+        repo.conf.get("user", "name", fallback=None)
+    email = os.environ.get(f"GIT_{role}_EMAIL") or \
+        repo.conf.get("user", "email", fallback=None)
+    if not name or not email:
+        import getpass
+        import socket
+        login = getpass.getuser()
+        name = name or login
+        email = email or f"{login}@{socket.gethostname()}"
+
+    date = os.environ.get(f"GIT_{role}_DATE")
+    if not date:
+        now = time.time()
+        offset = time.localtime(now).tm_gmtoff // 60
+        sign = "-" if offset < 0 else "+"
+        date = f"{int(now)} {sign}{abs(offset) // 60:02d}{abs(offset) % 60:02d}"
+    return f"{name} <{email}> {date}"
+
+# Add functionality for `commit` command to create a snapshot
+def cmd_commit(args):
+    """Handle the 'commit' command."""
+    logger.debug("Creating commit with message: %s", args.message)
+    repo = GitRepository(os.getcwd())  # Initialize repository object
+    index = index_read(repo)
+    if args.all:
+        add_tracked(repo, index)
+    tree_hash = tree_write_index(repo, index)
+    # Keep the refreshed cache-tree for the next commit
+    index_write(repo, index)
+
+    # Commit on top of whatever HEAD points to, and move it forward
+    branch = ref_symbolic(repo, "HEAD")
+    parent_hash = ref_resolve(repo, "HEAD")
+    commit_data = f"tree {tree_hash}\n"
+    if parent_hash:
+        commit_data += f"parent {parent_hash}\n"
+    commit_data += f"author {commit_identity(repo, 'AUTHOR')}\n"
+    commit_data += f"committer {commit_identity(repo, 'COMMITTER')}\n"
+    message = args.message if args.message.endswith("\n") else args.message + "\n"
+    commit_data += f"\n{message}"
+    sha1 = object_write(b"commit", commit_data.encode(), repo)
+    ref_update(repo, branch or "HEAD", sha1, parent_hash)
+    logger.info("Commit created successfully: %s", sha1)
+
+def argsp_commit(argsp):
+    argsp.add_argument("-a", "--all",
+                       action="store_true",
+                       help="Stage the changes to every tracked file first.")
+    argsp.add_argument("message", help="Commit message.")
+
+COMMANDS["commit"] = (cmd_commit, "Create a new commit.", argsp_commit)
+
+# Add functionality for `log` command to display commit history
+def cmd_log(args):
+    """Handle the 'log' command."""
+    logger.debug("Displaying commit history")
+    repo = GitRepository(os.getcwd())  # Initialize repository object
+    if args.revisions:
+        tips = [commit_peel(repo, object_find(repo, name)) for name in args.revisions]
+    else:
+        tips = [ref_resolve(repo, "HEAD")]
+        if tips[0] is None:
+            raise Exception(f"Your current branch {ref_symbolic(repo, 'HEAD')} "
+                            "does not have any commits yet")
+    since = date_parse(args.since) if args.since else None
+    until = date_parse(args.until) if args.until else None
+
+    paths = [index_path(repo, path) for path in args.paths]
+    if "." in paths:
+        paths = []  # The whole tree
+
+    # Commits come out of the walk one at a time, so the walk goes no
+    # further than the last commit printed
+    bloom = collections.Counter()
+    commits = rev_walk(repo, tips, since, until, paths, bloom)
+    # As in git, a negative count means no limit
+    if args.max_count is not None and args.max_count >= 0:
+        commits = itertools.islice(commits, args.max_count)
+    out = sys.stdout.buffer
+    width = diff_stat_width() if args.stat else None
+    for sha in commits:
+        fmt, data = object_read(repo, sha)
+        out.write(f"commit {sha}\n".encode())
+        out.write(data)
+        if args.stat:
+            # What the commit changed from its parent; nothing for merges, as in git
+            tree, parents, date, generation = commit_info(repo, sha)
+            if len(parents) <= 1:
+                old = commit_info(repo, parents[0])[0] if parents else None
+                changes = tree_diff(repo, old, tree, paths=paths or None)
+                lines = diff_stat_lines(diff_stat(repo, changes), width)
+                if lines:
+                    out.write(b"\n" + "".join(line + "\n" for line in lines).encode())
+        out.write(b"\n")
+    if paths:
+        logger.debug("Changed-path filters: %s", dict(bloom))
+        trace_event("bloom", **bloom)
+    logger.debug("Object cache: %s", repo.cache.stats())
+    trace_event("cache", **repo.cache.stats())
+
+def argsp_log(argsp):
+    argsp.add_argument("-n", "--max-count",
+                       type=int,
+                       default=None,
+                       help="Show at most this many commits (no limit if negative).")
+    argsp.add_argument("--since", "--after",
+                       default=None,
+                       help="Show commits more recent than this date.")
+    argsp.add_argument("--until", "--before",
+                       default=None,
+                       help="Show commits older than this date.")
+    argsp.add_argument("--stat",
+                       action="store_true",
+                       help="Show the lines each commit added and removed per file.")
+    argsp.add_argument("revisions",
+                       nargs="*",
+                       help="Commits to start from (default HEAD); "
+                            "paths after -- limit the log to the commits changing them.")
+    argsp.set_defaults(paths=[])
+
+COMMANDS["log"] = (cmd_log, "Display commit history.", argsp_log)
+
+# Packfiles
+#
+# `repack` moves loose objects into a single objects/pack/pack-<sha>.pack
+# with a matching version 2 .idx, in the same formats git uses.  Similar
+# objects are stored as deltas against each other (OFS_DELTA), chosen
+# with git's heuristic: sort by type, name hash and size, then try each
+# object against a sliding window of the ones just before it.
+#
+# With -a, the objects of the existing packs go into the new pack too,
+# and -d then deletes those packs: `gc` does both, so however often it
+# runs, the repository is left with a single pack to search.
+
+PACK_SIGNATURE = b"PACK"
+PACK_VERSION = 2
+PACK_IDX_SIGNATURE = b"\xfftOc"
+PACK_IDX_VERSION = 2
+
+PACK_TYPES = {b"commit": 1, b"tree": 2, b"blob": 3, b"tag": 4}
+PACK_OFS_DELTA = 6
+PACK_REF_DELTA = 7
+
+# Defaults for pack.window, pack.depth and core.bigFileThreshold.  The
+# delta matcher is pure Python, so objects past the threshold are stored
+# whole, well before git's own 512 MiB default would kick in.
+DEFAULT_PACK_WINDOW = 10
+DEFAULT_PACK_DEPTH = 50
+DEFAULT_BIG_FILE_THRESHOLD = 4 * 1024 * 1024
+
+# Deltas match the target against the base in blocks of this many bytes
+DELTA_BLOCK = 16
+# Largest copy a single delta instruction encodes (git's own limit)
+DELTA_MAX_COPY = 0x10000
+
+def object_loose_list(repo):
+    """Yield the ids of all loose objects in the store."""
+    objects_dir = repo_path(repo, "objects")
+    with os.scandir(objects_dir) as fanout:
+        for d in fanout:
+            if len(d.name) != 2 or not d.is_dir():
+                continue
+            with os.scandir(d.path) as entries:
+                for e in entries:
+                    if len(e.name) == 38 and not e.name.startswith("tmp_"):
+                        yield ObjectId.from_hex(d.name + e.name)
+
+def pack_name_hash(name):
+    """git's name hash: sorts paths so that same-suffix files are adjacent."""
+    h = 0
+    for c in name.encode("utf8"):
+        if c not in b" \t\n\r\f\v":
+            h = ((h >> 2) + (c << 24)) & 0xFFFFFFFF
+    return h
+
+def delta_varint(n):
+    """Little-endian base-128 size, as used in delta headers."""
+    out = bytearray()
+    while True:
+        byte = n & 0x7F
+        n >>= 7
+        if n:
+            out.append(byte | 0x80)
+        else:
+            out.append(byte)
+            return bytes(out)
+
+def delta_index(base):
+    """Map each aligned DELTA_BLOCK-byte block of base to its first offset."""
+    index = {}
+    for i in range(len(base) - DELTA_BLOCK - (len(base) % DELTA_BLOCK), -1, -DELTA_BLOCK):
+        index[base[i:i + DELTA_BLOCK]] = i
+    return index
+
+def delta_match_length(base, boff, target, toff):
+    """Length of the common run of base[boff:] and target[toff:]."""
+    limit = min(len(base) - boff, len(target) - toff)
+    n = 0
+    while n + 64 <= limit and base[boff + n:boff + n + 64] == target[toff + n:toff + n + 64]:
+        n += 64
+    while n < limit and base[boff + n] == target[toff + n]:
+        n += 1
+    return n
+
+def delta_emit_insert(out, data):
+    """Append literal data as insert instructions (127 bytes at most each)."""
+    for i in range(0, len(data), 127):
+        chunk = data[i:i + 127]
+        out.append(len(chunk))
+        out += chunk
+
+def delta_emit_copy(out, offset, size):
+    """Append copy-from-base instructions for base[offset:offset + size]."""
+    while size:
+        n = min(size, DELTA_MAX_COPY)
+        op = 0x80
+        args = bytearray()
+        for k in range(4):
+            byte = (offset >> (8 * k)) & 0xFF
+            if byte:
+                op |= 1 << k
+                args.append(byte)
+        # A size of 0x10000 encodes as no size bytes at all
+        for k in range(3):
+            byte = (n >> (8 * k)) & 0xFF
+            if byte:
+                op |= 0x10 << k
+                args.append(byte)
+        out.append(op)
+        out += args
+        offset += n
+        size -= n
+
+def delta_create(base, index, target, max_size):
+    """
+    Encode target as a git delta against base.
+
+    Args:
+        base (bytes): The delta base.
+        index (dict): delta_index(base).
+        target (bytes): The object to encode.
+        max_size (int): Give up once the delta would be bigger than this.
+
+    Returns:
+        bytes: The delta, or None if it isn't worth it.
+    """
+    out = bytearray(delta_varint(len(base)) + delta_varint(len(target)))
+    literal_start = 0
+    i = 0
+    end = len(target) - DELTA_BLOCK
+    while i <= end:
+        offset = index.get(target[i:i + DELTA_BLOCK])
+        if offset is None:
+            i += 1
+            if len(out) + i - literal_start > max_size:
+                return None
+            continue
+
+        # Base blocks are aligned, so the match may start a bit earlier
+        while i > literal_start and offset > 0 and target[i - 1] == base[offset - 1]:
+            i -= 1
+            offset -= 1
+        length = delta_match_length(base, offset, target, i)
+
+        delta_emit_insert(out, target[literal_start:i])
+        delta_emit_copy(out, offset, length)
+        i += length
+        literal_start = i
+        if len(out) > max_size:
+            return None
+
+    delta_emit_insert(out, target[literal_start:])
+    if len(out) > max_size:
+        return None
+    return bytes(out)
+
+def delta_apply(base, delta):
+    """Rebuild an object from its delta base and a git delta."""
+    def varint(pos):
+        n = shift = 0
+        while True:
+            byte = delta[pos]
+            pos += 1
+            n |= (byte & 0x7F) << shift
+            shift += 7
+            if not byte & 0x80:
+                return n, pos
+
+    base_size, pos = varint(0)
+    size, pos = varint(pos)
+    if base_size != len(base):
+        raise Exception("Delta base size mismatch")
+
+    out = bytearray()
+    while pos < len(delta):
+        op = delta[pos]
+        pos += 1
+        if op & 0x80:
+            # Copy from base: bits 0-3 say which offset bytes follow,
+            # bits 4-6 which size bytes.
+            offset = n = 0
+            for k in range(4):
+                if op & (1 << k):
+                    offset |= delta[pos] << (8 * k)
+                    pos += 1
+            for k in range(3):
+                if op & (0x10 << k):
+                    n |= delta[pos] << (8 * k)
+                    pos += 1
+            out += base[offset:offset + (n or DELTA_MAX_COPY)]
+        elif op:
+            out += delta[pos:pos + op]
+            pos += op
+        else:
+            raise Exception("Corrupt delta: reserved opcode 0")
+
+    if len(out) != size:
+        raise Exception("Delta result size mismatch")
+    return bytes(out)
+
+def pack_entry_header(type_num, size):
+    """The type-and-size varint that starts every pack entry."""
+    out = bytearray()
+    byte = (type_num << 4) | (size & 0x0F)
+    size >>= 4
+    while size:
+        out.append(byte | 0x80)
+        byte = size & 0x7F
+        size >>= 7
+    out.append(byte)
+    return bytes(out)
+
+def pack_ofs_encode(distance):
+    """Encode the backwards distance to an OFS_DELTA base."""
+    out = [distance & 0x7F]
+    distance >>= 7
+    while distance:
+        distance -= 1
+        out.append(0x80 | (distance & 0x7F))
+        distance >>= 7
+    return bytes(reversed(out))
+
+class PackWriter(object):
+    """Write a pack stream while tracking its offset, checksum and CRCs."""
+
+    def __init__(self, f, level):
+        import zlib
+        self.zlib = zlib
+        self.f = f
+        self.level = level
+        self.offset = 0
+        self.sha = new_sha1()
+        self.crc = 0
+        self.entries = []  # (binary sha, crc32, offset) for the .idx
+
+    def write(self, data):
+        self.f.write(data)
+        self.sha.update(data)
+        self.crc = self.zlib.crc32(data, self.crc)
+        self.offset += len(data)
+
+    def write_entry(self, sha, type_num, size, blocks, base_offset=None):
+        """Write one pack entry; blocks are its uncompressed contents."""
+        with trace_region("pack-write") as span:
+            start = self.offset
+            self.crc = 0
+            self.write(pack_entry_header(type_num, size))
+            if base_offset is not None:
+                self.write(pack_ofs_encode(start - base_offset))
+            compressor = self.zlib.compressobj(self.level)
+            for block in blocks:
+                out = compressor.compress(block)
+                if out:
+                    self.write(out)
+            self.write(compressor.flush())
+            self.entries.append((sha, self.crc, start))
+            span.add(objects=1, bytes=self.offset - start)
+        return start
+
+class PackWindowEntry(object):
+    """A recently packed object the next ones may be deltified against."""
+
+    def __init__(self, fmt, data, offset, depth):
+        self.fmt = fmt
+        self.data = data
+        self.offset = offset
+        self.depth = depth
+        self.index = None  # delta_index(data), built on first use
+
+def pack_idx_write(path, entries, pack_sha):
+    """Write a version 2 .idx for entries of (binary sha, crc32, offset)."""
+    entries = sorted(entries)
+    fanout = [0] * 256
+    for sha, crc, offset in entries:
+        fanout[sha[0]] += 1
+    for i in range(1, 256):
+        fanout[i] += fanout[i - 1]
+
+    # Offsets past 2 GiB go to a table of 64-bit offsets
+    small, large = [], []
+    for sha, crc, offset in entries:
+        if offset < 0x80000000:
+            small.append(offset)
+        else:
+            small.append(0x80000000 | len(large))
+            large.append(offset)
+
+    raw = b"".join([
+        PACK_IDX_SIGNATURE,
+        struct.pack(">I", PACK_IDX_VERSION),
+        struct.pack(">256I", *fanout),
+        b"".join(sha for sha, crc, offset in entries),
+        struct.pack(f">{len(entries)}I", *(crc for sha, crc, offset in entries)),
+        struct.pack(f">{len(small)}I", *small),
+        struct.pack(f">{len(large)}Q", *large),
+        pack_sha,
+    ])
+    with open(path, "wb") as f:
+        f.write(raw)
+        f.write(new_sha1(raw).digest())
+
+def pack_write(repo, shas, window=None, depth=None):
+    """
+    Write the objects shas, loose or packed, to a new pack.
+
+    Args:
+        repo (GitRepository): The repository object.
+        shas (list): ObjectIds of the objects to pack.
+        window (int): How many preceding objects to try as delta bases.
+        depth (int): Maximum length of a delta chain.
+
+    Returns:
+        str: The pack's name, i.e. the hex checksum in pack-<sha>.pack.
+    """
+    if window is None:
+        window = repo.conf.getint("pack", "window", fallback=DEFAULT_PACK_WINDOW)
+    if depth is None:
+        depth = repo.conf.getint("pack", "depth", fallback=DEFAULT_PACK_DEPTH)
+    big_file_threshold = config_size(repo, "core", "bigfilethreshold",
+                                     DEFAULT_BIG_FILE_THRESHOLD)
+    level = repo.conf.getint("pack", "compression",
+                             fallback=repo.conf.getint("core", "compression", fallback=-1))
+
+    # Blob names come from the index, so that e.g. all the versions of a
+    # Makefile end up next to each other.
+    names = {e.sha: e.name for e in index_read(repo).entries.values()}
+    objects = []
+    for sha in shas:
+        fmt, size = object_info(repo, sha)
+        objects.append((PACK_TYPES[fmt], pack_name_hash(names.get(sha, "")), -size, sha, fmt))
+    objects.sort()
+
+    import tempfile
+    pack_dir = repo_dir(repo, "objects", "pack", mkdir=True)
+    fd, tmp_path = tempfile.mkstemp(dir=pack_dir, prefix="tmp_pack_")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            writer = PackWriter(f, level)
+            writer.write(PACK_SIGNATURE + struct.pack(">II", PACK_VERSION, len(objects)))
+
+            recent = collections.deque(maxlen=window)
+            for type_num, name_hash, neg_size, sha, fmt in objects:
+                size = -neg_size
+                if size > big_file_threshold:
+                    # Too big to deltify: stream it straight through, if
+                    # it's loose
+                    if pack_object_find(repo, sha):
+                        blocks = [object_read(repo, sha)[1]]
+                    else:
+                        fmt, size, blocks = object_read_blocks(repo, sha)
+                    writer.write_entry(sha, type_num, size, blocks)
+                    continue
+
+                fmt, data = object_read(repo, sha)
+                best, best_base = None, None
+                with trace_region("delta") as span:
+                    for base in recent:
+                        if base.fmt != fmt or base.depth >= depth:
+                            continue
+                        if size < len(base.data) // 32:
+                            continue
+                        if base.index is None:
+                            base.index = delta_index(base.data)
+                        # A delta has to beat half the object to be worth it
+                        max_size = len(best) - 1 if best else size // 2 - 20
+                        delta = delta_create(base.data, base.index, data, max_size)
+                        if delta is not None:
+                            best, best_base = delta, base
+                    span.add(objects=1, bytes=size)
+
+                if best is not None:
+                    offset = writer.write_entry(sha, PACK_OFS_DELTA, len(best), [best],
+                                                base_offset=best_base.offset)
+                    entry_depth = best_base.depth + 1
+                else:
+                    offset = writer.write_entry(sha, type_num, size, [data])
+                    entry_depth = 0
+                recent.append(PackWindowEntry(fmt, data, offset, entry_depth))
+
+            pack_sha = writer.sha.digest()
+            f.write(pack_sha)
+
+        name = pack_sha.hex()
+        pack_path = os.path.join(pack_dir, f"pack-{name}.pack")
+        idx_tmp_path = tmp_path + ".idx"
+        pack_idx_write(idx_tmp_path, writer.entries, pack_sha)
+        # Readers look for the .idx, so it goes in last
+        os.replace(tmp_path, pack_path)
+        os.replace(idx_tmp_path, os.path.join(pack_dir, f"pack-{name}.idx"))
+    except BaseException:
+        for path in (tmp_path, tmp_path + ".idx"):
+            if os.path.exists(path):
+                os.unlink(path)
+        raise
+    return name
+
+def pack_remove(repo, packs):
+    """Delete packs (GitPack objects), and forget the open ones."""
+    for pack in packs:
+        # Readers look for the .idx, so it goes first
+        for path in (pack.idx_path, pack.pack_path):
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+    repo.packs = None
+
+def object_prune_loose(repo, shas):
+    """Delete the loose copies of shas, and fanout directories left empty."""
+    fanouts = set()
+    for sha in shas:
+        os.unlink(object_path(repo, sha))
+        fanouts.add(sha.hex()[:2])
+    for fanout in fanouts:
+        try:
+            os.rmdir(repo_path(repo, "objects", fanout))
+        except OSError:
+            continue
+        if repo.fanout_dirs is not None:
+            repo.fanout_dirs.discard(fanout)
+
+# Pack reader
+#
+# Packs are memory-mapped and looked up in place: the .idx fanout table
+# narrows a lookup to the ids sharing its first byte, and a binary search
+# over those finds the entry.  Nothing is parsed when a pack is opened, so
+# opening a repository costs the same whatever the size of its packs.
+
+PACK_TYPE_NAMES = {type_num: fmt for fmt, type_num in PACK_TYPES.items()}
+
+class GitPack(object):
+    """A packfile and its .idx, memory-mapped."""
+
+    def __init__(self, idx_path):
+        self.idx_path = idx_path
+        self.pack_path = idx_path[:-len(".idx")] + ".pack"
+        import mmap
+        import zlib
+        self.zlib = zlib
+        with open(idx_path, "rb") as f:
+            self.idx = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        with open(self.pack_path, "rb") as f:
+            self.pack = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        if self.idx[:4] != PACK_IDX_SIGNATURE or \
+           struct.unpack_from(">I", self.idx, 4)[0] != PACK_IDX_VERSION:
+            raise Exception(f"Unsupported pack index {idx_path}")
+        if self.pack[:4] != PACK_SIGNATURE:
+            raise Exception(f"Bad pack file {self.pack_path}")
+
+        self.count = self.fanout(255)
+        # Offsets of the tables following the fanout in a version 2 .idx
+        self.sha_table = 8 + 256 * 4
+        self.crc_table = self.sha_table + 20 * self.count
+        self.offset_table = self.crc_table + 4 * self.count
+        self.large_offset_table = self.offset_table + 4 * self.count
+
+    def fanout(self, byte):
+        """Number of objects whose id's first byte is <= byte."""
+        return struct.unpack_from(">I", self.idx, 8 + 4 * byte)[0]
+
+    def find(self, sha):
+        """Offset in the pack of the object with binary id sha, or None."""
+        lo = self.fanout(sha[0] - 1) if sha[0] else 0
+        hi = self.fanout(sha[0])
+        idx = self.idx
+        while lo < hi:
+            mid = (lo + hi) // 2
+            start = self.sha_table + 20 * mid
+            candidate = idx[start:start + 20]
+            if candidate < sha:
+                lo = mid + 1
+            elif candidate > sha:
+                hi = mid
+            else:
+                offset = struct.unpack_from(">I", idx, self.offset_table + 4 * mid)[0]
+                if offset & 0x80000000:
+                    large = self.large_offset_table + 8 * (offset & 0x7FFFFFFF)
+                    offset = struct.unpack_from(">Q", idx, large)[0]
+                return offset
+        return None
+
+    def ids(self):
+        """Yield the ids of the pack's objects, in id order."""
+        idx = self.idx
+        for start in range(self.sha_table, self.crc_table, 20):
+            yield ObjectId(idx[start:start + 20])
+
+    def ofs_distance(self, pos):
+        """Parse the distance to an OFS_DELTA base at pos: (distance, next pos)."""
+        byte = self.pack[pos]
+        pos += 1
+        distance = byte & 0x7F
+        while byte & 0x80:
+            byte = self.pack[pos]
+            pos += 1
+            distance = ((distance + 1) << 7) | (byte & 0x7F)
+        return distance, pos
+
+    def info(self, offset, base_info=None):
+        """
+        (fmt, size) of the object at offset.  A delta's size is in the
+        first bytes of the delta, and its type is its base's, so only
+        entry headers get looked at and nothing is inflated whole.
+        base_info gives the (fmt, size) of a REF_DELTA base (by ObjectId)
+        that isn't in this pack.
+        """
+        type_num, size, pos = self.entry_header(offset)
+        if type_num in PACK_TYPE_NAMES:
+            return PACK_TYPE_NAMES[type_num], size
+        if type_num == PACK_OFS_DELTA:
+            distance, pos = self.ofs_distance(pos)
+            base, base_sha = offset - distance, None
+        elif type_num == PACK_REF_DELTA:
+            base_sha = ObjectId(self.pack[pos:pos + 20])
+            base = self.find(base_sha)
+            pos += 20
+        else:
+            raise Exception(f"Bad object type {type_num} in {self.pack_path}")
+
+        # The base's size then the result's, as varints of 10 bytes at most
+        head = self.zlib.decompressobj().decompress(self.pack[pos:pos + 1024], 20)
+        sizes = []
+        i = 0
+        for k in range(2):
+            n = shift = 0
+            while True:
+                byte = head[i]
+                i += 1
+                n |= (byte & 0x7F) << shift
+                shift += 7
+                if not byte & 0x80:
+                    break
+            sizes.append(n)
+        if base is not None:
+            fmt = self.info(base, base_info)[0]
+        elif base_info is not None:
+            fmt = base_info(base_sha)[0]
+        else:
+            raise Exception(f"Missing delta base {base_sha}")
+        return fmt, sizes[1]
+
+    def entry_header(self, offset):
+        """Parse the entry at offset: (type number, size, data offset)."""
+        pack = self.pack
+        byte = pack[offset]
+        offset += 1
+        type_num = (byte >> 4) & 7
+        size = byte & 0x0F
+        shift = 4
+        while byte & 0x80:
+            byte = pack[offset]
+            offset += 1
+            size |= (byte & 0x7F) << shift
+            shift += 7
+        return type_num, size, offset
+
+    def inflate(self, offset, size):
+        """Inflate the zlib stream at offset, size bytes once inflated."""
+        # Deflate never grows data by more than a few bytes per 16 KiB
+        # block, which bounds how much of the map has to be looked at.
+        end = min(offset + size + size // 1024 + 64, len(self.pack))
+        data = self.zlib.decompressobj().decompress(memoryview(self.pack)[offset:end], size)
+        if len(data) != size:
+            raise Exception(f"Corrupt object at offset {offset} in {self.pack_path}")
+        return data
+
+    def read_at(self, offset, base_reader=None, cache=None):
+        """
+        Read the object at offset, resolving any chain of deltas.
+
+        Args:
+            offset (int): Offset of the entry in the pack.
+            base_reader (callable): Reads a REF_DELTA base (by ObjectId) that
+                isn't in this pack; it returns (fmt, data).
+            cache (ObjectCache): Where delta bases met along the chain are
+                looked up and kept.
+
+        Returns:
+            tuple: (fmt, data), as object_read does.
+        """
+        deltas = []  # (offset, delta) pairs, target first
+        while True:
+            if deltas and cache is not None:
+                cached = cache.get((self.pack_path, offset))
+                if cached:
+                    fmt, data = cached
+                    break
+            type_num, size, pos = self.entry_header(offset)
+            if type_num == PACK_OFS_DELTA:
+                distance, pos = self.ofs_distance(pos)
+                deltas.append((offset, self.inflate(pos, size)))
+                offset -= distance
+            elif type_num == PACK_REF_DELTA:
+                base_sha = self.pack[pos:pos + 20]
+                deltas.append((offset, self.inflate(pos + 20, size)))
+                offset = self.find(base_sha)
+                if offset is None:
+                    if base_reader is None:
+                        raise Exception(f"Missing delta base {base_sha.hex()}")
+                    fmt, data = base_reader(ObjectId(base_sha))
+                    break
+            elif type_num in PACK_TYPE_NAMES:
+                fmt = PACK_TYPE_NAMES[type_num]
+                data = self.inflate(pos, size)
+                if deltas and cache is not None:
+                    cache.put((self.pack_path, offset), (fmt, data))
+                break
+            else:
+                raise Exception(f"Bad object type {type_num} in {self.pack_path}")
+
+        # Every intermediate result is the base of the next delta up; the
+        # final object is left for the caller to cache.
+        for i in range(len(deltas) - 1, -1, -1):
+            delta_offset, delta = deltas[i]
+            data = delta_apply(data, delta)
+            if i and cache is not None:
+                cache.put((self.pack_path, delta_offset), (fmt, data))
+        return fmt, data
+
+def repo_packs(repo, rescan=False):
+    """The repository's packs, opened once and kept for the process."""
+    if repo.packs is None or rescan:
+        known = {pack.idx_path: pack for pack in repo.packs or []}
+        packs = []
+        pack_dir = repo_path(repo, "objects", "pack")
+        try:
+            names = sorted(os.listdir(pack_dir))
+        except FileNotFoundError:
+            names = []
+        for name in names:
+            if name.startswith("pack-") and name.endswith(".idx"):
+                path = os.path.join(pack_dir, name)
+                packs.append(known.get(path) or GitPack(path))
+        repo.packs = packs
+    return repo.packs
+
+def pack_object_find(repo, sha, rescan=False):
+    """(pack, offset) of the packed object sha, or None."""
+    for pack in repo_packs(repo, rescan):
+        offset = pack.find(sha)
+        if offset is not None:
+            return pack, offset
+    return None
+
+# Commit-graph
+#
+# objects/info/commit-graph holds, for every commit reachable from the
+# refs, its tree, its parents, its commit date and its generation number
+# (1 for a root, else 1 + the largest of its parents'), in git's own
+# format so git can read it too.  Commits are found the same way objects
+# are found in a pack index, a fanout table then a binary search, and
+# parents are stored as positions in the file: walking history through
+# the graph never opens or inflates a commit object.  Commits written
+# after the graph are still read from their objects.
+#
+# Generation numbers make ancestry queries cheap: a commit can only reach
+# commits whose generation is smaller than its own, so a search can stop
+# descending as soon as it gets below the generation of its target.
+
+COMMIT_GRAPH_SIGNATURE = b"CGPH"
+COMMIT_GRAPH_VERSION = 1
+COMMIT_GRAPH_HASH_VERSION = 1  # SHA-1
+# Parent entries of the commit data chunk
+GRAPH_PARENT_NONE = 0x70000000
+GRAPH_EXTRA_EDGES = 0x80000000  # Octopus merge: the rest is in the EDGE chunk
+GRAPH_LAST_EDGE = 0x80000000
+GENERATION_MAX = 0x3FFFFFFF
+# Generation of commits not in the graph, as in git
+GENERATION_INFINITY = 0xFFFFFFFF
+
+class GitCommitGraph(object):
+    """A commit-graph file, memory-mapped."""
+
+    def __init__(self, path):
+        self.path = path
+        import mmap
+        with open(path, "rb") as f:
+            self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        data = self.data
+        if data[:4] != COMMIT_GRAPH_SIGNATURE or data[4] != COMMIT_GRAPH_VERSION \
+           or data[5] != COMMIT_GRAPH_HASH_VERSION:
+            raise Exception(f"Unsupported commit-graph {path}")
+        chunks = {}
+        for i in range(data[6]):
+            chunk_id, offset = struct.unpack_from(">4sQ", data, 8 + 12 * i)
+            chunks[chunk_id] = offset
+        for chunk_id in (b"OIDF", b"OIDL", b"CDAT"):
+            if chunk_id not in chunks:
+                raise Exception(f"Commit-graph {path} has no {chunk_id.decode()} chunk")
+        self.fanout_table = chunks[b"OIDF"]
+        self.oid_table = chunks[b"OIDL"]
+        self.data_table = chunks[b"CDAT"]
+        self.edge_table = chunks.get(b"EDGE")
+        self.count = self.fanout(255)
+
+        # Changed-path filters: end offsets in BIDX, filters after the
+        # BDAT header (hash version, number of hashes, bits per path)
+        self.bloom_index = chunks.get(b"BIDX")
+        self.bloom_data = chunks.get(b"BDAT")
+        self.bloom_num_hashes = None
+        self.bloom_version = None
+        if self.bloom_index is not None and self.bloom_data is not None:
+            version, num_hashes, bits = struct.unpack_from(">III", data, self.bloom_data)
+            if version in (1, BLOOM_HASH_VERSION):
+                self.bloom_num_hashes = num_hashes
+                self.bloom_version = version
+
+    def fanout(self, byte):
+        """Number of commits whose id's first byte is <= byte."""
+        return struct.unpack_from(">I", self.data, self.fanout_table + 4 * byte)[0]
+
+    def find(self, sha):
+        """Position of the commit with binary id sha, or None."""
+        lo = self.fanout(sha[0] - 1) if sha[0] else 0
+        hi = self.fanout(sha[0])
+        data = self.data
+        while lo < hi:
+            mid = (lo + hi) // 2
+            start = self.oid_table + 20 * mid
+            candidate = data[start:start + 20]
+            if candidate < sha:
+                lo = mid + 1
+            elif candidate > sha:
+                hi = mid
+            else:
+                return mid
+        return None
+
+    def oid(self, pos):
+        """ObjectId of the commit at pos."""
+        start = self.oid_table + 20 * pos
+        return ObjectId(self.data[start:start + 20])
+
+    def commit(self, pos):
+        """(tree ObjectId, parent positions, commit date, generation) at pos."""
+        tree, parent1, parent2, high, low = struct.unpack_from(
+            ">20sIIII", self.data, self.data_table + 36 * pos)
+        parents = []
+        if parent1 != GRAPH_PARENT_NONE:
+            parents.append(parent1)
+        if parent2 & GRAPH_EXTRA_EDGES:
+            edge = self.edge_table + 4 * (parent2 & ~GRAPH_EXTRA_EDGES)
+            while True:
+                parent = struct.unpack_from(">I", self.data, edge)[0]
+                parents.append(parent & ~GRAPH_LAST_EDGE)
+                if parent & GRAPH_LAST_EDGE:
+                    break
+                edge += 4
+        elif parent2 != GRAPH_PARENT_NONE:
+            parents.append(parent2)
+        return ObjectId(tree), parents, ((high & 3) << 32) | low, high >> 2
+
+    def bloom(self, pos):
+        """The changed-path filter of the commit at pos, or None."""
+        if self.bloom_num_hashes is None:
+            return None
+        end = struct.unpack_from(">I", self.data, self.bloom_index + 4 * pos)[0]
+        start = struct.unpack_from(">I", self.data, self.bloom_index + 4 * (pos - 1))[0] if pos else 0
+        if start == end:
+            return None
+        base = self.bloom_data + 12
+        return self.data[base + start:base + end]
+
+# Changed-path Bloom filters
+#
+# With --changed-paths, the commit-graph also stores for each commit a
+# Bloom filter of the paths it changed relative to its first parent (and
+# of their leading directories), in git's BIDX/BDAT chunks.  `log -- path`
+# asks the filter first: "definitely not" means the commit left path
+# alone, and no tree has to be read to find that out.
+
+BLOOM_HASH_VERSION = 2  # murmur3 over unsigned bytes
+BLOOM_SEEDS = (0x293ae76f, 0x7e646e2c)
+# git's defaults, a false positive rate of about 1%
+BLOOM_NUM_HASHES = 7
+BLOOM_BITS_PER_ENTRY = 10
+# Commits changing more paths get a filter that matches everything
+BLOOM_MAX_CHANGED_PATHS = 512
+
+def murmur3(data, seed):
+    """32-bit murmur3 of data, as git's changed-path filters use it."""
+    c1, c2, mask = 0xcc9e2d51, 0x1b873593, 0xFFFFFFFF
+    h = seed
+    n = len(data) & ~3
+    for (k,) in struct.iter_unpack("<I", data[:n]):
+        k = (k * c1) & mask
+        k = ((k << 15) | (k >> 17)) & mask
+        h ^= (k * c2) & mask
+        h = ((h << 13) | (h >> 19)) & mask
+        h = (h * 5 + 0xe6546b64) & mask
+    tail = data[n:]
+    if tail:
+        k = int.from_bytes(tail, "little")
+        k = (k * c1) & mask
+        k = ((k << 15) | (k >> 17)) & mask
+        h ^= (k * c2) & mask
+    h ^= len(data)
+    h ^= h >> 16
+    h = (h * 0x85ebca6b) & mask
+    h ^= h >> 13
+    h = (h * 0xc2b2ae35) & mask
+    return h ^ (h >> 16)
+
+def bloom_key(path, num_hashes):
+    """The num_hashes hashes of path a filter sets or tests."""
+    data = path.encode("utf8")
+    h0, h1 = (murmur3(data, seed) for seed in BLOOM_SEEDS)
+    return [(h0 + i * h1) & 0xFFFFFFFF for i in range(num_hashes)]
+
+def bloom_settings(repo):
+    """
+    (number of hashes, bits per path) for new filters.
+
+    commitGraph.bloomFalsePositiveRate trades filter size for precision;
+    unset, git's own 7 hashes over 10 bits per path are used.
+    """
+    rate = repo.conf.getfloat("commitGraph", "bloomfalsepositiverate", fallback=None)
+    if rate is None:
+        return BLOOM_NUM_HASHES, BLOOM_BITS_PER_ENTRY
+    import math
+    if not 0 < rate < 1:
+        raise Exception(f"commitGraph.bloomFalsePositiveRate must be in (0, 1), not {rate}")
+    bits = max(1, math.ceil(-math.log(rate) / math.log(2) ** 2))
+    return max(1, round(bits * math.log(2))), bits
+
+def bloom_filter(paths, num_hashes, bits_per_entry):
+    """The filter of a commit that changed paths (files, "/"-separated)."""
+    if len(paths) > BLOOM_MAX_CHANGED_PATHS:
+        return b"\xff"
+    keys = set()
+    for path in paths:
+        # Leading directories go in too, so `log -- dir` can use the filter
+        while path:
+            keys.add(path)
+            path = path.rpartition("/")[0]
+    size = max(1, (len(keys) * bits_per_entry + 7) // 8)
+    bits = bytearray(size)
+    for key in keys:
+        for h in bloom_key(key, num_hashes):
+            pos = h % (size * 8)
+            bits[pos >> 3] |= 1 << (pos & 7)
+    return bytes(bits)
+
+def bloom_contains(bits, key):
+    """False if the filter bits definitely doesn't contain key (bloom_key())."""
+    size = len(bits) * 8
+    for h in key:
+        pos = h % size
+        if not bits[pos >> 3] & (1 << (pos & 7)):
+            return False
+    return True
+
+def repo_commit_graph(repo):
+    """The repository's GitCommitGraph, opened once, or None if it has none."""
+    if repo.commit_graph is None:
+        repo.commit_graph = False
+        if repo.conf.getboolean("core", "commitgraph", fallback=True):
+            try:
+                repo.commit_graph = GitCommitGraph(repo_path(repo, "objects", "info", "commit-graph"))
+            except FileNotFoundError:
+                pass
+    return repo.commit_graph or None
+
+def commit_info(repo, sha):
+    """
+    The metadata history walks need about commit sha, from the commit-graph
+    if it has the commit, else from the commit object.
+
+    Returns:
+        tuple: (tree, parents, commit date, generation); the generation
+        is GENERATION_INFINITY outside the graph.
+    """
+    graph = repo_commit_graph(repo)
+    if graph is not None:
+        pos = graph.find(sha)
+        if pos is not None:
+            tree, parents, date, generation = graph.commit(pos)
+            return tree, [graph.oid(p) for p in parents], date, generation
+
+    commit = object_load(repo, sha, b"commit")
+    return commit.tree, commit.parents, commit.date, GENERATION_INFINITY
+
+def commit_peel(repo, sha):
+    """The commit sha refers to, following annotated tags; None for other objects."""
+    while True:
+        obj = object_load(repo, sha)
+        if isinstance(obj, Commit):
+            return sha
+        if not isinstance(obj, Tag):
+            return None
+        sha = obj.object
+
+def commit_graph_write(repo, changed_paths=None):
+    """
+    Write objects/info/commit-graph for all the commits reachable from
+    HEAD and the refs.
+
+    With changed_paths, it also gets a changed-path Bloom filter per
+    commit; None keeps them if the current commit-graph has them.
+
+    Returns:
+        int: The number of commits in the graph.
+    """
+    with trace_region("commit-graph-collect") as span:
+        tips = [ref_resolve(repo, "HEAD")] + list(ref_list(repo).values())
+        commits = {}  # ObjectId -> (tree, parents, commit date)
+        stack = [commit_peel(repo, sha) for sha in tips if sha]
+        while stack:
+            sha = stack.pop()
+            if sha is None or sha in commits:
+                continue
+            commit = object_load(repo, sha, b"commit")
+            commits[sha] = (commit.tree, commit.parents, commit.date)
+            stack.extend(commit.parents)
+            span.add(objects=1)
+
+    # Generation numbers, parents first, without recursing
+    generations = {}
+    for sha in commits:
+        stack = [sha]
+        while stack:
+            top = stack[-1]
+            if top in generations:
+                stack.pop()
+                continue
+            parents = commits[top][1]
+            pending = [p for p in parents if p not in generations]
+            if pending:
+                stack.extend(pending)
+                continue
+            stack.pop()
+            generations[top] = min(GENERATION_MAX,
+                                   1 + max((generations[p] for p in parents), default=0))
+
+    if changed_paths is None:
+        graph = repo_commit_graph(repo)
+        changed_paths = graph is not None and graph.bloom_num_hashes is not None
+    filters = {}
+    if changed_paths:
+        num_hashes, bits_per_entry = bloom_settings(repo)
+        with trace_region("commit-graph-bloom") as span:
+            for sha, (tree, parents, date) in commits.items():
+                base = commits[parents[0]][0] if parents else None
+                paths = [path for path, a, b in tree_diff(repo, base, tree)]
+                filters[sha] = bloom_filter(paths, num_hashes, bits_per_entry)
+                span.add(objects=1, bytes=len(filters[sha]))
+
+    with trace_region("commit-graph-write") as span:
+        order = sorted(commits)
+        positions = {sha: pos for pos, sha in enumerate(order)}
+        fanout = [0] * 256
+        for sha in order:
+            fanout[sha[0]] += 1
+        for i in range(1, 256):
+            fanout[i] += fanout[i - 1]
+
+        cdat = bytearray()
+        edges = []
+        for sha in order:
+            tree, parents, date = commits[sha]
+            parent1 = positions[parents[0]] if parents else GRAPH_PARENT_NONE
+            if len(parents) < 2:
+                parent2 = GRAPH_PARENT_NONE
+            elif len(parents) == 2:
+                parent2 = positions[parents[1]]
+            else:
+                parent2 = GRAPH_EXTRA_EDGES | len(edges)
+                edges.extend(positions[p] for p in parents[1:])
+                edges[-1] |= GRAPH_LAST_EDGE
+            cdat += struct.pack(">20sIIII", tree, parent1, parent2,
+                                (generations[sha] << 2) | ((date >> 32) & 3),
+                                date & 0xFFFFFFFF)
+
+        chunks = [(b"OIDF", struct.pack(">256I", *fanout)),
+                  (b"OIDL", b"".join(order)),
+                  (b"CDAT", bytes(cdat))]
+        if edges:
+            chunks.append((b"EDGE", struct.pack(f">{len(edges)}I", *edges)))
+        if filters:
+            ends = list(itertools.accumulate(len(filters[sha]) for sha in order))
+            chunks.append((b"BIDX", struct.pack(f">{len(ends)}I", *ends)))
+            chunks.append((b"BDAT", struct.pack(">III", BLOOM_HASH_VERSION, num_hashes,
+                                                bits_per_entry)
+                           + b"".join(filters[sha] for sha in order)))
+
+        # Header, then a table of chunk offsets ended by a zero id
+        parts = [COMMIT_GRAPH_SIGNATURE,
+                 bytes([COMMIT_GRAPH_VERSION, COMMIT_GRAPH_HASH_VERSION, len(chunks), 0])]
+        offset = 8 + 12 * (len(chunks) + 1)
+        for chunk_id, chunk in chunks:
+            parts.append(struct.pack(">4sQ", chunk_id, offset))
+            offset += len(chunk)
+        parts.append(struct.pack(">4sQ", b"\0\0\0\0", offset))
+        parts.extend(chunk for chunk_id, chunk in chunks)
+        raw = b"".join(parts)
+        raw += new_sha1(raw).digest()
+
+        import tempfile
+        info_dir = repo_dir(repo, "objects", "info", mkdir=True)
+        fd, tmp = tempfile.mkstemp(dir=info_dir, prefix="tmp_graph_")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(raw)
+            os.chmod(tmp, 0o444)
+            os.replace(tmp, os.path.join(info_dir, "commit-graph"))
+        except BaseException:
+            os.unlink(tmp)
+            raise
+        span.add(objects=len(order), bytes=len(raw))
+
+    repo.commit_graph = None
+    return len(order)
+
+def commit_is_ancestor(repo, ancestor, sha):
+    """Whether commit ancestor is reachable from commit sha (or is sha)."""
+    import heapq
+    target = commit_info(repo, ancestor)[3]
+    seen = {sha}
+    queue = [(-commit_info(repo, sha)[3], sha)]
+    with trace_region("ancestry") as span:
+        while queue:
+            generation, current = heapq.heappop(queue)
+            span.add(objects=1)
+            if current == ancestor:
+                return True
+            for parent in commit_info(repo, current)[1]:
+                if parent in seen:
+                    continue
+                seen.add(parent)
+                generation = commit_info(repo, parent)[3]
+                # Nothing below the target's generation can reach it
+                if generation >= target:
+                    heapq.heappush(queue, (-generation, parent))
+    return False
+
+def commit_merge_bases(repo, one, two):
+    """
+    The best common ancestors of commits one and two, found as git does:
+    walk down from both, newest (by generation, then date) first, painting
+    what each side reaches, until only commits below a common one are left.
+    """
+    import heapq
+    PARENT1, PARENT2, STALE = 1, 2, 4
+    if one == two:
+        return [one]
+
+    flags = {one: PARENT1, two: PARENT2}
+    queue = []
+    def push(sha):
+        tree, parents, date, generation = commit_info(repo, sha)
+        heapq.heappush(queue, (-generation, -date, sha))
+    push(one)
+    push(two)
+
+    bases = []
+    with trace_region("merge-base") as span:
+        while any(not flags[sha] & STALE for g, d, sha in queue):
+            g, d, sha = heapq.heappop(queue)
+            span.add(objects=1)
+            flag = flags[sha] & (PARENT1 | PARENT2 | STALE)
+            if flag == PARENT1 | PARENT2:
+                if sha not in bases:
+                    bases.append(sha)
+                flag |= STALE
+            for parent in commit_info(repo, sha)[1]:
+                if flags.get(parent, 0) & flag == flag:
+                    continue
+                flags[parent] = flags.get(parent, 0) | flag
+                push(parent)
+
+    # Drop the bases that are ancestors of another one
+    return [base for base in bases
+            if not any(other != base and commit_is_ancestor(repo, base, other)
+                       for other in bases)]
+
+# Revision walking
+#
+# rev_walk() is a generator: it hands out commits newest first, popping
+# them from a heap ordered by commit date and only then pushing their
+# parents, so a consumer that stops after ten commits (log -n 10) has
+# looked at those ten and their parents, whatever the size of the history.
+#
+# Limited to paths, it only hands out the commits that changed them, and
+# simplifies merges as git does: a merge that took paths unchanged from
+# one of its parents is skipped, and only that parent is followed.
+
+# Seconds in the units a relative date ("2 weeks ago") may use
+DATE_UNITS = {"second": 1, "minute": 60, "hour": 3600, "day": 86400,
+              "week": 7 * 86400, "month": 30 * 86400, "year": 365 * 86400}
+
+def date_parse(text, now=None):
+    """
+    A timestamp from a date given to --since/--until: seconds since the
+    epoch, "YYYY-MM-DD[ HH:MM[:SS]]" in local time, or "<n> <unit>s ago".
+    """
+    text = text.strip()
+    if text.isdigit():
+        return int(text)
+    words = text.replace(".", " ").split()
+    if len(words) == 3 and words[0].isdigit() and words[2] == "ago" \
+       and words[1].rstrip("s") in DATE_UNITS:
+        now = time.time() if now is None else now
+        return int(now) - int(words[0]) * DATE_UNITS[words[1].rstrip("s")]
+    for fmt in ("%Y-%m-%d %H:%M:%S", "%Y-%m-%d %H:%M", "%Y-%m-%d"):
+        try:
+            return int(time.mktime(time.strptime(text.replace("T", " "), fmt)))
+        except ValueError:
+            pass
+    raise Exception(f"Bad date {text}")
+
+def rev_path_keys(repo, paths):
+    """
+    What rev_treesame() tests commits' changed-path filters with: per
+    path, the bloom_key() of it and of its leading directories.
+    """
+    graph = repo_commit_graph(repo)
+    if graph is None or graph.bloom_num_hashes is None:
+        return None
+    # Version 1 filters hashed bytes past 0x7f as signed chars
+    if graph.bloom_version == 1 and not all(path.isascii() for path in paths):
+        return None
+    keys = []
+    for path in paths:
+        parts = path.split("/")
+        keys.append([bloom_key("/".join(parts[:n]), graph.bloom_num_hashes)
+                     for n in range(len(parts), 0, -1)])
+    return keys
+
+def rev_treesame(repo, sha, tree, parent, paths, keys, stats):
+    """
+    Whether paths are the same in commit sha (whose tree is tree) and in
+    its parent, asking the changed-path filter of sha first if parent is
+    its first parent and keys (see rev_path_keys()) is set.
+    """
+    if keys is not None:
+        graph = repo_commit_graph(repo)
+        pos = graph.find(sha)
+        bits = graph.bloom(pos) if pos is not None else None
+        if bits is None:
+            stats["filter_not_present"] += 1
+        elif not any(all(bloom_contains(bits, key) for key in path_keys)
+                     for path_keys in keys):
+            stats["definitely_not"] += 1
+            return True
+        else:
+            stats["maybe"] += 1
+
+    # The first difference under paths settles it
+    parent_tree = commit_info(repo, parent)[0]
+    same = next(tree_diff(repo, parent_tree, tree, paths=paths), None) is None
+    if same and keys is not None and bits is not None:
+        stats["false_positive"] += 1
+    return same
+
+def rev_walk(repo, tips, since=None, until=None, paths=None, stats=None):
+    """
+    Yield the ids of the commits reachable from tips, newest first.
+
+    Args:
+        repo (GitRepository): The repository object.
+        tips (list): ObjectIds of the commits to start from.
+        since (int): Stop at the first commit older than this timestamp.
+        until (int): Skip commits newer than this timestamp.
+        paths (list): Only yield the commits changing these paths.
+        stats (collections.Counter): Where to count how the changed-path
+            filters answered, when paths are given.
+    """
+    import heapq
+    order = itertools.count()  # Keeps commits with equal dates in push order
+    seen = set()
+    queue = []
+
+    if paths:
+        keys = rev_path_keys(repo, paths)
+        stats = collections.Counter() if stats is None else stats
+
+    def push(sha):
+        if sha not in seen:
+            seen.add(sha)
+            tree, parents, date, generation = commit_info(repo, sha)
+            heapq.heappush(queue, (-date, next(order), sha, tree, parents))
+
+    for sha in tips:
+        push(sha)
+    with trace_region("walk") as span:
+        while queue:
+            date, n, sha, tree, parents = heapq.heappop(queue)
+            span.add(objects=1)
+            # Everything left in the queue is older still
+            if since is not None and -date < since:
+                return
+            show = True
+            if paths:
+                if not parents:
+                    show = next(tree_diff(repo, None, tree, paths=paths), None) is not None
+                for i, parent in enumerate(parents):
+                    if rev_treesame(repo, sha, tree, parent, paths,
+                                    keys if i == 0 else None, stats):
+                        show = False
+                        parents = [parent]
+                        break
+            for parent in parents:
+                push(parent)
+            if show and (until is None or -date <= until):
+                yield sha
+
+# Diffs
+#
+# `diff-tree` and `log --stat` run on tree_diff(), so comparing two
+# commits only reads the trees along the paths that changed between them.
+# --stat also counts the lines each file gained and lost, as git does:
+# the lines both versions start and end with are trimmed, lines found on
+# one side only are set aside (nothing can match them), and Myers'
+# algorithm finds the shortest edit script between the rest.  A file with
+# a NUL byte in its first 8000 bytes is binary, and only its sizes show.
+
+# Bytes searched for a NUL to tell binary files, as in git
+DIFF_BINARY_PEEK = 8000
+# Width of the plumbing's --stat, and of log's off a terminal, as in git
+DIFF_STAT_WIDTH = 80
+# The file type bits of a mode
+DIFF_TYPE_MASK = 0o170000
+
+def tree_peel(repo, sha):
+    """The tree sha refers to: itself, or that of the commit or tag it names."""
+    while True:
+        obj = object_load(repo, sha)
+        if isinstance(obj, Tree):
+            return sha
+        if isinstance(obj, Commit):
+            return obj.tree
+        if not isinstance(obj, Tag):
+            raise Exception(f"Object {sha} is not a tree")
+        sha = obj.object
+
+def diff_status(a, b):
+    """The letter git shows for a change from a to b ((mode, sha) or None)."""
+    if a is None:
+        return "A"
+    if b is None:
+        return "D"
+    if int(a[0], 8) & DIFF_TYPE_MASK != int(b[0], 8) & DIFF_TYPE_MASK:
+        return "T"
+    return "M"
+
+def diff_raw(path, a, b):
+    """The line of git's raw diff format for the change of path from a to b."""
+    old_mode, old_sha = (int(a[0], 8), a[1].hex()) if a else (0, "0" * 40)
+    new_mode, new_sha = (int(b[0], 8), b[1].hex()) if b else (0, "0" * 40)
+    return f":{old_mode:06o} {new_mode:06o} {old_sha} {new_sha} {diff_status(a, b)}\t{path}"
+
+def diff_blob(repo, entry):
+    """The contents a diff sees for entry, a (mode, sha) or None."""
+    if entry is None:
+        return b""
+    if entry[0] == "160000":
+        return f"Subproject commit {entry[1]}\n".encode()  # Not in this repository
+    return object_read(repo, entry[1])[1]
+
+def diff_lines(data):
+    """The lines of data, a last line missing its newline told apart."""
+    lines = data.split(b"\n")
+    if lines[-1]:
+        lines[-1] += b"\x00"  # Text has no NUL, so no other line ends so
+    else:
+        lines.pop()
+    return lines
+
+def diff_distance(a, b):
+    """Length of the shortest edit script turning list a into list b (Myers)."""
+    n, m = len(a), len(b)
+    if not n or not m:
+        return n + m
+    # v[offset + k] is how far along a the furthest path of diagonal k got
+    offset = n + m
+    v = [0] * (2 * offset + 2)
+    for d in range(offset + 1):
+        for k in range(-d, d + 1, 2):
+            if k == -d or (k != d and v[offset + k - 1] < v[offset + k + 1]):
+                x = v[offset + k + 1]
+            else:
+                x = v[offset + k - 1] + 1
+            y = x - k
+            while x < n and y < m and a[x] == b[y]:
+                x += 1
+                y += 1
+            v[offset + k] = x
+            if x >= n and y >= m:
+                return d
+    return n + m
+
+def diff_line_counts(old, new):
+    """(lines added, lines removed) going from text old to text new."""
+    a, b = diff_lines(old), diff_lines(new)
+    lo, hi_a, hi_b = 0, len(a), len(b)
+    while lo < hi_a and lo < hi_b and a[lo] == b[lo]:
+        lo += 1
+    while hi_a > lo and hi_b > lo and a[hi_a - 1] == b[hi_b - 1]:
+        hi_a -= 1
+        hi_b -= 1
+    a, b = a[lo:hi_a], b[lo:hi_b]
+    common = set(a).intersection(b)
+    kept = [line for line in a if line in common], [line for line in b if line in common]
+    same = (len(kept[0]) + len(kept[1]) - diff_distance(*kept)) // 2
+    return len(b) - same, len(a) - same
+
+def diff_stat(repo, changes):
+    """
+    [(path, added, removed, binary)] for the (path, old, new) changes
+    tree_diff() yields: lines for text files, for binary ones their new
+    and old sizes in bytes.
+    """
+    stats = []
+    for path, a, b in changes:
+        old, new = diff_blob(repo, a), diff_blob(repo, b)
+        binary = b"\x00" in old[:DIFF_BINARY_PEEK] or b"\x00" in new[:DIFF_BINARY_PEEK]
+        if a and b and a[1] == b[1]:
+            added, removed = 0, 0  # The mode changed, not the contents
+        elif binary:
+            added, removed = len(new), len(old)
+        else:
+            added, removed = diff_line_counts(old, new)
+        stats.append((path, added, removed, binary))
+    return stats
+
+def diff_stat_width():
+    """Columns log --stat may use: $COLUMNS, else the terminal's width, as in git."""
+    columns = os.environ.get("COLUMNS", "")
+    if columns.isdigit() and int(columns) > 0:
+        return int(columns)
+    if sys.stdout.isatty():
+        try:
+            return os.get_terminal_size(sys.stdout.fileno()).columns
+        except OSError:
+            pass
+    return DIFF_STAT_WIDTH
+
+def diff_stat_lines(stats, width):
+    """
+    The lines of git's --stat for diff_stat() results: a name, the
+    change count and a +/- graph per file, laid out within width columns
+    the way git does it, then a summary.  None for no changes.
+    """
+    if not stats:
+        return None
+    max_len = max(len(path) for path, added, removed, binary in stats)
+    max_change = max((added + removed for path, added, removed, binary in stats
+                      if not binary), default=0)
+    number_width, bin_width = 0, 0
+    for path, added, removed, binary in stats:
+        if binary:
+            # "Bin XXX -> YYY bytes", the counts aligned with "Bin"
+            bin_width = max(bin_width, 14 + len(str(added)) + len(str(removed)))
+            number_width = 3
+    number_width = max(number_width, len(str(max_change)))
+
+    # The name, " | ", the count, a space and the graph share the width;
+    # if they don't fit, the graph gets at most 3/8 of it
+    width = max(width, 16 + 6 + number_width)
+    graph_width = max_change if max_change + 4 > bin_width else bin_width - 4
+    name_width = max_len
+    if name_width + number_width + 6 + graph_width > width:
+        if graph_width > width * 3 // 8 - number_width - 6:
+            graph_width = max(width * 3 // 8 - number_width - 6, 6)
+        if name_width > width - number_width - 6 - graph_width:
+            name_width = width - number_width - 6 - graph_width
+        else:
+            graph_width = width - number_width - 6 - name_width
+
+    def scale(n):
+        return 1 + n * (graph_width - 1) // max_change if n else 0
+
+    lines = []
+    for path, added, removed, binary in stats:
+        prefix, name, length = "", path, name_width
+        if name_width < len(path):
+            # Keep the end of the name, from a directory boundary
+            prefix, length = "...", name_width - 3
+            name = path[len(path) - length:] if length > 0 else ""
+            slash = name.find("/")
+            if slash >= 0:
+                name = name[slash:]
+        name = f" {prefix}{name}{' ' * max(length - len(name), 0)} | "
+        if binary:
+            sizes = f" {removed} -> {added} bytes" if added or removed else ""
+            lines.append(f"{name}{'Bin':>{number_width}}{sizes}")
+            continue
+        plus, minus = added, removed
+        if graph_width <= max_change:
+            total = scale(added + removed)
+            if total < 2 and added and removed:
+                total = 2
+            if added < removed:
+                plus = scale(added)
+                minus = total - plus
+            else:
+                minus = scale(removed)
+                plus = total - minus
+        change = added + removed
+        lines.append(f"{name}{change:>{number_width}}{' ' if change else ''}{'+' * plus}{'-' * minus}")
+
+    insertions = sum(added for path, added, removed, binary in stats if not binary)
+    deletions = sum(removed for path, added, removed, binary in stats if not binary)
+    summary = f" {len(stats)} file{'s' if len(stats) != 1 else ''} changed"
+    if insertions or not deletions:
+        summary += f", {insertions} insertion{'s' if insertions != 1 else ''}(+)"
+    if deletions or not insertions:
+        summary += f", {deletions} deletion{'s' if deletions != 1 else ''}(-)"
+    lines.append(summary)
+    return lines
+
+def diff_format(repo, changes, fmt):
+    """
+    The lines showing the (path, old, new) changes tree_diff() yields, in
+    fmt: "raw", "name-only", "name-status" or "stat".
+    """
+    if fmt == "stat":
+        return diff_stat_lines(diff_stat(repo, changes), DIFF_STAT_WIDTH) or []
+    if fmt == "name-only":
+        return [path for path, a, b in changes]
+    if fmt == "name-status":
+        return [f"{diff_status(a, b)}\t{path}" for path, a, b in changes]
+    return [diff_raw(path, a, b) for path, a, b in changes]
+
+# Add functionality for `diff-tree` command to compare two trees
+def cmd_diff_tree(args):
+    """Handle the 'diff-tree' command."""
+    repo = GitRepository(os.getcwd())  # Initialize repository object
+    paths = [index_path(repo, path) for path in args.paths]
+    if not paths or "." in paths:
+        paths = None  # The whole tree
+
+    if len(args.objects) > 2:
+        raise Exception("diff-tree compares one commit or two trees")
+    header = None
+    if len(args.objects) == 2:
+        old, new = (tree_peel(repo, object_find(repo, name)) for name in args.objects)
+    else:
+        # One commit: compare it with its parent
+        header = commit_peel(repo, object_find(repo, args.objects[0]))
+        if header is None:
+            raise Exception(f"{args.objects[0]} is not a commit")
+        new, parents, date, generation = commit_info(repo, header)
+        if len(parents) > 1 or (not parents and not args.root):
+            return  # As in git, merges and root commits show no diff
+        old = commit_info(repo, parents[0])[0] if parents else None
+
+    recursive = args.r or args.format == "stat"
+    changes = tree_diff(repo, old, new, paths=paths, recursive=recursive)
+    lines = diff_format(repo, changes, args.format)
+    if lines:
+        out = sys.stdout.buffer
+        if header is not None:
+            out.write(f"{header}\n".encode())
+        out.write("".join(line + "\n" for line in lines).encode())
+    logger.debug("Object cache: %s", repo.cache.stats())
+    trace_event("cache", **repo.cache.stats())
+
+def argsp_diff_tree(argsp):
+    argsp.add_argument("-r",
+                       action="store_true",
+                       help="Recurse into subtrees rather than show them as one entry.")
+    argsp.add_argument("--root",
+                       action="store_true",
+                       help="Show a root commit as adding all its files.")
+    formats = argsp.add_mutually_exclusive_group()
+    formats.add_argument("--name-only",
+                         dest="format",
+                         action="store_const",
+                         const="name-only",
+                         help="Show only the names of the changed files.")
+    formats.add_argument("--name-status",
+                         dest="format",
+                         action="store_const",
+                         const="name-status",
+                         help="Show the names and the kind of change (A, D, M, T).")
+    formats.add_argument("--stat",
+                         dest="format",
+                         action="store_const",
+                         const="stat",
+                         help="Show the lines added and removed per file (implies -r).")
+    argsp.add_argument("objects",
+                       nargs="+",
+                       metavar="tree-ish",
+                       help="Two trees (or commits) to compare, or one commit to compare "
+                            "with its parent; paths after -- limit the diff to them.")
+    argsp.set_defaults(format="raw", paths=[])
+
+COMMANDS["diff-tree"] = (cmd_diff_tree, "Compare the trees of two commits.", argsp_diff_tree)
+
+# Add functionality for `cat-file` command to print an object
+def cmd_cat_file(args):
+    """Handle the 'cat-file' command."""
+    repo = GitRepository(os.getcwd())  # Initialize repository object
+    fmt, data = object_read(repo, object_find(repo, args.object))
+    if fmt != args.type.encode():
+        raise Exception(f"Object {args.object} is a {fmt.decode()}, not a {args.type}")
+    sys.stdout.buffer.write(data)
+
+def argsp_cat_file(argsp):
+    argsp.add_argument("type",
+                       metavar="type",
+                       choices=["blob", "commit", "tag", "tree"],
+                       help="Specify the type.")
+    argsp.add_argument("object",
+                       metavar="object",
+                       help="The object to display.")
+
+COMMANDS["cat-file"] = (cmd_cat_file, "Provide content of repository objects.", argsp_cat_file)
+
+# Add functionality for `repack` command to pack loose objects
+def cmd_repack(args):
+    """Handle the 'repack' command."""
+    repo = GitRepository(os.getcwd())  # Initialize repository object
+    with trace_region("enumerate") as span:
+        loose = list(object_loose_list(repo))
+        shas = dict.fromkeys(loose)
+        packs = repo_packs(repo, rescan=True) if args.a else []
+        for pack in packs:
+            shas.update(dict.fromkeys(pack.ids()))
+        span.add(objects=len(shas))
+    if not loose and len(packs) < 2:
+        logger.info("Nothing new to pack.")
+        return
+    logger.info("Packing %d objects, %d of them loose", len(shas), len(loose))
+    name = pack_write(repo, list(shas), window=args.window, depth=args.depth)
+    logger.info("Wrote pack-%s.pack", name)
+    if args.d:
+        object_prune_loose(repo, loose)
+        logger.info("Pruned %d loose objects", len(loose))
+        # A pack with the same contents as the new one is the new one
+        old = [pack for pack in packs if pack.idx_path != os.path.join(
+            repo_path(repo, "objects", "pack"), f"pack-{name}.idx")]
+        pack_remove(repo, old)
+        if old:
+            logger.info("Removed %d old packs", len(old))
+
+def argsp_repack(argsp):
+    argsp.add_argument("-a",
+                       action="store_true",
+                       help="Pack the objects of the existing packs too, into one pack.")
+    argsp.add_argument("-d",
+                       action="store_true",
+                       help="Delete the loose objects once they are packed, "
+                            "and with -a the old packs.")
+    argsp.add_argument("--window",
+                       type=int,
+                       default=None,
+                       help="Number of objects to try as delta bases (default pack.window or 10).")
+    argsp.add_argument("--depth",
+                       type=int,
+                       default=None,
+                       help="Maximum delta chain length (default pack.depth or 50).")
+
+COMMANDS["repack"] = (cmd_repack, "Pack loose objects, or with -a all objects.", argsp_repack)
+
+# Add functionality for `gc` command, a `repack -a -d`
+def cmd_gc(args):
+    """Handle the 'gc' command."""
+    args.a = True
+    args.d = True
+    args.window = None
+    args.depth = None
+    cmd_repack(args)
+    # Like git's gc.writeCommitGraph
+    repo = GitRepository(os.getcwd())
+    if repo.conf.getboolean("gc", "writecommitgraph", fallback=True) and ref_resolve(repo, "HEAD"):
+        commit_graph_write(repo)
+
+COMMANDS["gc"] = (cmd_gc, "Pack all objects into one pack and prune the rest.", None)
+
+# Add functionality for `commit-graph` command to write the commit-graph
+def cmd_commit_graph(args):
+    """Handle the 'commit-graph' command."""
+    repo = GitRepository(os.getcwd())  # Initialize repository object
+    count = commit_graph_write(repo, args.changed_paths or None)
+    logger.info("Wrote a commit-graph of %d commits", count)
+
+def argsp_commit_graph(argsp):
+    argsp.add_argument("action",
+                       choices=["write"],
+                       help="What to do with the commit-graph.")
+    argsp.add_argument("--changed-paths",
+                       action="store_true",
+                       help="Store changed-path Bloom filters for path-limited log.")
+
+COMMANDS["commit-graph"] = (cmd_commit_graph, "Write the commit-graph file.", argsp_commit_graph)
+
+# Add functionality for `merge-base` command to find common ancestors
+def cmd_merge_base(args):
+    """Handle the 'merge-base' command."""
+    repo = GitRepository(os.getcwd())  # Initialize repository object
+    one, two = (commit_peel(repo, object_find(repo, name)) for name in args.commits)
+    if args.is_ancestor:
+        sys.exit(0 if commit_is_ancestor(repo, one, two) else 1)
+    bases = commit_merge_bases(repo, one, two)
+    if not bases:
+        sys.exit(1)
+    for base in bases if args.all else bases[:1]:
+        print(base)
+
+def argsp_merge_base(argsp):
+    argsp.add_argument("--all",
+                       action="store_true",
+                       help="Print all the best common ancestors, not just one.")
+    argsp.add_argument("--is-ancestor",
+                       action="store_true",
+                       help="Exit with 0 if the first commit is an ancestor of the second, else 1.")
+    argsp.add_argument("commits",
+                       nargs=2,
+                       metavar="commit",
+                       help="The commits to compare.")
+
+COMMANDS["merge-base"] = (cmd_merge_base, "Find the best common ancestors of two commits.", argsp_merge_base)
+
+# Log levels by name, for WYAG_LOG
+LOG_LEVELS = {"debug": 10, "info": 20, "warning": 30, "error": 40, "critical": 50}
+
+def logging_setup(verbose=0):
+    """
+    Send the 'git' logger's records to stderr, at the requested level.
+
+    The level is WARNING unless raised by -v (INFO) or -vv (DEBUG), or set
+    with WYAG_LOG (a level name or number), which -v takes precedence over;
+    a WYAG_LOG that is neither is ignored, with a warning.  Only the 'git'
+    logger is touched, never the root logger, so this doesn't interfere
+    with the logging of a program calling main().
+    """
+    import logging
+
+    level = logging.WARNING
+    bad_env = None
+    env = os.environ.get("WYAG_LOG")
+    if env:
+        level = LOG_LEVELS.get(env.strip().lower())
+        if level is None:
+            try:
+                level = int(env)
+            except ValueError:
+                level, bad_env = logging.WARNING, env
+    if verbose:
+        level = logging.INFO if verbose == 1 else logging.DEBUG
+
+    git_logger = logging.getLogger('git')
+    git_logger.setLevel(level)
+    if not git_logger.handlers:
+        handler = logging.StreamHandler()
+        handler.setFormatter(logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s'))
+        git_logger.addHandler(handler)
+        git_logger.propagate = False
+    if bad_env is not None:
+        git_logger.warning("Ignoring WYAG_LOG=%s: not a level name (%s) or number",
+                           bad_env, ", ".join(LOG_LEVELS))
+
+def argparser_build(command=None):
+    """
+    Build the argument parser.
+
+    Every command gets a subparser so `--help` can list them all, but only
+    command, the one being run, has its arguments added.
+    """
+    import argparse
+    argparser = argparse.ArgumentParser(description="The stupidest content tracker")
+    argparser.add_argument("--version",
+                           action="version",
+                           version=f"%(prog)s {__version__}")
+    argparser.add_argument("-v", "--verbose",
+                           action="count",
+                           default=0,
+                           help="Log progress (-v) or per-file detail (-vv); see also WYAG_LOG.")
+
+    # Add subparsers for commands
+    argsubparsers = argparser.add_subparsers(title="Commands", dest="command")
+    argsubparsers.required = True
+    for name, (fn, help, add_arguments) in COMMANDS.items():
+        argsp = argsubparsers.add_parser(name, help=help)
+        if name == command and add_arguments:
+            add_arguments(argsp)
+    return argparser
+
+# Define the main function
+def main(argv=sys.argv[1:]):
+    """
+    Main entry point for the CLI.
+
+    Args:
+        argv (list): Command-line arguments (excluding the script name).
+    """
+    # Answer --version before importing and setting up anything else
+    if argv == ["--version"]:
+        print(f"{os.path.basename(sys.argv[0])} {__version__}")
+        return
+
+    # The command is the first argument that isn't an option
+    command = next((arg for arg in argv if not arg.startswith("-")), None)
+    # Everything after "--" is a list of paths, as in git
+    paths = None
+    if "--" in argv:
+        split = argv.index("--")
+        argv, paths = argv[:split], argv[split + 1:]
+    argparser = argparser_build(command)
+    args = argparser.parse_args(argv)
+    if paths is not None:
+        if not hasattr(args, "paths"):
+            argparser.error(f"{args.command} doesn't take paths")
+        args.paths = paths
+
+    logging_setup(args.verbose)
+    logger.debug("Parsed arguments: %s", args)
+
+    fn, help, add_arguments = COMMANDS[args.command]
+    trace_start(args.command, argv)
+    status = "error"
+    try:
+        fn(args)
+        sys.stdout.flush()  # So a closed pipe shows up here, not at exit
+        status = "ok"
+    except BrokenPipeError:
+        # Whoever read our output stopped (`wyag log | head`): stop too,
+        # quietly, as git does
+        status = "broken-pipe"
+        stdout_discard()
+        sys.exit(STATUS_BROKEN_PIPE)
+    finally:
+        trace_end(status)
+
+# Exit status for a closed stdout: that of git, killed by SIGPIPE
+STATUS_BROKEN_PIPE = 128 + 13
+
+def stdout_discard():
+    """
+    Point stdout at /dev/null, so that what is still buffered for the
+    closed pipe doesn't make the interpreter fail again while flushing it
+    at exit.
+    """
+    try:
+        fd = sys.stdout.fileno()
+    except (AttributeError, ValueError, OSError):
+        return  # Not a real file, e.g. redirected by a caller of main()
+    devnull = os.open(os.devnull, os.O_WRONLY)
+    os.dup2(devnull, fd)
+    os.close(devnull)
 
 
 # Ensure the main function is called when the script is executed directly
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
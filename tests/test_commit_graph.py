@@ -0,0 +1,185 @@
+"""
+The commit-graph: commit_graph_write read back through GitCommitGraph,
+merges and octopus merges included, and the murmur3 hash and Bloom
+filters of its changed-path chunks.
+"""
+
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import libwyag  # noqa: E402
+
+class Murmur3Test(unittest.TestCase):
+
+    # The published test vectors of 32-bit murmur3: (data, seed, hash)
+    VECTORS = [
+        (b"", 0, 0),
+        (b"", 1, 0x514E28B7),
+        (b"", 0xFFFFFFFF, 0x81F16F39),
+        (b"\xff\xff\xff\xff", 0, 0x76293B50),
+        (b"\x21\x43\x65\x87", 0, 0xF55B516B),
+        (b"\x21\x43\x65\x87", 0x5082EDEE, 0x2362F9DE),
+        (b"\x21\x43\x65", 0, 0x7E4A8634),
+        (b"\x21\x43", 0, 0xA0F7B07A),
+        (b"\x21", 0, 0x72661CF4),
+        (b"\x00\x00\x00\x00", 0, 0x2362F9DE),
+        (b"Hello, world!", 0x9747B28C, 0x24884CBA),
+        (b"The quick brown fox jumps over the lazy dog", 0x9747B28C, 0x2FA826CD),
+        (b"aaaa", 0x9747B28C, 0x5A97808A),
+        (b"abc", 0, 0xB3DD93FA),
+    ]
+
+    def test_vectors(self):
+        for data, seed, expected in self.VECTORS:
+            self.assertEqual(libwyag.murmur3(data, seed), expected, (data, hex(seed)))
+
+class BloomTest(unittest.TestCase):
+
+    def test_paths_and_leading_directories(self):
+        bits = libwyag.bloom_filter(["a/b/c", "d"], 7, 10)
+        self.assertEqual(len(bits), (4 * 10 + 7) // 8)
+        for path in ("a/b/c", "a/b", "a", "d"):
+            self.assertTrue(libwyag.bloom_contains(bits, libwyag.bloom_key(path, 7)), path)
+        absent = [path for path in (f"other{i}" for i in range(100))
+                  if libwyag.bloom_contains(bits, libwyag.bloom_key(path, 7))]
+        self.assertLess(len(absent), 10)
+
+    def test_too_many_paths_match_everything(self):
+        paths = [f"f{i}" for i in range(libwyag.BLOOM_MAX_CHANGED_PATHS + 1)]
+        bits = libwyag.bloom_filter(paths, 7, 10)
+        self.assertEqual(bits, b"\xff")
+        self.assertTrue(libwyag.bloom_contains(bits, libwyag.bloom_key("anything", 7)))
+
+class CommitGraphTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.worktree = os.path.join(self.tmp.name, "worktree")
+        libwyag.repo_create(self.worktree)
+        self.repo = libwyag.GitRepository(self.worktree)
+
+        # root - one - two ------ merge - octopus
+        #          \- side -----/          /
+        #          \- other ---------------
+        self.date = 1700000000
+        root = self.commit({"a": "1"}, [])
+        one = self.commit({"a": "2", "dir/b": "1"}, [root])
+        two = self.commit({"a": "3", "dir/b": "1"}, [one])
+        side = self.commit({"a": "2", "dir/b": "2"}, [one])
+        other = self.commit({"a": "2", "dir/b": "1", "dir/c": "1"}, [one])
+        merge = self.commit({"a": "3", "dir/b": "2"}, [two, side])
+        octopus = self.commit({"a": "3", "dir/b": "2", "dir/c": "1"}, [merge, other, side])
+        self.commits = {"root": root, "one": one, "two": two, "side": side,
+                        "other": other, "merge": merge, "octopus": octopus}
+        with open(libwyag.repo_path(self.repo, "refs", "heads", "master"), "w") as f:
+            f.write(f"{octopus}\n")
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def tree(self, files):
+        """Write the tree of files, {path: contents}, one level of directories deep."""
+        items, subdirs = [], {}
+        for path, text in files.items():
+            if "/" in path:
+                dirname, name = path.split("/", 1)
+                subdirs.setdefault(dirname, {})[name] = text
+            else:
+                sha = libwyag.object_write(b"blob", text.encode(), self.repo)
+                items.append(("100644", path, sha))
+        for dirname, subfiles in subdirs.items():
+            items.append((libwyag.TREE_MODE, dirname, self.tree(subfiles)))
+        return libwyag.object_write(b"tree", libwyag.tree_serialize(items), self.repo)
+
+    def commit(self, files, parents):
+        self.date += 60
+        lines = [f"tree {self.tree(files)}"] + [f"parent {p}" for p in parents]
+        lines += [f"author A U Thor <author@example.com> {self.date} +0000",
+                  f"committer A U Thor <author@example.com> {self.date} +0000",
+                  "", f"Commit at {self.date}", ""]
+        return libwyag.object_write(b"commit", "\n".join(lines).encode(), self.repo)
+
+    def graph_path(self):
+        return libwyag.repo_path(self.repo, "objects", "info", "commit-graph")
+
+    def check_graph(self, graph):
+        self.assertEqual(graph.count, len(self.commits))
+        generations = {"root": 1, "one": 2, "two": 3, "side": 3, "other": 3,
+                       "merge": 4, "octopus": 5}
+        for name, sha in self.commits.items():
+            pos = graph.find(sha)
+            self.assertIsNotNone(pos, name)
+            self.assertEqual(graph.oid(pos), sha)
+            commit = libwyag.object_load(self.repo, sha, b"commit")
+            tree, parents, date, generation = graph.commit(pos)
+            self.assertEqual(tree, commit.tree, name)
+            self.assertEqual([graph.oid(p) for p in parents], commit.parents, name)
+            self.assertEqual(date, commit.date, name)
+            self.assertEqual(generation, generations[name], name)
+        self.assertIsNone(graph.find(libwyag.ObjectId(b"\x00" * 20)))
+
+    def test_read_back(self):
+        self.assertEqual(libwyag.commit_graph_write(self.repo), len(self.commits))
+        graph = libwyag.GitCommitGraph(self.graph_path())
+        self.check_graph(graph)
+        self.assertIsNone(graph.bloom_num_hashes)
+        self.assertIsNotNone(graph.edge_table)
+
+    def test_changed_paths(self):
+        libwyag.commit_graph_write(self.repo, changed_paths=True)
+        graph = libwyag.GitCommitGraph(self.graph_path())
+        self.check_graph(graph)
+        self.assertEqual(graph.bloom_num_hashes, libwyag.BLOOM_NUM_HASHES)
+
+        # Each filter has the paths changed since the first parent
+        changed = {"root": ["a"], "one": ["a", "dir/b", "dir"], "two": ["a"],
+                   "side": ["dir/b", "dir"], "merge": ["dir/b", "dir"],
+                   "octopus": ["dir/c", "dir"]}
+        for name, paths in changed.items():
+            bits = graph.bloom(graph.find(self.commits[name]))
+            for path in paths:
+                key = libwyag.bloom_key(path, graph.bloom_num_hashes)
+                self.assertTrue(libwyag.bloom_contains(bits, key), (name, path))
+
+        # Rewriting keeps the filters unless asked not to
+        libwyag.commit_graph_write(self.repo)
+        self.assertIsNotNone(libwyag.GitCommitGraph(self.graph_path()).bloom_num_hashes)
+        libwyag.commit_graph_write(self.repo, changed_paths=False)
+        self.assertIsNone(libwyag.GitCommitGraph(self.graph_path()).bloom_num_hashes)
+
+    def test_ancestry(self):
+        libwyag.commit_graph_write(self.repo)
+        c = self.commits
+        self.assertTrue(libwyag.commit_is_ancestor(self.repo, c["root"], c["octopus"]))
+        self.assertTrue(libwyag.commit_is_ancestor(self.repo, c["side"], c["merge"]))
+        self.assertFalse(libwyag.commit_is_ancestor(self.repo, c["other"], c["merge"]))
+        self.assertEqual(libwyag.commit_merge_bases(self.repo, c["two"], c["side"]), [c["one"]])
+        self.assertEqual(libwyag.commit_merge_bases(self.repo, c["merge"], c["other"]), [c["one"]])
+
+    @unittest.skipUnless(shutil.which("git"), "git isn't installed")
+    def test_git_agrees(self):
+        libwyag.commit_graph_write(self.repo, changed_paths=True)
+        subprocess.run(["git", "commit-graph", "verify"], cwd=self.worktree,
+                       check=True, capture_output=True)
+        ours = libwyag.GitCommitGraph(self.graph_path())
+        ours_filters = {sha: ours.bloom(ours.find(sha)) for sha in self.commits.values()}
+        os.chmod(self.graph_path(), 0o644)
+        os.unlink(self.graph_path())
+
+        # git's own graph reads the same, and its filters (of ASCII
+        # paths) are bit for bit ours
+        subprocess.run(["git", "commit-graph", "write", "--reachable", "--changed-paths"],
+                       cwd=self.worktree, check=True, capture_output=True)
+        theirs = libwyag.GitCommitGraph(self.graph_path())
+        self.check_graph(theirs)
+        for sha, bits in ours_filters.items():
+            self.assertEqual(theirs.bloom(theirs.find(sha)), bits)
+
+if __name__ == "__main__":
+    unittest.main()
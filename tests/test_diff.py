@@ -0,0 +1,204 @@
+"""
+Tree diffs: tree_diff between hand-made trees, path limits and
+non-recursive diffs included, and the raw, name-status and --stat output
+built from it, against fixed output git gives for the same trees.
+"""
+
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import libwyag  # noqa: E402
+
+TEXT = b"".join(b"line %d\n" % i for i in range(20))
+
+# {path: (mode, contents)}
+OLD = {
+    "README": ("100644", TEXT),
+    "bin": ("100644", b"\x00\x01\x02" * 10),
+    "run.sh": ("100644", b"echo hi\n"),
+    "link": ("100644", b"target\n"),
+    "gone/a": ("100644", b"a\n"),
+    "gone/b": ("100644", b"b\n"),
+    "src/main.c": ("100644", b"int main;\n"),
+    "src/util.c": ("100644", b"same\n"),
+    "src/lib/x.c": ("100644", b"x\n"),
+}
+NEW = {
+    "README": ("100644", TEXT.replace(b"line 3\n", b"line three\n") + b"more\n"),
+    "bin": ("100644", b"\x00\x01\x02" * 20),
+    "run.sh": ("100755", b"echo hi\n"),
+    "link": ("120000", b"target"),
+    "src/main.c": ("100644", b"int main(void);\n"),
+    "src/util.c": ("100644", b"same\n"),
+    "src/lib/x.c": ("100644", b"x\n"),
+    "src/new/y.c": ("100644", b"y\ny\n"),
+    "zz": ("100644", b""),
+}
+OLD_TREE = "9f84c5d72d26c7b17b9ce339ac0119290fa9761f"
+NEW_TREE = "1c6b52a051bcabcb1d8d39dd20788b54de88e0fe"
+
+# What git diff-tree -r shows for OLD_TREE and NEW_TREE
+RAW = """\
+:100644 100644 af8a489dcd5fafd865d2779c644a9fb1ed226224 9a90e457fc473eeced9b43e659833e95a3803554 M\tREADME
+:100644 100644 c095d21b4873d1325ca28f63beeac2ab62da47f9 1ca09ecd42a7f126c6ddd0284efd1a1b8566120a M\tbin
+:100644 000000 78981922613b2afb6025042ff6bd878ac1994e85 0000000000000000000000000000000000000000 D\tgone/a
+:100644 000000 61780798228d17af2d34fce4cfbdf35556832472 0000000000000000000000000000000000000000 D\tgone/b
+:100644 120000 eb5a316cbd195d26e3f768c7dd8e1b47299e17f8 1de565933b05f74c75ff9a6520af5f9f8a5a2f1d T\tlink
+:100644 100755 8b2fe5434fec16870a71cd8b272c7fcf6d352536 8b2fe5434fec16870a71cd8b272c7fcf6d352536 M\trun.sh
+:100644 100644 f7fb5910a6050ac2cd2cc4563a8651c523a2c526 eba29761620d996a04a654d6150ceede33fb0dac M\tsrc/main.c
+:000000 100644 0000000000000000000000000000000000000000 9b48ee4cf97a769f421b2cdb7b2df71293a1413d A\tsrc/new/y.c
+:000000 100644 0000000000000000000000000000000000000000 e69de29bb2d1d6434b8b29ae775ad8c2e48c5391 A\tzz
+"""
+
+# Without -r
+RAW_TOP = """\
+:100644 100644 af8a489dcd5fafd865d2779c644a9fb1ed226224 9a90e457fc473eeced9b43e659833e95a3803554 M\tREADME
+:100644 100644 c095d21b4873d1325ca28f63beeac2ab62da47f9 1ca09ecd42a7f126c6ddd0284efd1a1b8566120a M\tbin
+:040000 000000 3683f870be446c7cc05ffaef9fa06415276e1828 0000000000000000000000000000000000000000 D\tgone
+:100644 120000 eb5a316cbd195d26e3f768c7dd8e1b47299e17f8 1de565933b05f74c75ff9a6520af5f9f8a5a2f1d T\tlink
+:100644 100755 8b2fe5434fec16870a71cd8b272c7fcf6d352536 8b2fe5434fec16870a71cd8b272c7fcf6d352536 M\trun.sh
+:040000 040000 13113f859c6341f19530f2a29e8ca4d99eb91f19 e69840c43208148e296fa9a09f5fc726d2ddcf3b M\tsrc
+:000000 100644 0000000000000000000000000000000000000000 e69de29bb2d1d6434b8b29ae775ad8c2e48c5391 A\tzz
+"""
+
+STAT = """\
+ README      |   3 ++-
+ bin         | Bin 30 -> 60 bytes
+ gone/a      |   1 -
+ gone/b      |   1 -
+ link        |   2 +-
+ run.sh      |   0
+ src/main.c  |   2 +-
+ src/new/y.c |   2 ++
+ zz          |   0
+ 9 files changed, 6 insertions(+), 5 deletions(-)
+"""
+
+class TreeDiffTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.worktree = os.path.join(self.tmp.name, "worktree")
+        libwyag.repo_create(self.worktree)
+        self.repo = libwyag.GitRepository(self.worktree)
+        self.old, self.new = self.tree(OLD), self.tree(NEW)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def tree(self, files):
+        """Write the tree of files, {path: (mode, contents)}."""
+        items, subdirs = [], {}
+        for path, (mode, data) in files.items():
+            if "/" in path:
+                dirname, name = path.split("/", 1)
+                subdirs.setdefault(dirname, {})[name] = (mode, data)
+            else:
+                items.append((mode, path, libwyag.object_write(b"blob", data, self.repo)))
+        for dirname, subfiles in subdirs.items():
+            items.append((libwyag.TREE_MODE, dirname, self.tree(subfiles)))
+        return libwyag.object_write(b"tree", libwyag.tree_serialize(items), self.repo)
+
+    def output(self, fmt, **kwargs):
+        changes = libwyag.tree_diff(self.repo, self.old, self.new, **kwargs)
+        return "".join(line + "\n" for line in libwyag.diff_format(self.repo, changes, fmt))
+
+    def test_trees(self):
+        self.assertEqual((str(self.old), str(self.new)), (OLD_TREE, NEW_TREE))
+
+    def test_raw(self):
+        self.assertEqual(self.output("raw"), RAW)
+        self.assertEqual(self.output("raw", recursive=False), RAW_TOP)
+
+    def test_names(self):
+        paths = [line.split("\t")[1] for line in RAW.splitlines()]
+        self.assertEqual(self.output("name-only"), "".join(p + "\n" for p in paths))
+        self.assertEqual(self.output("name-status"), "".join(
+            f"{line[97]}\t{path}\n" for line, path in zip(RAW.splitlines(), paths)))
+
+    def test_stat(self):
+        self.assertEqual(self.output("stat"), STAT)
+
+    def test_paths(self):
+        changes = libwyag.tree_diff(self.repo, self.old, self.new, paths=["src/new", "gone/a"])
+        self.assertEqual([path for path, a, b in changes], ["gone/a", "src/new/y.c"])
+        changes = libwyag.tree_diff(self.repo, self.old, self.new, paths=["src"])
+        self.assertEqual([path for path, a, b in changes], ["src/main.c", "src/new/y.c"])
+        changes = libwyag.tree_diff(self.repo, self.old, self.new, paths=["src/lib", "nowhere"])
+        self.assertEqual(list(changes), [])
+
+    def test_empty_sides(self):
+        self.assertEqual(list(libwyag.tree_diff(self.repo, self.old, self.old)), [])
+        added = list(libwyag.tree_diff(self.repo, None, self.new))
+        self.assertEqual([path for path, a, b in added], sorted(NEW))
+        self.assertTrue(all(a is None for path, a, b in added))
+        removed = list(libwyag.tree_diff(self.repo, self.old, None))
+        self.assertEqual(len(removed), len(OLD))
+        self.assertTrue(all(b is None for path, a, b in removed))
+
+    @unittest.skipUnless(shutil.which("git"), "git isn't installed")
+    def test_git_agrees(self):
+        def git(*argv):
+            return subprocess.run(["git", "diff-tree", *argv, OLD_TREE, NEW_TREE],
+                                  cwd=self.worktree, check=True, capture_output=True,
+                                  text=True).stdout
+
+        self.assertEqual(git("-r"), RAW)
+        self.assertEqual(git(), RAW_TOP)
+        self.assertEqual(git("-r", "--stat=80"), STAT)
+
+class DiffStatTest(unittest.TestCase):
+
+    def test_line_counts(self):
+        cases = [
+            (b"a\nb\nc\n", b"a\nc\nd\n", (1, 1)),
+            (b"a\nb\nc\n", b"a\nb\nc\n", (0, 0)),
+            (b"", b"x\ny\n", (2, 0)),
+            (b"x\ny\n", b"", (0, 2)),
+            (b"a", b"a\n", (1, 1)),  # The missing newline counts
+            (b"a\nb\na\nb\n", b"b\na\nb\na\n", (1, 1)),
+            (TEXT, TEXT[::-1], (21, 20)),
+        ]
+        for old, new, expected in cases:
+            self.assertEqual(libwyag.diff_line_counts(old, new), expected, (old[:20], new[:20]))
+
+    # Lines git shows with --stat=80 and --stat=40 for the same changes
+    STATS = [("a/very/long/directory/name/with/a/file.txt", 150, 30, False),
+             ("gone", 0, 7, False), ("img.png", 2048, 1024, True), ("short", 1, 0, False)]
+    WIDE = """\
+ a/very/long/directory/name/with/a/file.txt | 180 ++++++++++++++++++++++++-----
+ gone                                       |   7 --
+ img.png                                    | Bin 1024 -> 2048 bytes
+ short                                      |   1 +
+ 4 files changed, 151 insertions(+), 37 deletions(-)"""
+    NARROW = """\
+ .../name/with/a/file.txt  | 180 +++++-
+ gone                      |   7 -
+ img.png                   | Bin 1024 -> 2048 bytes
+ short                     |   1 +
+ 4 files changed, 151 insertions(+), 37 deletions(-)"""
+
+    def test_layout(self):
+        self.assertEqual(libwyag.diff_stat_lines(self.STATS, 80), self.WIDE.splitlines())
+        self.assertEqual(libwyag.diff_stat_lines(self.STATS, 40), self.NARROW.splitlines())
+        self.assertIsNone(libwyag.diff_stat_lines([], 80))
+
+    def test_summary(self):
+        def summary(stats):
+            return libwyag.diff_stat_lines(stats, 80)[-1]
+
+        self.assertEqual(summary([("a", 1, 0, False)]),
+                         " 1 file changed, 1 insertion(+)")
+        self.assertEqual(summary([("a", 0, 2, False)]),
+                         " 1 file changed, 2 deletions(-)")
+        self.assertEqual(summary([("a", 0, 0, False), ("b", 0, 0, False)]),
+                         " 2 files changed, 0 insertions(+), 0 deletions(-)")
+
+if __name__ == "__main__":
+    unittest.main()
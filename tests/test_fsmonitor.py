@@ -0,0 +1,129 @@
+"""
+The fsmonitor daemon, driven in-process: FsMonitor(repo).start() serves
+its socket on background threads, and the tests query it the way
+commands do.
+"""
+
+import os
+import sys
+import tempfile
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import libwyag  # noqa: E402
+
+@unittest.skipUnless(sys.platform.startswith("linux"), "the fsmonitor uses inotify")
+class FsMonitorTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.worktree = os.path.join(self.tmp.name, "worktree")
+        libwyag.repo_create(self.worktree)
+        self.repo = libwyag.GitRepository(self.worktree)
+        self.repo.conf.set("core", "fsmonitor", "true")
+        self.write("a/b/file", "1")
+        self.write("top", "1")
+        self.monitor = libwyag.FsMonitor(self.repo)
+        self.monitor.start()
+
+    def tearDown(self):
+        self.monitor.stop()
+        self.tmp.cleanup()
+
+    def write(self, name, text):
+        path = os.path.join(self.worktree, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "w") as f:
+            f.write(text)
+
+    def query(self, token=""):
+        """(new token, changed paths) since token."""
+        answer = libwyag.fsmonitor_request(self.repo, f"query {token}")
+        token, *paths = answer.decode().split("\x00")[:-1]
+        return token, paths
+
+    def staged_index(self):
+        """An index with every file of the worktree staged."""
+        index = libwyag.GitIndex()
+        candidates = []
+        for name in ("a/b/file", "top"):
+            path = os.path.join(self.worktree, name)
+            candidates.append((path, name, os.lstat(path)))
+        libwyag.add_files(self.repo, index, candidates)
+        return index
+
+    def test_unknown_token_means_everything(self):
+        token, paths = self.query("")
+        self.assertTrue(token.startswith("wyag:"))
+        self.assertEqual(paths, ["/"])
+        self.assertEqual(self.query("wyag:another:1")[1], ["/"])
+
+    def test_changes_since_token(self):
+        token, paths = self.query()
+        # Changes made right before a query are always in its answer
+        self.write("a/b/file", "2")
+        self.write("new", "x")
+        token2, paths = self.query(token)
+        self.assertEqual(paths, ["a/b/file", "new"])
+        self.assertEqual(self.query(token2)[1], [])
+
+    def test_new_directories_are_watched(self):
+        token, paths = self.query()
+        os.makedirs(os.path.join(self.worktree, "c/d"))
+        token, paths = self.query(token)
+        self.assertIn("c/", paths)
+        self.write("c/d/file", "x")
+        self.assertEqual(self.query(token)[1], ["c/d/file"])
+
+    def test_journal_trimmed(self):
+        with mock.patch.object(libwyag, "FSMONITOR_JOURNAL_MAX", 16):
+            first, paths = self.query()
+            token = first
+            for i in range(20):
+                self.write(f"file{i}", "x")
+                token, paths = self.query(token)
+                self.assertEqual(paths, [f"file{i}"])
+            # Too old to answer precisely
+            self.assertEqual(self.query(first)[1], ["/"])
+        self.assertLessEqual(len(self.monitor.journal), 32)
+
+    def test_check(self):
+        index = self.staged_index()
+        token, names = libwyag.fsmonitor_check(self.repo, index)
+        self.assertIsNone(names)  # No token yet: look at everything
+        libwyag.fsmonitor_done(index, token, set())
+
+        self.write("top", "2")
+        token, names = libwyag.fsmonitor_check(self.repo, index)
+        self.assertEqual(names, {"top"})
+        # Entries found dirty stay to be looked at next time
+        libwyag.fsmonitor_done(index, token, {"top"})
+        self.assertEqual(libwyag.fsmonitor_check(self.repo, index)[1], {"top"})
+
+    def test_status_and_stop(self):
+        self.assertTrue(libwyag.fsmonitor_request(self.repo, "status").startswith(b"pid "))
+        self.assertEqual(libwyag.fsmonitor_request(self.repo, "stop"), b"ok\n")
+        self.assertTrue(self.monitor.stopped.wait(5))
+        self.monitor.stop()
+        self.assertFalse(os.path.exists(libwyag.repo_path(self.repo, libwyag.FSMONITOR_SOCKET)))
+
+        # Commands fall back to looking at everything
+        self.assertIsNone(libwyag.fsmonitor_request(self.repo, "status"))
+        index = self.staged_index()
+        self.assertEqual(libwyag.fsmonitor_check(self.repo, index), (None, None))
+
+    def test_socket_left_by_a_dead_daemon(self):
+        self.monitor.stop()
+        # A socket file nothing listens on
+        import socket
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.bind(libwyag.repo_path(self.repo, libwyag.FSMONITOR_SOCKET))
+        self.assertIsNone(libwyag.fsmonitor_request(self.repo, "status"))
+        self.monitor = libwyag.FsMonitor(self.repo)
+        self.monitor.start()
+        self.assertEqual(self.query()[1], ["/"])
+
+if __name__ == "__main__":
+    unittest.main()
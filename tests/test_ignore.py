@@ -0,0 +1,172 @@
+"""
+Ignore rules: IgnoreRules on its own for the pattern syntax (negation,
+anchoring, directory-only patterns, globs), and IgnoreMatcher for the
+precedence between .gitignore files, info/exclude and
+core.excludesFile.
+"""
+
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import libwyag  # noqa: E402
+
+def ignored(lines, path, is_dir=False, base=""):
+    return libwyag.IgnoreRules(lines, base).match(path, path.rpartition("/")[2], is_dir)
+
+class IgnoreRulesTest(unittest.TestCase):
+
+    def test_plain_names_match_at_any_depth(self):
+        self.assertTrue(ignored(["build"], "build"))
+        self.assertTrue(ignored(["build"], "a/b/build", True))
+        self.assertIsNone(ignored(["build"], "builder"))
+        self.assertIsNone(ignored(["build"], "build/x"))
+
+    def test_anchoring(self):
+        # A slash anywhere but at the end anchors the pattern to its directory
+        self.assertTrue(ignored(["/build"], "build"))
+        self.assertIsNone(ignored(["/build"], "a/build"))
+        self.assertTrue(ignored(["doc/*.txt"], "doc/notes.txt"))
+        self.assertIsNone(ignored(["doc/*.txt"], "a/doc/notes.txt"))
+        self.assertIsNone(ignored(["doc/*.txt"], "doc/sub/notes.txt"))
+        # Patterns of a deeper .gitignore are relative to its directory
+        self.assertTrue(ignored(["/out"], "sub/out", base="sub/"))
+        self.assertIsNone(ignored(["/out"], "sub/deeper/out", base="sub/"))
+
+    def test_directory_only(self):
+        self.assertTrue(ignored(["cache/"], "cache", True))
+        self.assertIsNone(ignored(["cache/"], "cache", False))
+        self.assertTrue(ignored(["*.d/"], "x/y.d", True))
+        self.assertIsNone(ignored(["*.d/"], "x/y.d", False))
+
+    def test_negation_last_match_wins(self):
+        self.assertFalse(ignored(["*.log", "!keep.log"], "keep.log"))
+        self.assertTrue(ignored(["*.log", "!keep.log"], "other.log"))
+        self.assertTrue(ignored(["!keep.log", "*.log"], "keep.log"))
+        self.assertFalse(ignored(["/a*", "!/ab*"], "abc"))
+        self.assertTrue(ignored(["/a*", "!/ab*", "/abc"], "abc"))
+
+    def test_globs(self):
+        self.assertTrue(ignored(["*.o"], "a/b.o"))
+        self.assertTrue(ignored(["a?c"], "abc"))
+        self.assertIsNone(ignored(["a?c"], "a/c"))
+        self.assertTrue(ignored(["[abc].txt"], "b.txt"))
+        self.assertIsNone(ignored(["[!abc].txt"], "b.txt"))
+        self.assertTrue(ignored(["[!abc].txt"], "d.txt"))
+        self.assertTrue(ignored(["**/logs"], "a/b/logs", True))
+        self.assertTrue(ignored(["**/logs"], "logs", True))
+        self.assertTrue(ignored(["a/**/z"], "a/z"))
+        self.assertTrue(ignored(["a/**/z"], "a/b/c/z"))
+        self.assertTrue(ignored(["a/**"], "a/b/c"))
+        self.assertIsNone(ignored(["a/**"], "a"))
+
+    def test_syntax(self):
+        self.assertIsNone(ignored(["# comment", "", "   "], "# comment"))
+        self.assertTrue(ignored(["\\#hash"], "#hash"))
+        self.assertTrue(ignored(["\\!bang"], "!bang"))
+        self.assertTrue(ignored(["trailing   "], "trailing"))
+        self.assertTrue(ignored(["space\\ "], "space "))
+        self.assertIsNone(ignored(["space\\ "], "space"))
+
+class IgnoreMatcherTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.worktree = os.path.join(self.tmp.name, "worktree")
+        libwyag.repo_create(self.worktree)
+        self.repo = libwyag.GitRepository(self.worktree)
+        self.excludes = os.path.join(self.tmp.name, "excludes")
+        self.repo.conf.set("core", "excludesfile", self.excludes)
+        self.write("excludes", "*.tmp\n*.bak\nglobal\n", root=self.tmp.name)
+        self.write(".git/info/exclude", "!keep.tmp\n*.swp\n")
+        self.write(".gitignore", "/build/\n*.log\n!important.log\nvendor\n")
+        self.write("src/.gitignore", "!*.bak\ngen/\n/local\n")
+        self.write("src/deep/.gitignore", "*.log\n")
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def write(self, name, text, root=None):
+        path = os.path.join(root or self.worktree, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "w") as f:
+            f.write(text)
+
+    # Path, is a directory, ignored
+    CASES = [
+        ("a.tmp", False, True),           # core.excludesFile
+        ("keep.tmp", False, False),       # info/exclude beats it
+        ("x.swp", False, True),           # info/exclude
+        ("a.log", False, True),           # .gitignore
+        ("important.log", False, False),  # negated
+        ("src/a.log", False, True),       # .gitignore of a directory above
+        ("src/a.bak", False, False),      # deeper .gitignore beats excludesFile
+        ("a.bak", False, True),
+        ("src/deep/important.log", False, True),  # deeper .gitignore beats negation
+        ("build", True, True),            # anchored, directory only
+        ("build", False, False),
+        ("src/build", True, False),
+        ("src/gen", True, True),
+        ("src/gen", False, False),
+        ("src/local", False, True),
+        ("local", False, False),
+        ("vendor", True, True),
+        ("src/vendor", True, True),
+        ("global", False, True),
+        ("src/main.c", False, False),
+    ]
+
+    def test_precedence(self):
+        matcher = libwyag.IgnoreMatcher(self.repo)
+        for path, is_dir, expected in self.CASES:
+            self.assertEqual(matcher.ignored(path, is_dir), bool(expected), path)
+
+    def test_excluded_names_the_ignored_directory(self):
+        matcher = libwyag.IgnoreMatcher(self.repo)
+        self.assertEqual(matcher.excluded("build/out/x.c", False), "build")
+        self.assertEqual(matcher.excluded("src/gen/x.c", False), "src/gen")
+        self.assertEqual(matcher.excluded("src/a.log", False), "src/a.log")
+        self.assertIsNone(matcher.excluded("src/main.c", False))
+        # A file can't be re-included from inside an ignored directory
+        self.write("vendor/.gitignore", "!*\n")
+        matcher = libwyag.IgnoreMatcher(self.repo)
+        self.assertEqual(matcher.excluded("vendor/lib.c", False), "vendor")
+
+    def test_digests(self):
+        matcher = libwyag.IgnoreMatcher(self.repo)
+        digest = matcher.load("src/").digest
+        self.write("src/.gitignore", "other\n")
+        self.assertNotEqual(libwyag.IgnoreMatcher(self.repo).load("src/").digest, digest)
+        self.assertIsNone(matcher.load("nowhere/", False))
+
+    @unittest.skipUnless(shutil.which("git"), "git isn't installed")
+    def test_git_agrees(self):
+        paths = []
+        for path, is_dir, expected in self.CASES:
+            full = os.path.join(self.worktree, path)
+            if is_dir:
+                os.makedirs(full, exist_ok=True)
+            elif not os.path.exists(full):
+                self.write(path, "")
+            paths.append((path, is_dir))
+        paths = [(path, is_dir) for path, is_dir in paths
+                 if os.path.isdir(os.path.join(self.worktree, path)) == is_dir]
+        # Files in ignored directories
+        for path in ("build/out/x.c", "src/gen/x.c", "vendor/lib.c"):
+            self.write(path, "")
+            paths.append((path, False))
+        proc = subprocess.run(["git", "-c", f"core.excludesFile={self.excludes}",
+                               "check-ignore", "--no-index", *(p for p, d in paths)],
+                              cwd=self.worktree, capture_output=True, text=True)
+        by_git = set(proc.stdout.splitlines())
+        matcher = libwyag.IgnoreMatcher(self.repo)
+        for path, is_dir in paths:
+            self.assertEqual(matcher.excluded(path, is_dir) is not None, path in by_git, path)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,161 @@
+"""
+The staging index: index_write/index_read round trips, the TREE
+(cache-tree) and FSMN (fsmonitor) extensions, and the EWAH bitmaps the
+latter is stored with.
+"""
+
+import os
+import shutil
+import struct
+import subprocess
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import libwyag  # noqa: E402
+
+FILES = {"a": "1", "dir/b": "2", "dir/sub/c": "3", "dir/sub/d": "4", "e": "5"}
+
+def entry_fields(entry):
+    return (entry.name, entry.sha, entry.mode, entry.ctime, entry.mtime, entry.dev,
+            entry.ino, entry.uid, entry.gid, entry.size, entry.flags)
+
+def cache_tree_fields(tree):
+    return (tree.name, tree.entry_count, tree.sha,
+            {name: cache_tree_fields(child) for name, child in tree.subtrees.items()})
+
+class IndexTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.worktree = os.path.join(self.tmp.name, "worktree")
+        libwyag.repo_create(self.worktree)
+        self.repo = libwyag.GitRepository(self.worktree)
+        self.index = libwyag.GitIndex()
+        candidates = []
+        for name, text in FILES.items():
+            path = os.path.join(self.worktree, name)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, "w") as f:
+                f.write(text)
+            candidates.append((path, name, os.lstat(path)))
+        libwyag.add_files(self.repo, self.index, candidates)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def roundtrip(self, index):
+        libwyag.index_write(self.repo, index)
+        return libwyag.index_read(self.repo)
+
+    def test_entries(self):
+        index = self.roundtrip(self.index)
+        self.assertEqual(sorted(index.entries), sorted(FILES))
+        for name, entry in index.entries.items():
+            self.assertEqual(entry_fields(entry), entry_fields(self.index.entries[name]))
+        self.assertIsNone(index.cache_tree)
+        self.assertIsNone(index.fsmonitor_token)
+
+    def test_long_name(self):
+        name = "d/" + "x" * 5000
+        sha = next(iter(self.index.entries.values())).sha
+        self.index.entries[name] = libwyag.GitIndexEntry(name, sha, 0o100644)
+        index = self.roundtrip(self.index)
+        self.assertEqual(entry_fields(index.entries[name]),
+                         entry_fields(self.index.entries[name]))
+        self.assertEqual(len(index.entries), len(FILES) + 1)
+
+    def test_empty(self):
+        index = self.roundtrip(libwyag.GitIndex())
+        self.assertEqual(index.entries, {})
+
+    def test_corrupt(self):
+        libwyag.index_write(self.repo, self.index)
+        path = libwyag.repo_path(self.repo, "index")
+        with open(path, "r+b") as f:
+            f.seek(40)
+            byte = f.read(1)
+            f.seek(40)
+            f.write(bytes([byte[0] ^ 1]))
+        with self.assertRaisesRegex(Exception, "bad checksum"):
+            libwyag.index_read(self.repo)
+
+    def test_tree_extension(self):
+        root = libwyag.tree_write_index(self.repo, self.index)
+        index = self.roundtrip(self.index)
+        self.assertEqual(index.cache_tree.sha, root)
+        self.assertEqual(cache_tree_fields(index.cache_tree),
+                         cache_tree_fields(self.index.cache_tree))
+        self.assertEqual(index.cache_tree.entry_count, len(FILES))
+        self.assertEqual(index.cache_tree.subtrees["dir"].subtrees["sub"].entry_count, 2)
+
+        # Staging dir/sub/c invalidates the trees above it only
+        libwyag.cache_tree_invalidate(index, "dir/sub/c")
+        index = self.roundtrip(index)
+        self.assertEqual(index.cache_tree.entry_count, -1)
+        self.assertEqual(index.cache_tree.subtrees["dir"].subtrees["sub"].entry_count, -1)
+        self.assertIsNone(index.cache_tree.sha)
+        self.assertEqual(libwyag.tree_write_index(self.repo, index), root)
+
+    def test_fsmonitor_extension(self):
+        self.index.fsmonitor_token = "wyag:1234:56"
+        self.index.fsmonitor_dirty = {"dir/b", "e"}
+        index = self.roundtrip(self.index)
+        self.assertEqual(index.fsmonitor_token, "wyag:1234:56")
+        self.assertEqual(index.fsmonitor_dirty, {"dir/b", "e"})
+
+        index.fsmonitor_dirty = set()
+        index = self.roundtrip(index)
+        self.assertEqual(index.fsmonitor_dirty, set())
+
+    @unittest.skipUnless(shutil.which("git"), "git isn't installed")
+    def test_git_reads_index(self):
+        self.index.fsmonitor_token = "wyag:1234:56"
+        root = libwyag.tree_write_index(self.repo, self.index)
+        libwyag.index_write(self.repo, self.index)
+
+        def git(*argv):
+            return subprocess.run(["git", *argv], cwd=self.worktree, check=True,
+                                  capture_output=True, text=True).stdout
+
+        staged = git("ls-files", "-s").splitlines()
+        self.assertEqual(staged, [f"{e.mode:o} {e.sha} 0\t{name}"
+                                  for name, e in sorted(self.index.entries.items())])
+        self.assertEqual(git("write-tree").strip(), str(root))
+
+class EwahTest(unittest.TestCase):
+
+    def test_known_bitmap(self):
+        # Bits 0, 2 and 192 of 200: a literal word, then a run of two zero
+        # words and another literal word
+        words = [1 << 33, 0b101, 2 << 1 | 1 << 33, 1]
+        data = struct.pack(">II4QI", 200, 4, *words, 2)
+        self.assertEqual(libwyag.ewah_serialize([0, 2, 192], 200), data)
+        self.assertEqual(libwyag.ewah_parse(data), ([0, 2, 192], len(data)))
+
+    def test_run_of_ones(self):
+        # One run length word: two words of ones, no literals
+        data = struct.pack(">IIQI", 100, 1, 1 | 2 << 1, 0)
+        self.assertEqual(libwyag.ewah_parse(data), (list(range(100)), len(data)))
+
+    def test_parse_at_offset(self):
+        data = b"junk" + libwyag.ewah_serialize([3], 10) + b"more"
+        self.assertEqual(libwyag.ewah_parse(data, 4), ([3], len(data) - 4))
+
+    def test_roundtrips(self):
+        cases = [
+            ([], 0),
+            ([], 1000),
+            ([999], 1000),
+            (list(range(0, 640, 2)), 640),
+            (list(range(64 * 5)), 64 * 5 + 1),
+            ([0, 64 * 1000, 64 * 1000 + 63], 64 * 1001),
+        ]
+        for bits, size in cases:
+            data = libwyag.ewah_serialize(bits, size)
+            self.assertEqual(libwyag.ewah_parse(data), (bits, len(data)), (bits[:5], size))
+
+if __name__ == "__main__":
+    unittest.main()
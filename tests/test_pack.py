@@ -0,0 +1,178 @@
+"""
+Deltas and packfiles: delta_create/delta_apply against each other and
+against hand-assembled deltas, and packs written by pack_write read back
+through GitPack, delta chains included.
+"""
+
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import libwyag  # noqa: E402
+
+def versions(count):
+    """count versions of a text file, each one growing and editing the last."""
+    lines = [f"line {i}: {'x' * (i % 7)}\n".encode() for i in range(200)]
+    out = []
+    for v in range(count):
+        lines[v * 13 % len(lines)] = f"edited in version {v}\n".encode()
+        lines.append(f"added in version {v}\n".encode())
+        out.append(b"".join(lines))
+    return out
+
+class DeltaTest(unittest.TestCase):
+
+    def roundtrip(self, base, target):
+        delta = libwyag.delta_create(base, libwyag.delta_index(base), target, len(target) + 64)
+        self.assertIsNotNone(delta)
+        self.assertEqual(libwyag.delta_apply(base, delta), target)
+        return delta
+
+    def test_known_delta(self):
+        base = b"hello world"
+        # Sizes 11 and 11; copy 5 bytes at 6, insert " ", copy 5 bytes at 0
+        delta = b"\x0b\x0b" + b"\x91\x06\x05" + b"\x01 " + b"\x90\x05"
+        self.assertEqual(libwyag.delta_apply(base, delta), b"world hello")
+
+    def test_copy_size_zero_means_64k(self):
+        base = bytes(range(256)) * 512  # 128 KiB
+        delta = libwyag.delta_varint(len(base)) + libwyag.delta_varint(0x10000) + b"\x80"
+        self.assertEqual(libwyag.delta_apply(base, delta), base[:0x10000])
+
+    def test_varint(self):
+        self.assertEqual(libwyag.delta_varint(0), b"\x00")
+        self.assertEqual(libwyag.delta_varint(127), b"\x7f")
+        self.assertEqual(libwyag.delta_varint(128), b"\x80\x01")
+        self.assertEqual(libwyag.delta_varint(0x10000), b"\x80\x80\x04")
+
+    def test_roundtrips(self):
+        old, new = versions(2)
+        delta = self.roundtrip(old, new)
+        self.assertLess(len(delta), len(new) // 4)
+        self.roundtrip(new, old)
+        self.roundtrip(old, b"")
+        self.roundtrip(b"", b"short")
+        self.roundtrip(b"a" * 100, b"b" * 100)
+
+    def test_large_copies_split(self):
+        base = os.urandom(0x30000)
+        target = base[5:] + b"tail"
+        delta = self.roundtrip(base, target)
+        self.assertLess(len(delta), 64)
+
+    def test_gives_up_past_max_size(self):
+        base, target = os.urandom(1000), os.urandom(1000)
+        self.assertIsNone(libwyag.delta_create(base, libwyag.delta_index(base), target, 500))
+
+    def test_corrupt_deltas(self):
+        with self.assertRaises(Exception):
+            libwyag.delta_apply(b"abc", b"\x04\x01\x01x")  # Wrong base size
+        with self.assertRaises(Exception):
+            libwyag.delta_apply(b"abc", b"\x03\x02\x01x")  # Wrong result size
+        with self.assertRaises(Exception):
+            libwyag.delta_apply(b"abc", b"\x03\x01\x00")   # Reserved opcode
+
+class PackTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.worktree = os.path.join(self.tmp.name, "worktree")
+        libwyag.repo_create(self.worktree)
+        self.repo = libwyag.GitRepository(self.worktree)
+        self.objects = {}
+        for data in versions(12) + [os.urandom(3000), b""]:
+            self.objects[libwyag.object_write(b"blob", data, self.repo)] = (b"blob", data)
+        tree = libwyag.tree_serialize([("100644", "file", next(iter(self.objects)))])
+        self.objects[libwyag.object_write(b"tree", tree, self.repo)] = (b"tree", tree)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def pack(self, name):
+        return libwyag.GitPack(libwyag.repo_path(self.repo, "objects", "pack", f"pack-{name}.idx"))
+
+    def test_read_back(self):
+        name = libwyag.pack_write(self.repo, list(self.objects), window=10, depth=50)
+        pack = self.pack(name)
+        self.assertEqual(pack.count, len(self.objects))
+        self.assertEqual(sorted(pack.ids()), sorted(self.objects))
+
+        types = {}
+        for sha, obj in self.objects.items():
+            offset = pack.find(sha)
+            self.assertIsNotNone(offset)
+            self.assertEqual(pack.read_at(offset), obj)
+            self.assertEqual(pack.info(offset), (obj[0], len(obj[1])))
+            types[sha] = pack.entry_header(offset)[0]
+        # The versions of the file are stored as deltas of each other
+        self.assertGreaterEqual(list(types.values()).count(libwyag.PACK_OFS_DELTA), 8)
+        self.assertIsNone(pack.find(libwyag.ObjectId(b"\xff" * 20)))
+
+    def chain_length(self, pack, offset):
+        length = 0
+        while True:
+            type_num, size, pos = pack.entry_header(offset)
+            if type_num != libwyag.PACK_OFS_DELTA:
+                return length
+            distance, pos = pack.ofs_distance(pos)
+            offset -= distance
+            length += 1
+
+    def test_chains_and_depth(self):
+        name = libwyag.pack_write(self.repo, list(self.objects), window=1, depth=50)
+        pack = self.pack(name)
+        lengths = [self.chain_length(pack, pack.find(sha)) for sha in self.objects]
+        self.assertGreater(max(lengths), 2)
+
+        # Chains are cached along the way, and read the same with a cache
+        cache = libwyag.ObjectCache(1 << 20)
+        for sha, obj in self.objects.items():
+            self.assertEqual(pack.read_at(pack.find(sha), cache=cache), obj)
+        self.assertGreater(cache.hits, 0)
+
+        name = libwyag.pack_write(self.repo, list(self.objects), window=1, depth=2)
+        pack = self.pack(name)
+        self.assertLessEqual(max(self.chain_length(pack, pack.find(sha))
+                                 for sha in self.objects), 2)
+
+    def test_big_objects_stored_whole(self):
+        self.repo.conf.set("core", "bigfilethreshold", "1k")
+        name = libwyag.pack_write(self.repo, list(self.objects))
+        pack = self.pack(name)
+        for sha, (fmt, data) in self.objects.items():
+            offset = pack.find(sha)
+            if len(data) > 1024:
+                self.assertEqual(pack.entry_header(offset)[0], libwyag.PACK_TYPES[fmt])
+            self.assertEqual(pack.read_at(offset), (fmt, data))
+
+    def test_gc_leaves_one_pack(self):
+        cwd = os.getcwd()
+        os.chdir(self.worktree)
+        self.addCleanup(os.chdir, cwd)
+        pack_dir = libwyag.repo_path(self.repo, "objects", "pack")
+        for data in (b"one", b"two"):
+            libwyag.main(["repack", "-d"])
+            self.objects[libwyag.object_write(b"blob", data, self.repo)] = (b"blob", data)
+        self.assertEqual(len([n for n in os.listdir(pack_dir) if n.endswith(".idx")]), 2)
+
+        libwyag.main(["gc"])
+        packs = [n for n in os.listdir(pack_dir) if n.endswith(".idx")]
+        self.assertEqual(len(packs), 1)
+        self.assertEqual(list(libwyag.object_loose_list(self.repo)), [])
+        repo = libwyag.GitRepository(self.worktree)
+        for sha, obj in self.objects.items():
+            self.assertEqual(libwyag.object_read(repo, sha), obj)
+
+    @unittest.skipUnless(shutil.which("git"), "git isn't installed")
+    def test_git_verifies_pack(self):
+        name = libwyag.pack_write(self.repo, list(self.objects))
+        idx = libwyag.repo_path(self.repo, "objects", "pack", f"pack-{name}.idx")
+        subprocess.run(["git", "verify-pack", idx], check=True, capture_output=True)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,65 @@
+"""
+Startup cost of the CLI: `wyag --version` under `python -X importtime`.
+
+Every command pays for what importing libwyag pulls in, so the import
+has a time budget, and the modules only some commands need must not be
+imported at startup.
+"""
+
+import os
+import subprocess
+import sys
+import tempfile
+import unittest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Microseconds importing libwyag may take, bytecode cached, dependencies
+# included.  It takes under 10 ms; the slack is for slow CI machines.
+IMPORT_BUDGET_US = 50000
+
+# Modules that must wait until a command needs them
+DEFERRED = ["argparse", "concurrent.futures", "configparser", "ctypes", "hashlib",
+            "json", "logging", "mmap", "re", "socket", "socketserver",
+            "subprocess", "tempfile", "zlib"]
+
+def import_times(env):
+    """{module: cumulative microseconds} of a `wyag --version` run."""
+    proc = subprocess.run([sys.executable, "-X", "importtime",
+                           os.path.join(ROOT, "wyag"), "--version"],
+                          capture_output=True, text=True, env=env, check=True)
+    times = {}
+    for line in proc.stderr.splitlines():
+        if not line.startswith("import time:"):
+            continue
+        self_us, cumulative, name = line[len("import time:"):].split("|")
+        if cumulative.strip().isdigit():
+            times[name.strip()] = int(cumulative)
+    return times
+
+class StartupTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        # Cache bytecode outside the tree, and warm it up: compiling
+        # libwyag isn't what is measured
+        cls.pycache = tempfile.TemporaryDirectory()
+        env = dict(os.environ, PYTHONPYCACHEPREFIX=cls.pycache.name)
+        env.pop("PYTHONDONTWRITEBYTECODE", None)
+        import_times(env)
+        cls.times = import_times(env)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.pycache.cleanup()
+
+    def test_import_budget(self):
+        self.assertIn("libwyag", self.times)
+        self.assertLess(self.times["libwyag"], IMPORT_BUDGET_US)
+
+    def test_deferred_modules(self):
+        imported = [name for name in DEFERRED if name in self.times]
+        self.assertEqual(imported, [])
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,149 @@
+"""
+status and the stat cache of the index, racy git in particular: a file
+changed in the same timestamp tick the index was written in has the
+stat data of its index entry, and must be hashed rather than trusted.
+"""
+
+import contextlib
+import io
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import libwyag  # noqa: E402
+
+class StatusTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.worktree = os.path.join(self.tmp.name, "worktree")
+        libwyag.repo_create(self.worktree)
+        self.repo = libwyag.GitRepository(self.worktree)
+        cwd = os.getcwd()
+        os.chdir(self.worktree)
+        self.addCleanup(os.chdir, cwd)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def write(self, name, text):
+        path = os.path.join(self.worktree, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "w") as f:
+            f.write(text)
+        return path
+
+    def wyag(self, *argv):
+        out = io.StringIO()
+        with contextlib.redirect_stdout(out):
+            libwyag.main(list(argv))
+        return out.getvalue()
+
+    def status(self):
+        return self.wyag("status", "--porcelain", "-uall").splitlines()
+
+    def index_mtime(self, mtime_ns):
+        """Give .git/index the mtime mtime_ns."""
+        os.utime(libwyag.repo_path(self.repo, "index"), ns=(mtime_ns, mtime_ns))
+
+    def stale_entry(self, name, old_text, new_text):
+        """
+        Stage old_text as name, then write new_text (of the same size) and
+        record the stat data of the new file with the id of the old one:
+        the index of a racy change.  Returns the new file's mtime.
+        """
+        path = self.write(name, old_text)
+        self.wyag("add", name)
+        index = libwyag.index_read(self.repo)
+        sha = index.entries[name].sha
+        with open(path, "w") as f:
+            f.write(new_text)
+        st = os.lstat(path)
+        index.entries[name] = libwyag.index_entry_from_stat(name, sha, st)
+        index.mtime_ns = None
+        libwyag.index_write(self.repo, index)
+        return st.st_mtime_ns
+
+    def test_racy_change_is_found(self):
+        mtime = self.stale_entry("a", "old\n", "new\n")
+        # Written in the same tick as the file: the entry can't be trusted
+        self.index_mtime(mtime)
+        self.assertEqual(self.status(), ["AM a"])
+
+    def test_stat_data_trusted_once_older_than_index(self):
+        mtime = self.stale_entry("a", "old\n", "new\n")
+        # The same entry with an index written later is trusted without
+        # hashing: this is what the racy check is for
+        self.index_mtime(mtime + 10**9)
+        self.assertEqual(self.status(), ["A  a"])
+
+    def test_racy_entries_smudged_on_write(self):
+        mtime = self.stale_entry("a", "old\n", "new\n")
+        self.index_mtime(mtime)
+        # Rewriting the index makes it newer than the entry: the entry is
+        # written with a zero size so it still gets hashed next time
+        index = libwyag.index_read(self.repo)
+        libwyag.index_write(self.repo, index)
+        index = libwyag.index_read(self.repo)
+        self.assertEqual(index.entries["a"].size, 0)
+        self.assertEqual(self.status(), ["AM a"])
+
+    def test_racily_clean_file_refreshed(self):
+        path = self.write("a", "same\n")
+        self.wyag("add", "a")
+        self.index_mtime(os.lstat(path).st_mtime_ns)
+        self.assertEqual(self.status(), ["A  a"])
+        # status hashed the file, found it clean and saved its stat data
+        index = libwyag.index_read(self.repo)
+        self.assertTrue(libwyag.index_entry_uptodate(index, index.entries["a"], os.lstat(path)))
+
+    def test_uptodate(self):
+        path = self.write("a", "text\n")
+        st = os.lstat(path)
+        entry = libwyag.index_entry_from_stat("a", libwyag.ObjectId(b"\x01" * 20), st)
+        index = libwyag.GitIndex({"a": entry}, st.st_mtime_ns + 1)
+        self.assertTrue(libwyag.index_entry_uptodate(index, entry, st))
+        index.mtime_ns = st.st_mtime_ns
+        self.assertFalse(libwyag.index_entry_uptodate(index, entry, st))
+        index.mtime_ns = None
+        self.assertFalse(libwyag.index_entry_uptodate(index, entry, st))
+
+        # Executable bits only count with core.fileMode
+        os.chmod(path, 0o755)
+        st = os.lstat(path)
+        entry = libwyag.index_entry_from_stat("a", entry.sha, st)
+        entry.mode = 0o100644
+        index.mtime_ns = st.st_mtime_ns + 1
+        self.assertFalse(libwyag.index_entry_uptodate(index, entry, st))
+        self.assertTrue(libwyag.index_entry_uptodate(index, entry, st, filemode=False))
+
+    def test_porcelain(self):
+        for name in ("kept", "changed", "removed", "dir/staged"):
+            self.write(name, "1\n")
+        self.wyag("add", ".")
+        self.wyag("commit", "First")
+        self.write("changed", "2\n")
+        self.write("dir/staged", "22\n")
+        self.write("dir/new", "1\n")
+        self.write("untracked/file", "1\n")
+        self.wyag("add", "dir/staged", "dir/new")
+        os.unlink("removed")
+        self.write("dir/staged", "333\n")
+
+        lines = self.wyag("status", "--porcelain").splitlines()
+        self.assertEqual(lines, [" M changed", "A  dir/new", "MM dir/staged", " D removed",
+                                 "?? untracked/"])
+        self.assertEqual(self.status()[-1], "?? untracked/file")
+
+        if shutil.which("git"):
+            git = subprocess.run(["git", "status", "--porcelain"], check=True,
+                                 capture_output=True, text=True).stdout
+            self.assertEqual(git.splitlines(), lines)
+
+if __name__ == "__main__":
+    unittest.main()